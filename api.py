@@ -1,9 +1,14 @@
+import atexit
+
 from flask import Flask
 
+from main import main
 from main_bp import main_bp
 
 app = Flask(__name__)
 app.register_blueprint(main_bp, url_prefix='/api')
+# The IMAP connections kept by imports are logged out when the worker exits
+atexit.register(main.close)
 
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=7667)
@@ -0,0 +1,94 @@
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+
+# ioctl that makes dst share the data blocks of src on btrfs, xfs and other CoW filesystems
+FICLONE = 0x40049409
+
+
+class BlobWriter:
+    """Writes a blob in chunks to a temporary file, hashing it on the way, and moves it into the store on commit."""
+
+    def __init__(self, store):
+        self.store = store
+        self.sha256 = hashlib.sha256()
+        os.makedirs(store.base_path, exist_ok=True)
+        fd, self.tmp_path = tempfile.mkstemp(dir=store.base_path, suffix=".tmp")
+        self.file = os.fdopen(fd, "wb")
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.file.write(data)
+
+    def commit(self):
+        self.file.close()
+        digest = self.sha256.hexdigest()
+        path = self.store.path_for(digest)
+        if os.path.exists(path):
+            os.remove(self.tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self.tmp_path, path)
+        return path, digest
+
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class AttachmentStore:
+    """Stores every attachment once under its SHA-256, sharded as <base_path>/ab/cd/abcd....pdf."""
+
+    def __init__(self, base_path, extension=".pdf"):
+        self.base_path = base_path
+        self.extension = extension
+
+    def path_for(self, digest):
+        return os.path.join(self.base_path, digest[:2], digest[2:4], digest + self.extension)
+
+    def put(self, payload):
+        digest = hashlib.sha256(payload).hexdigest()
+        path = self.path_for(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temporary file first so a blob is either complete or missing
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(payload)
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        return path, digest
+
+    def open_writer(self):
+        # For attachments that are too large to be held in memory
+        return BlobWriter(self)
+
+    @staticmethod
+    def link(source, destination):
+        """Create destination as a hardlink or reflink of source, falling back to a copy."""
+        if os.path.exists(destination):
+            return destination
+        try:
+            os.link(source, destination)
+            return destination
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP):
+                raise
+        try:
+            with open(source, "rb") as src, open(destination, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            shutil.copystat(source, destination)
+            return destination
+        except OSError:
+            if os.path.exists(destination):
+                os.remove(destination)
+        shutil.copy2(source, destination)
+        return destination
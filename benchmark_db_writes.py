@@ -0,0 +1,58 @@
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from db_email import Base, BatchWriter, Db, ImportedEmail
+
+
+def make_row(i):
+    return ImportedEmail(imap_account="benchmark@example.com", subject=f"Invoice {i}", sender="billing@example.com",
+                         date=datetime.now(), has_attachment=True, attachment_path=f"/tmp/{i}.pdf",
+                         body="Please find the invoice attached." * 20)
+
+
+def per_row_commits(database_url, rows):
+    # Previous behaviour: default SQLite settings and one commit per imported email
+    engine = create_engine(database_url)
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    started = time.perf_counter()
+    for i in range(rows):
+        session.add(make_row(i))
+        session.commit()
+    elapsed = time.perf_counter() - started
+    session.close()
+    engine.dispose()
+    return elapsed
+
+
+def batched_writes(database_url, rows, batch_size):
+    db = Db(database_url)
+    with db.get_session() as session:
+        writer = BatchWriter(session, batch_size=batch_size)
+        started = time.perf_counter()
+        for i in range(rows):
+            writer.add(make_row(i))
+        writer.flush()
+        elapsed = time.perf_counter() - started
+    db.engine.dispose()
+    return elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare per-row commits with batched writes of imported emails")
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        before = per_row_commits(f"sqlite:///{os.path.join(tmp_dir, 'before.db')}", args.rows)
+        after = batched_writes(f"sqlite:///{os.path.join(tmp_dir, 'after.db')}", args.rows, args.batch_size)
+
+    print(f"per-row commits: {args.rows / before:10.0f} rows/sec")
+    print(f"batched writes:  {args.rows / after:10.0f} rows/sec (batch size {args.batch_size}, WAL)")
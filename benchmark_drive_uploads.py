@@ -0,0 +1,70 @@
+import argparse
+import logging
+import os
+import tempfile
+import time
+from datetime import datetime
+
+from db_email import Db, ImportedEmail, STATE_ORGANIZED, STATE_UPLOADED
+from email_exporter import EmailOrganizer
+from fake_drive import FakeDriveClient
+
+
+def make_files(base_dir, files, size):
+    paths = []
+    for i in range(files):
+        organization_dir = os.path.join(base_dir, "2024", "October", f"Organization {i % 10}")
+        os.makedirs(organization_dir, exist_ok=True)
+        path = os.path.join(organization_dir, f"invoice_{i}.pdf")
+        with open(path, "wb") as file:
+            file.write(os.urandom(size))
+        paths.append(path)
+    return paths
+
+
+def upload(database_url, paths, args, workers):
+    db = Db(database_url)
+    with db.get_session() as session:
+        for i, path in enumerate(paths):
+            session.add(ImportedEmail(imap_account="benchmark@example.com", subject=f"Invoice {i}",
+                                      sender="billing@example.com", date=datetime.now(), has_attachment=True,
+                                      processed_path=path, uploaded=False, state=STATE_ORGANIZED))
+        session.commit()
+    client = FakeDriveClient(latency=args.latency, bandwidth=args.bandwidth * 1024 * 1024,
+                             failure_rate=args.failure_rate)
+    organizer = EmailOrganizer(database_url, os.path.dirname(paths[0]), drive_client=client,
+                               upload_workers=workers, upload_chunk_size_mb=args.chunk_size_mb,
+                               upload_max_retries=args.max_retries, upload_commit_every=args.commit_every)
+    organizer.uploader.backoff = 0.01
+    started = time.perf_counter()
+    organizer.organize_and_upload(batch_size=args.batch_size)
+    elapsed = time.perf_counter() - started
+    with db.get_new_session() as session:
+        uploaded = session.query(ImportedEmail).filter(ImportedEmail.state == STATE_UPLOADED).count()
+    db.engine.dispose()
+    return elapsed, uploaded, client.stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare sequential and parallel Drive uploads against a fake Drive")
+    parser.add_argument("--files", type=int, default=40)
+    parser.add_argument("--size-kb", type=int, default=2048)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--chunk-size-mb", type=float, default=0.5)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per Drive request")
+    parser.add_argument("--bandwidth", type=float, default=20, help="MB/s per connection")
+    parser.add_argument("--failure-rate", type=float, default=0.05, help="share of chunks that fail")
+    parser.add_argument("--max-retries", type=int, default=5)
+    parser.add_argument("--commit-every", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=50)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = make_files(os.path.join(tmp_dir, "organized"), args.files, args.size_kb * 1024)
+        for workers in (1, args.workers):
+            database_url = f"sqlite:///{os.path.join(tmp_dir, f'workers_{workers}.db')}"
+            elapsed, uploaded, stats = upload(database_url, paths, args, workers)
+            print(f"{workers:2d} workers: {uploaded / elapsed:8.1f} files/sec, "
+                  f"{stats['bytes'] / elapsed / 1024 / 1024:6.1f} MB/sec, {uploaded}/{args.files} uploaded, "
+                  f"{stats['requests']} requests, {stats['failures']} failed chunks resumed")
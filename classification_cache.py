@@ -0,0 +1,137 @@
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta
+from email.utils import parseaddr
+
+from db_email import ClassificationCacheEntry
+
+# Domains shared by unrelated senders, their results are only cached per address
+FREEMAIL_DOMAINS = frozenset((
+    "gmail.com", "googlemail.com", "outlook.com", "hotmail.com", "live.com", "msn.com", "yahoo.com", "icloud.com",
+    "me.com", "aol.com", "gmx.com", "gmx.net", "proton.me", "protonmail.com", "zoho.com", "seznam.cz",
+    "centrum.sk", "centrum.cz", "azet.sk", "post.sk", "zoznam.sk", "atlas.sk", "email.cz",
+))
+
+
+def get_cache_keys(sender, use_domains=True):
+    """Cache keys of a From header, most specific first: 'user@example.com' and '@example.com'.
+
+    The display name and a +tag are dropped, so 'Billing <Billing+2024@Example.com>' and 'billing@example.com'
+    share an entry and invoices@example.com falls back to the entry of the domain.
+    """
+    address = parseaddr(sender or "")[1].strip().lower()
+    if "@" not in address:
+        return [address] if address else []
+    local_part, domain = address.rsplit("@", 1)
+    keys = [f"{local_part.split('+', 1)[0]}@{domain}"]
+    if use_domains and domain not in FREEMAIL_DOMAINS:
+        keys.append(f"@{domain}")
+    return keys
+
+
+class MemoryCache:
+    """Thread-safe LRU dict whose entries expire ttl seconds after they were stored."""
+
+    def __init__(self, max_entries=1000, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, stored_at = entry
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class ClassificationCache:
+    """Classification results by sender address and domain, in memory and optionally in the database.
+
+    Lookups try the memory tier first and then the classification_cache table, so results survive restarts and
+    are shared by all workers. Entries expire after ttl_days and the least recently used are evicted above
+    max_entries.
+    """
+
+    def __init__(self, use_db=True, ttl_days=180, max_entries=10000, memory_entries=1000, use_domains=True):
+        self.use_db = use_db
+        self.ttl = timedelta(days=ttl_days) if ttl_days else None
+        self.max_entries = max_entries
+        self.use_domains = use_domains
+        self.memory = MemoryCache(memory_entries, self.ttl.total_seconds() if self.ttl else None)
+        self.stats = {'hits': 0, 'misses': 0, 'memory_hits': 0, 'db_hits': 0, 'domain_hits': 0}
+        # Hits are written to the table on evict, so memory hits also keep entries from being evicted
+        self.hits_by_key = Counter()
+
+    def get(self, session, sender, count_miss=True):
+        # A lookup that is repeated later for the same email passes count_miss=False, so it is counted once
+        keys = get_cache_keys(sender, self.use_domains)
+        result, key = self.lookup(session, keys)
+        if result is None:
+            if count_miss:
+                self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        self.hits_by_key[key] += 1
+        if key.startswith("@"):
+            self.stats['domain_hits'] += 1
+        return result
+
+    def peek(self, sender):
+        # The memory tier only, without counting, safe to call from threads that do not own the session
+        for key in get_cache_keys(sender, self.use_domains):
+            result = self.memory.get(key)
+            if result is not None:
+                return result
+        return None
+
+    def lookup(self, session, keys):
+        for key in keys:
+            result = self.memory.get(key)
+            if result is not None:
+                self.stats['memory_hits'] += 1
+                return result, key
+        if not self.use_db or not keys:
+            return None, None
+        created_after = datetime.now() - self.ttl if self.ttl else None
+        rows = ClassificationCacheEntry.get_by_keys(session, keys, created_after)
+        for key in keys:
+            row = rows.get(key)
+            if row is not None:
+                result = row.to_result()
+                self.memory.put(key, result)
+                self.stats['db_hits'] += 1
+                return result, key
+        return None, None
+
+    def put(self, session, sender, result):
+        for key in get_cache_keys(sender, self.use_domains):
+            self.memory.put(key, result)
+            if self.use_db:
+                ClassificationCacheEntry.save(session, key, result)
+
+    def evict(self, session):
+        if not self.use_db:
+            return 0
+        ClassificationCacheEntry.record_hits(session, self.hits_by_key)
+        self.hits_by_key.clear()
+        created_before = datetime.now() - self.ttl if self.ttl else datetime.min
+        return ClassificationCacheEntry.evict(session, created_before, self.max_entries)
+
+    def hit_rate(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / lookups if lookups else 0.0
@@ -0,0 +1,187 @@
+import asyncio
+import json
+import random
+import tempfile
+import time
+
+import openai
+
+
+class TokenBucket:
+    """Async token bucket refilled continuously at rate_per_minute, holding at most one minute of tokens."""
+
+    def __init__(self, rate_per_minute):
+        self.capacity = rate_per_minute
+        self.rate = rate_per_minute / 60
+        self.tokens = rate_per_minute
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+class ClassificationEngine:
+    """Runs chat completions concurrently on the async OpenAI client.
+
+    Concurrency is bounded, requests and tokens per minute are limited with token buckets and
+    429/5xx/connection errors are retried with exponential backoff.
+    """
+
+    def __init__(self, client_factory, model="gpt-4o-mini", max_tokens=100, concurrency=8, requests_per_minute=500,
+                 tokens_per_minute=200000, max_retries=5):
+        # The async client is bound to an event loop, so a new one is created for every run
+        self.client_factory = client_factory
+        self.model = model
+        self.max_tokens = max_tokens
+        self.concurrency = concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+
+    @staticmethod
+    def estimate_tokens(messages):
+        # About four characters per token, good enough for rate limiting
+        return sum(len(message["content"]) for message in messages) // 4 + 1
+
+    @staticmethod
+    def is_retryable(error):
+        if isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError)):
+            return True
+        return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+    @staticmethod
+    def get_retry_delay(error, attempt):
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return min(60, 2 ** attempt) + random.random()
+
+    async def classify(self, client, semaphore, requests, tokens, messages):
+        for attempt in range(self.max_retries + 1):
+            await requests.acquire()
+            await tokens.acquire(self.estimate_tokens(messages) + self.max_tokens)
+            try:
+                async with semaphore:
+                    response = await client.chat.completions.create(model=self.model, messages=messages,
+                                                                    max_tokens=self.max_tokens)
+                return response.choices[0].message.content
+            except Exception as e:
+                if not self.is_retryable(e) or attempt == self.max_retries:
+                    print(f"Error detecting organization and spam status: {e}")
+                    return None
+                delay = self.get_retry_delay(e, attempt)
+                print(f"Classification request failed ({e}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+        return None
+
+    def run(self, jobs, on_result):
+        """Classify (key, messages) jobs and call on_result(key, content) in the calling thread as they complete.
+
+        jobs may be a blocking generator, it is advanced in an executor so classification starts before it is
+        exhausted. Jobs with messages None are passed to on_result with content None without a request.
+        """
+        asyncio.run(self.run_async(jobs, on_result))
+
+    async def run_async(self, jobs, on_result):
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        requests = TokenBucket(self.requests_per_minute)
+        tokens = TokenBucket(self.tokens_per_minute)
+        iterator = iter(jobs)
+        client = self.client_factory()
+
+        async def classify_job(key, messages):
+            # Jobs without messages were classified by the caller and are only passed through
+            if messages is None:
+                on_result(key, None)
+                return
+            on_result(key, await self.classify(client, semaphore, requests, tokens, messages))
+
+        tasks = []
+        try:
+            while True:
+                job = await loop.run_in_executor(None, next, iterator, None)
+                if job is None:
+                    break
+                tasks.append(asyncio.create_task(classify_job(*job)))
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await client.close()
+
+
+class BatchClassifier:
+    """Classifies with the OpenAI Batch API, for backfills that need throughput and low cost rather than latency.
+
+    client only needs the files and batches resources of the OpenAI client, so an OpenAI client pointed to
+    fake_openai_server.py or any object with the same methods can be used instead.
+    """
+
+    # Statuses after which a batch does not change anymore
+    FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+    def __init__(self, client, model="gpt-4o-mini", max_tokens=100, poll_interval=60, max_requests=50000):
+        self.client = client
+        self.model = model
+        self.max_tokens = max_tokens
+        self.poll_interval = poll_interval
+        # The Batch API accepts at most 50,000 requests per batch
+        self.max_requests = max_requests
+
+    def submit(self, requests):
+        """Upload (custom_id, messages) requests as a JSONL file and create a batch.
+
+        Returns (batch, request count), or None when there were no requests.
+        """
+        request_count = 0
+        with tempfile.TemporaryFile() as requests_file:
+            for custom_id, messages in requests:
+                line = {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions",
+                        "body": {"model": self.model, "messages": messages, "max_tokens": self.max_tokens}}
+                requests_file.write(json.dumps(line).encode("utf-8") + b"\n")
+                request_count += 1
+            if not request_count:
+                return None
+            requests_file.seek(0)
+            input_file = self.client.files.create(file=("classification.jsonl", requests_file), purpose="batch")
+        batch = self.client.batches.create(input_file_id=input_file.id, endpoint="/v1/chat/completions",
+                                           completion_window="24h")
+        print(f"Submitted classification batch {batch.id} with {request_count} requests")
+        return batch, request_count
+
+    def wait(self, batch_id):
+        while True:
+            batch = self.client.batches.retrieve(batch_id)
+            if batch.status in self.FINAL_STATUSES:
+                print(f"Classification batch {batch_id} {batch.status}")
+                return batch
+            time.sleep(self.poll_interval)
+
+    def get_results(self, batch):
+        """Yield (custom_id, content) of the successful requests, expired batches still have partial results."""
+        if not batch.output_file_id:
+            return
+        for line in self.client.files.content(batch.output_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            response = result.get("response") or {}
+            if result.get("error") or response.get("status_code") != 200:
+                print(f"Classification request {result.get('custom_id')} failed: {result.get('error') or response}")
+                continue
+            yield result["custom_id"], response["body"]["choices"][0]["message"]["content"]
@@ -1,13 +1,44 @@
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, Text
+import time
+from datetime import datetime
+
+from sqlalchemy import create_engine, event, inspect, text, and_, case, Column, Integer, String, Boolean, DateTime, \
+    Float, Text, UniqueConstraint, Index
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from contextlib import contextmanager
 
 Base = declarative_base()
 
+# Processing states of an imported email, every stage picks up the emails in the state of the previous one
+STATE_IMPORTED = 'imported'
+STATE_TEXT_EXTRACTED = 'text_extracted'
+STATE_CLASSIFIED = 'classified'
+STATE_ORGANIZED = 'organized'
+STATE_UPLOADED = 'uploaded'
+# Emails without a PDF attachment, no stage works on them
+STATE_SKIPPED = 'skipped'
+# Emails whose attachment yielded no text in pdf_max_attempts extractions, they are not extracted again
+STATE_EXTRACTION_FAILED = 'extraction_failed'
+
+# Status of a job started through the API
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+
 class ImportedEmail(Base):
     __tablename__ = 'imported_emails'
+    __table_args__ = (
+        Index('ix_imported_emails_account_header_hash', 'imap_account', 'header_hash', unique=True),
+        Index('ix_imported_emails_message_id', 'message_id'),
+        Index('ix_imported_emails_account_date', 'imap_account', 'date'),
+        Index('ix_imported_emails_attachment_hash', 'attachment_hash'),
+        Index('ix_imported_emails_state_id', 'state', 'id'),
+        Index('ix_imported_emails_state_processed_path', 'state', 'processed_path'),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     imap_account = Column(String, nullable=False)
@@ -30,6 +61,15 @@ class ImportedEmail(Base):
     is_invoice = Column(Boolean, default=False)
     processed_path = Column(String, nullable=True)
     uploaded = Column(Boolean, default=False)
+    message_id = Column(String, nullable=True)
+    # SHA-256 of the normalized identifying headers, used to skip emails that were already imported
+    header_hash = Column(String(64), nullable=True)
+    # SHA-256 of the PDF attachment, attachment_path points to its blob in the AttachmentStore
+    attachment_hash = Column(String(64), nullable=True)
+    attachment_name = Column(String, nullable=True)
+    state = Column(String(20), nullable=True, default=STATE_IMPORTED)
+    # Token count of the classification prompt, for tuning the prompt budget
+    prompt_tokens = Column(Integer, nullable=True)
 
     @classmethod
     def save_to_database(cls, session, **kwargs):
@@ -49,6 +89,90 @@ class ImportedEmail(Base):
             session.rollback()
             raise e
 
+    @classmethod
+    def get_batch_by_state(cls, session, states, after_id=0, limit=100):
+        # Keyset pagination on (state, id), the cost of a page does not grow with the table
+        try:
+            return session.query(cls).filter(cls.state.in_(states), cls.id > after_id) \
+                .order_by(cls.id).limit(limit).all()
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise e
+
+    @classmethod
+    def count_by_state(cls, session, states):
+        try:
+            return session.query(cls).filter(cls.state.in_(states)).count()
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise e
+
+    @classmethod
+    def backfill_state(cls, connection):
+        # Derive the state of rows imported before the state column existed from the older columns
+        table = cls.__table__
+        has_pdf = and_(table.c.has_attachment == True, table.c.attachment_path.like('%.pdf'))
+        connection.execute(table.update().where(table.c.state == None).values(state=case(
+            (table.c.uploaded == True, STATE_UPLOADED),
+            (table.c.processed_path != None, STATE_ORGANIZED),
+            (and_(has_pdf, table.c.sender_organisation != None), STATE_CLASSIFIED),
+            (has_pdf, STATE_IMPORTED),
+            else_=STATE_SKIPPED)))
+
+    @classmethod
+    def get_existing_header_hashes(cls, session, imap_account, header_hashes):
+        try:
+            if not header_hashes:
+                return set()
+            rows = session.query(cls.header_hash).filter(cls.imap_account == imap_account,
+                                                         cls.header_hash.in_(list(header_hashes))).all()
+            return {row.header_hash for row in rows}
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise e
+
+    @classmethod
+    def has_legacy_rows(cls, session, imap_account):
+        # Rows imported before header_hash was stored
+        try:
+            return session.query(cls.id).filter(cls.imap_account == imap_account, cls.header_hash == None) \
+                .first() is not None
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise e
+
+    @classmethod
+    def claim_legacy_rows(cls, session, imap_account, identities):
+        """Sets header_hash on rows imported before it was stored, returns the header hashes that were set.
+
+        The hashed headers were not stored, so the hash of such a row can not be computed when migrating. The row
+        gets it when its email is seen again: identities maps header hashes to (sender, subject, date) of emails
+        not found by their hash, and a legacy row with the same sender, subject and date is taken for the email.
+        """
+        try:
+            if not identities:
+                return set()
+            rows = session.query(cls).filter(cls.imap_account == imap_account, cls.header_hash == None,
+                                             cls.date.in_({date for _, _, date in identities.values()})).all()
+            rows_by_identity = {}
+            for row in rows:
+                rows_by_identity.setdefault((row.sender, row.subject, row.date), row)
+            claimed = set()
+            for header_hash, identity in identities.items():
+                row = rows_by_identity.pop(identity, None)
+                if row is not None:
+                    row.header_hash = header_hash
+                    claimed.add(header_hash)
+            session.commit()
+            return claimed
+        except IntegrityError:
+            # The import of another mailbox of the account claimed or imported the same email first
+            session.rollback()
+            return cls.get_existing_header_hashes(session, imap_account, identities)
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise e
+
     @classmethod
     def get_all(cls, session):
         try:
@@ -99,15 +223,486 @@ class ImportedEmail(Base):
             raise e
 
 
+class MailboxSyncState(Base):
+    __tablename__ = 'mailbox_sync_state'
+    __table_args__ = (UniqueConstraint('imap_account', 'mailbox', name='uq_mailbox_sync_state_account_mailbox'),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    imap_account = Column(String, nullable=False)
+    mailbox = Column(String, nullable=False)
+    uid_validity = Column(Integer, nullable=True)
+    last_uid = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=True)
+
+    @classmethod
+    def get_or_create(cls, session, imap_account, mailbox):
+        try:
+            state = session.query(cls).filter(cls.imap_account == imap_account, cls.mailbox == mailbox).first()
+            if state is None:
+                state = cls(imap_account=imap_account, mailbox=mailbox, uid_validity=None, last_uid=0)
+                session.add(state)
+                session.commit()
+            return state
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise e
+
+    def reset(self, uid_validity):
+        self.uid_validity = uid_validity
+        self.last_uid = 0
+        self.updated_at = datetime.now()
+
+    def advance(self, uid):
+        if uid > self.last_uid:
+            self.last_uid = uid
+            self.updated_at = datetime.now()
+
+
+class ExtractedText(Base):
+    __tablename__ = 'extracted_texts'
+    __table_args__ = (
+        Index('ix_extracted_texts_hash_password', 'attachment_hash', 'password_index', unique=True),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    attachment_hash = Column(String(64), nullable=False)
+    # Index into pdf_passwords of the password that decrypted the PDF, the password itself is not stored
+    password_index = Column(Integer, nullable=True)
+    encrypted = Column(Boolean, default=False)
+    page_count = Column(Integer, nullable=True)
+    pages_read = Column(Integer, nullable=True)
+    text = Column(Text, nullable=True)
+    extraction_time = Column(Float, nullable=True)
+    created_at = Column(DateTime, nullable=True)
+    # Why the last extraction returned no text and how often the attachment was extracted
+    error = Column(Text, nullable=True)
+    attempts = Column(Integer, default=0)
+
+    @classmethod
+    def get_by_hashes(cls, session, attachment_hashes):
+        try:
+            if not attachment_hashes:
+                return {}
+            rows = session.query(cls).filter(cls.attachment_hash.in_(list(attachment_hashes))).all()
+            # A row with text wins over a failed extraction with another password
+            rows_by_hash = {}
+            for row in rows:
+                if row.text or row.attachment_hash not in rows_by_hash:
+                    rows_by_hash[row.attachment_hash] = row
+            return rows_by_hash
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise e
+
+    @classmethod
+    def save(cls, session, attachment_hash, extraction):
+        try:
+            row = session.query(cls).filter(cls.attachment_hash == attachment_hash,
+                                            cls.password_index == extraction['password_index']).first()
+            if row is None:
+                row = cls(attachment_hash=attachment_hash, password_index=extraction['password_index'])
+            row.encrypted = extraction['encrypted']
+            row.page_count = extraction['page_count']
+            row.pages_read = extraction['pages_read']
+            row.text = extraction['text']
+            row.extraction_time = extraction['extraction_time']
+            row.error = extraction.get('error')
+            row.attempts = (row.attempts or 0) + 1
+            row.created_at = datetime.now()
+            session.add(row)
+            return row
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise e
+
+    def covers(self, max_chars=None, max_pages=None):
+        # Text extracted with a smaller budget than requested can not be reused
+        if self.pages_read == self.page_count:
+            return True
+        if max_chars is not None and len(self.text or "") >= max_chars:
+            return True
+        return max_pages is not None and self.pages_read >= max_pages
+
+    def to_extraction(self):
+        return {'text': self.text or "", 'pages_read': self.pages_read, 'page_count': self.page_count,
+                'encrypted': self.encrypted, 'password_index': self.password_index,
+                'extraction_time': self.extraction_time, 'error': self.error}
+
+
+class ClassificationBatch(Base):
+    """An OpenAI batch job of classification requests, kept until its results were applied."""
+    __tablename__ = 'classification_batches'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    batch_id = Column(String, nullable=False, unique=True)
+    status = Column(String, nullable=True)
+    request_count = Column(Integer, nullable=True)
+    applied = Column(Boolean, default=False)
+    created_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, nullable=True)
+
+    @classmethod
+    def create(cls, session, batch_id, status, request_count):
+        try:
+            row = cls(batch_id=batch_id, status=status, request_count=request_count, applied=False,
+                      created_at=datetime.now(), updated_at=datetime.now())
+            session.add(row)
+            return row
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise e
+
+    @classmethod
+    def get_unapplied(cls, session):
+        try:
+            return session.query(cls).filter(cls.applied == False).order_by(cls.id).all()
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise e
+
+    def mark_applied(self, status):
+        self.status = status
+        self.applied = True
+        self.updated_at = datetime.now()
+
+
+class ClassificationCacheEntry(Base):
+    """Classification of a sender, keyed by its normalized address or by its domain prefixed with '@'."""
+    __tablename__ = 'classification_cache'
+    __table_args__ = (
+        Index('ix_classification_cache_last_used_at', 'last_used_at'),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    cache_key = Column(String, nullable=False, unique=True)
+    organization = Column(String, nullable=True)
+    is_spam = Column(Boolean, default=False)
+    is_invoice = Column(Boolean, default=False)
+    hit_count = Column(Integer, default=0)
+    created_at = Column(DateTime, nullable=True)
+    last_used_at = Column(DateTime, nullable=True)
+
+    @classmethod
+    def get_by_keys(cls, session, cache_keys, created_after=None):
+        try:
+            query = session.query(cls).filter(cls.cache_key.in_(list(cache_keys)))
+            if created_after is not None:
+                query = query.filter(cls.created_at >= created_after)
+            return {row.cache_key: row for row in query.all()}
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise e
+
+    @classmethod
+    def save(cls, session, cache_key, result):
+        # An upsert, workers storing the same key at the same time must not fail on the unique cache_key
+        try:
+            now = datetime.now()
+            values = {'organization': result['organization'], 'is_spam': result['is_spam'],
+                      'is_invoice': result['is_invoice'], 'created_at': now, 'last_used_at': now}
+            insert = postgresql.insert if session.get_bind().dialect.name == "postgresql" else sqlite.insert
+            statement = insert(cls).values(cache_key=cache_key, hit_count=0, **values)
+            session.execute(statement.on_conflict_do_update(index_elements=[cls.cache_key], set_=values))
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise e
+
+    @classmethod
+    def record_hits(cls, session, hits_by_key):
+        try:
+            now = datetime.now()
+            for cache_key, hits in hits_by_key.items():
+                session.query(cls).filter(cls.cache_key == cache_key).update(
+                    {cls.hit_count: cls.hit_count + hits, cls.last_used_at: now}, synchronize_session=False)
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise e
+
+    @classmethod
+    def evict(cls, session, created_before, max_entries):
+        # Expired entries are removed, then the least recently used ones above max_entries
+        try:
+            removed = session.query(cls).filter(cls.created_at < created_before).delete(synchronize_session=False)
+            if max_entries is not None:
+                keep = session.query(cls.id).order_by(cls.last_used_at.desc()).limit(max_entries)
+                removed += session.query(cls).filter(cls.id.notin_(keep.scalar_subquery())) \
+                    .delete(synchronize_session=False)
+            return removed
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise e
+
+    def to_result(self):
+        return {'organization': self.organization, 'is_spam': self.is_spam, 'is_invoice': self.is_invoice}
+
+
+class ClassificationStat(Base):
+    """Counter of the classification cache or matcher, summed over all runs and processes."""
+    __tablename__ = 'classification_stats'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(String, nullable=False, unique=True)
+    value = Column(Integer, default=0)
+    updated_at = Column(DateTime, nullable=True)
+
+    @classmethod
+    def get_all(cls, session):
+        try:
+            return {row.name: row.value for row in session.query(cls).all()}
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise e
+
+    @classmethod
+    def add(cls, session, counts):
+        # Adds the counts to the stored values in one upsert per counter, so processes can add at the same time
+        try:
+            now = datetime.now()
+            insert = postgresql.insert if session.get_bind().dialect.name == "postgresql" else sqlite.insert
+            for name, count in counts.items():
+                if not count:
+                    continue
+                statement = insert(cls).values(name=name, value=count, updated_at=now)
+                session.execute(statement.on_conflict_do_update(
+                    index_elements=[cls.name], set_={'value': cls.value + statement.excluded.value, 'updated_at': now}))
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise e
+
+
+class DriveFolder(Base):
+    """Google Drive folder id of a folder path below an upload root folder."""
+    __tablename__ = 'drive_folders'
+    __table_args__ = (UniqueConstraint('root_folder_id', 'path', name='uq_drive_folders_root_path'),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    root_folder_id = Column(String, nullable=False)
+    path = Column(String, nullable=False)
+    folder_id = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=True)
+
+    @classmethod
+    def get_all(cls, session, root_folder_id):
+        try:
+            rows = session.query(cls.path, cls.folder_id).filter(cls.root_folder_id == root_folder_id).all()
+            return {row.path: row.folder_id for row in rows}
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise e
+
+    @classmethod
+    def get_folder_id(cls, session, root_folder_id, path):
+        try:
+            row = session.query(cls.folder_id).filter(cls.root_folder_id == root_folder_id, cls.path == path).first()
+            return row.folder_id if row else None
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise e
+
+    @classmethod
+    def save(cls, session, root_folder_id, path, folder_id):
+        # Returns the folder id stored for the path, another worker may have stored its folder first
+        try:
+            session.add(cls(root_folder_id=root_folder_id, path=path, folder_id=folder_id, created_at=datetime.now()))
+            session.commit()
+            return folder_id
+        except IntegrityError:
+            session.rollback()
+            return cls.get_folder_id(session, root_folder_id, path)
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise e
+
+    @classmethod
+    def delete_tree(cls, session, root_folder_id, path):
+        try:
+            session.query(cls).filter(cls.root_folder_id == root_folder_id,
+                                      (cls.path == path) | cls.path.startswith(path + "/", autoescape=True)) \
+                .delete(synchronize_session=False)
+            session.commit()
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise e
+
+
+class Job(Base):
+    """A long-running job started through the API, shared by all API workers through the database."""
+    __tablename__ = 'jobs'
+
+    id = Column(String(36), primary_key=True)
+    kind = Column(String(40), nullable=False)
+    params = Column(Text, nullable=True)  # JSON
+    # Set while the job is queued or running, only one job per key can be active
+    active_key = Column(String, nullable=True, unique=True)
+    status = Column(String(20), nullable=False, default=JOB_QUEUED)
+    processed = Column(Integer, default=0)
+    total = Column(Integer, nullable=True)
+    message = Column(Text, nullable=True)
+    cancel_requested = Column(Boolean, default=False)
+    created_at = Column(DateTime, nullable=True)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, nullable=True)
+
+    @classmethod
+    def create(cls, session, job_id, kind, key, params):
+        # Returns the new job, or None when a job with the same key is already active
+        try:
+            now = datetime.now()
+            job = cls(id=job_id, kind=kind, params=params, active_key=key, status=JOB_QUEUED, processed=0,
+                      cancel_requested=False, created_at=now, updated_at=now)
+            session.add(job)
+            session.commit()
+            return job
+        except IntegrityError:
+            session.rollback()
+            return None
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise e
+
+    @classmethod
+    def get(cls, session, job_id):
+        try:
+            return session.query(cls).filter(cls.id == job_id).first()
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise e
+
+    @classmethod
+    def get_active(cls, session, key):
+        try:
+            return session.query(cls).filter(cls.active_key == key).first()
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise e
+
+    @classmethod
+    def touch(cls, session, job_ids):
+        # Running jobs are marked alive, a job that is not updated for a while is considered abandoned
+        try:
+            if job_ids:
+                session.query(cls).filter(cls.id.in_(job_ids), cls.active_key != None) \
+                    .update({cls.updated_at: datetime.now()}, synchronize_session=False)
+                session.commit()
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise e
+
+    def start(self):
+        self.status = JOB_RUNNING
+        self.started_at = self.updated_at = datetime.now()
+
+    def finish(self, status, message=None):
+        self.status = status
+        self.message = message
+        self.active_key = None
+        self.finished_at = self.updated_at = datetime.now()
+
+
+class BatchWriter:
+    """Buffers new rows and inserts them with one commit per batch instead of one per row."""
+
+    def __init__(self, session, batch_size=100, flush_interval_ms=1000):
+        self.session = session
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval_ms / 1000
+        self.rows = []
+        # Optional key of every buffered row (e.g. the UID of the email), failed_keys holds those of rows not saved
+        self.keys = []
+        self.failed_keys = set()
+        self.first_row_at = None
+        self.written = 0
+        self.failed = 0
+
+    def add(self, row, key=None):
+        if not self.rows:
+            self.first_row_at = time.monotonic()
+        self.rows.append(row)
+        self.keys.append(key)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        if self.rows and time.monotonic() - self.first_row_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        rows, self.rows = self.rows, []
+        keys, self.keys = self.keys, []
+        try:
+            self.session.add_all(rows)
+            self.session.commit()
+            self.written += len(rows)
+        except SQLAlchemyError as e:
+            self.session.rollback()
+            print(f"Batch insert of {len(rows)} rows failed, retrying row by row: {e}")
+            # Insert the rows one by one so a single bad row does not lose the whole batch
+            for row, key in zip(rows, keys):
+                try:
+                    self.session.add(row)
+                    self.session.commit()
+                    self.written += 1
+                except SQLAlchemyError as e:
+                    self.session.rollback()
+                    self.failed += 1
+                    if key is not None:
+                        self.failed_keys.add(key)
+                    print(f"Database error while saving {row}: {e}")
+
+
 class Db:
     def __init__(self, database_url='sqlite:///emails.db'):
         self.engine = create_engine(database_url)
+        if self.engine.dialect.name == "sqlite":
+            event.listen(self.engine, "connect", self.configure_sqlite)
         Base.metadata.create_all(self.engine)
+        self.migrate()
         self.Session = scoped_session(sessionmaker(bind=self.engine))
 
+    def migrate(self):
+        # create_all only creates missing tables, columns and indexes added later to existing tables are created here
+        inspector = inspect(self.engine)
+        for table in Base.metadata.sorted_tables:
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            missing_columns = [column for column in table.columns if column.name not in existing_columns]
+            if missing_columns:
+                with self.engine.begin() as connection:
+                    for column in missing_columns:
+                        column_type = column.type.compile(dialect=self.engine.dialect)
+                        connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                    if table is ImportedEmail.__table__ and "state" in {column.name for column in missing_columns}:
+                        ImportedEmail.backfill_state(connection)
+            for index in table.indexes:
+                index.create(self.engine, checkfirst=True)
+
+    @staticmethod
+    def configure_sqlite(dbapi_connection, connection_record):
+        # WAL lets readers work during imports and NORMAL sync only fsyncs at checkpoints
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA busy_timeout=30000")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA cache_size=-65536")
+        cursor.close()
+
     @contextmanager
     def get_session(self):
         session = self.Session()
+        try:
+            yield session
+        finally:
+            session.close()
+
+    @contextmanager
+    def get_new_session(self):
+        # Independent of the thread-local scoped session, so it can be used while get_session() is open
+        session = self.Session.session_factory()
         try:
             yield session
         finally:
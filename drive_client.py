@@ -0,0 +1,118 @@
+import json
+import threading
+
+import httplib2
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaFileUpload
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+# Reasons of a 403 answer that only ask to slow down, the request is retried
+RATE_LIMIT_REASONS = frozenset(('ratelimitexceeded', 'userratelimitexceeded'))
+
+
+class DriveNotFoundError(Exception):
+    """The file or a parent folder does not exist (anymore)."""
+
+
+class TransientDriveError(Exception):
+    """A request failed in a way that can be retried, an interrupted upload resumes where it stopped."""
+
+
+class DriveClient:
+    """The Google Drive operations used for uploads, implemented by GoogleDriveClient and FakeDriveClient."""
+
+    def find_folder(self, name, parent_id):
+        """Returns the id of the folder with this name in the parent folder, or None."""
+        raise NotImplementedError
+
+    def create_folder(self, name, parent_id):
+        """Creates a folder and returns its id."""
+        raise NotImplementedError
+
+    def trash(self, file_id):
+        raise NotImplementedError
+
+    def start_upload(self, local_path, title, parent_id, chunk_size):
+        """Returns a resumable upload to pass to upload_chunk."""
+        raise NotImplementedError
+
+    def upload_chunk(self, upload):
+        """Sends the next chunk, returns the file id once the upload is complete and None before.
+
+        After a TransientDriveError the next call continues from the last byte the server received.
+        """
+        raise NotImplementedError
+
+
+class GoogleDriveClient(DriveClient):
+    """Drive v2 API client of an authorized pydrive GoogleAuth, safe to use from several threads."""
+
+    def __init__(self, gauth):
+        self.gauth = gauth
+        self.local = threading.local()
+
+    def get_http(self):
+        # httplib2 is not thread-safe, every thread uses its own authorized connection
+        if not hasattr(self.local, 'http'):
+            self.local.http = self.gauth.Get_Http_Object()
+        return self.local.http
+
+    @staticmethod
+    def get_error_reasons(error):
+        # Lower-cased reasons of the errors in the JSON body of an HttpError, e.g. userratelimitexceeded
+        try:
+            content = json.loads(error.content or b'{}')
+            return {str(item.get('reason', '')).lower() for item in content['error']['errors']}
+        except (ValueError, TypeError, KeyError, AttributeError):
+            return set()
+
+    @classmethod
+    def translate_error(cls, error):
+        status = error.resp.status
+        if status == 404:
+            return DriveNotFoundError(str(error))
+        if status in (408, 429) or status >= 500:
+            return TransientDriveError(str(error))
+        if status == 403 and cls.get_error_reasons(error) & RATE_LIMIT_REASONS:
+            return TransientDriveError(str(error))
+        return error
+
+    def execute(self, request):
+        try:
+            return request.execute(http=self.get_http())
+        except HttpError as e:
+            raise self.translate_error(e) from e
+        except (OSError, httplib2.HttpLib2Error) as e:
+            raise TransientDriveError(str(e)) from e
+
+    def find_folder(self, name, parent_id):
+        escaped_name = name.replace("\\", "\\\\").replace("'", "\\'")
+        query = ("title = '%s' and '%s' in parents and mimeType = '%s' and trashed=false"
+                 % (escaped_name, parent_id or 'root', FOLDER_MIME_TYPE))
+        items = self.execute(self.gauth.service.files().list(q=query, maxResults=1)).get('items', [])
+        return items[0]['id'] if items else None
+
+    def create_folder(self, name, parent_id):
+        body = {'title': name, 'mimeType': FOLDER_MIME_TYPE}
+        if parent_id:
+            body['parents'] = [{'id': parent_id}]
+        return self.execute(self.gauth.service.files().insert(body=body))['id']
+
+    def trash(self, file_id):
+        self.execute(self.gauth.service.files().trash(fileId=file_id))
+
+    def start_upload(self, local_path, title, parent_id, chunk_size):
+        body = {'title': title}
+        if parent_id:
+            body['parents'] = [{'id': parent_id}]
+        media = MediaFileUpload(local_path, mimetype='application/pdf', chunksize=chunk_size, resumable=True)
+        return self.gauth.service.files().insert(body=body, media_body=media)
+
+    def upload_chunk(self, upload):
+        try:
+            status, response = upload.next_chunk(http=self.get_http())
+        except HttpError as e:
+            raise self.translate_error(e) from e
+        except (OSError, httplib2.HttpLib2Error) as e:
+            raise TransientDriveError(str(e)) from e
+        return response['id'] if response else None
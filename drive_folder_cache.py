@@ -0,0 +1,62 @@
+import threading
+
+from db_email import DriveFolder
+
+
+class DriveFolderCache:
+    """Drive folder ids by folder path ('2024/October/Acme') below a root folder.
+
+    The ids are kept in the drive_folders table, so they survive restarts and are shared by all workers, and in
+    memory, so a known folder needs no query at all. The table is read once on first use.
+    """
+
+    def __init__(self, db, root_folder_id):
+        self.db = db
+        self.root_folder_id = root_folder_id or 'root'
+        self.folders = None
+        # One lock per path, held while the missing folder is looked up or created so this process does not create it
+        # twice, folders at other paths are created meanwhile
+        self.path_locks = {}
+        # Guards self.folders and self.path_locks
+        self.lock = threading.RLock()
+
+    def warm(self):
+        with self.lock:
+            if self.folders is None:
+                with self.db.get_new_session() as session:
+                    self.folders = DriveFolder.get_all(session, self.root_folder_id)
+
+    def get(self, path):
+        self.warm()
+        with self.lock:
+            folder_id = self.folders.get(path)
+        if folder_id is None:
+            # Another worker may have created the folder since the table was read
+            with self.db.get_new_session() as session:
+                folder_id = DriveFolder.get_folder_id(session, self.root_folder_id, path)
+            if folder_id is not None:
+                with self.lock:
+                    self.folders[path] = folder_id
+        return folder_id
+
+    def path_lock(self, path):
+        with self.lock:
+            return self.path_locks.setdefault(path, threading.Lock())
+
+    def put(self, path, folder_id):
+        """Store the folder id of a path, returns the id of the folder stored first when another worker won."""
+        self.warm()
+        with self.db.get_new_session() as session:
+            folder_id = DriveFolder.save(session, self.root_folder_id, path, folder_id)
+        with self.lock:
+            self.folders[path] = folder_id
+        return folder_id
+
+    def invalidate(self, path):
+        # Forget a folder that no longer exists in Drive and all folders below it
+        self.warm()
+        with self.lock:
+            for cached_path in [cached for cached in self.folders if cached == path or cached.startswith(path + "/")]:
+                del self.folders[cached_path]
+        with self.db.get_new_session() as session:
+            DriveFolder.delete_tree(session, self.root_folder_id, path)
@@ -0,0 +1,43 @@
+import logging
+import random
+import time
+
+from drive_client import TransientDriveError
+
+
+class DriveUploader:
+    """Uploads files in chunks with resumable uploads, retrying transient failures with exponential backoff.
+
+    A failed chunk is resumed from the last byte Drive received instead of starting the file over.
+    """
+
+    def __init__(self, client, chunk_size=8 * 1024 * 1024, max_retries=5, backoff=1.0):
+        self.client = client
+        # Resumable uploads need chunks in multiples of 256 KB
+        self.chunk_size = max(256 * 1024, chunk_size // (256 * 1024) * 256 * 1024)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.logger = logging.getLogger(__name__)
+
+    def get_retry_delay(self, attempt):
+        return min(60, self.backoff * 2 ** attempt) * (0.5 + random.random())
+
+    def retry(self, function, *args):
+        # Calls function until it succeeds, at most max_retries times again after a transient failure
+        for attempt in range(self.max_retries + 1):
+            try:
+                return function(*args)
+            except TransientDriveError as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.get_retry_delay(attempt)
+                self.logger.warning("Drive request failed (%s), retrying in %.1fs", e, delay)
+                time.sleep(delay)
+
+    def upload(self, local_path, title, parent_id):
+        """Upload a file and return its Drive id, every chunk is retried max_retries times."""
+        upload = self.client.start_upload(local_path, title, parent_id, self.chunk_size)
+        while True:
+            file_id = self.retry(self.client.upload_chunk, upload)
+            if file_id:
+                return file_id
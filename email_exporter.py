@@ -1,67 +1,192 @@
 import logging
 import os
-import shutil
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
 from pydrive.auth import GoogleAuth
-from pydrive.drive import GoogleDrive
 from sqlalchemy import and_
 
-from db_email import ImportedEmail, Db
+from attachment_store import AttachmentStore
+from db_email import ImportedEmail, Db, STATE_CLASSIFIED, STATE_ORGANIZED, STATE_UPLOADED
+from drive_client import DriveNotFoundError, GoogleDriveClient
+from drive_folder_cache import DriveFolderCache
+from drive_uploader import DriveUploader
+from pdf_processor import PDFProcessor
+
+# Characters kept in file and folder names taken from emails, others are replaced with '_'
+UNSAFE_NAME_CHARACTERS = re.compile(r"[^\w .,&()+'-]")
+
+
+def safe_name(name, default):
+    # Attachment names and organizations come from the email, they must not add path components
+    name = UNSAFE_NAME_CHARACTERS.sub("_", os.path.basename((name or "").replace("\\", "/"))).strip().lstrip(".")
+    return name[:150] or default
 
 
 class EmailOrganizer:
     def __init__(self, db_url='sqlite:///emails.db', base_dir='organized_emails', root_folder_id=None,
-                 settings_file='settings.yaml'):
+                 settings_file='settings.yaml', drive_client=None, upload_workers=4, upload_chunk_size_mb=8,
+                 upload_max_retries=5, upload_commit_every=20):
         self.base_dir = base_dir
         self.root_folder_id = root_folder_id  # Google Drive root folder ID
         self.db = Db(db_url)
-        self.gauth = GoogleAuth(settings_file=settings_file)
-        self.gauth.LocalWebserverAuth()  # Authenticate user
-        self.drive = GoogleDrive(self.gauth)
+        if drive_client is None:
+            self.gauth = GoogleAuth(settings_file=settings_file)
+            self.gauth.LocalWebserverAuth()  # Authenticate user
+            drive_client = GoogleDriveClient(self.gauth)
+        self.drive_client = drive_client
+        # Files are uploaded by upload_workers threads in resumable chunks, failed chunks are retried with backoff
+        self.uploader = DriveUploader(drive_client, chunk_size=int(upload_chunk_size_mb * 1024 * 1024),
+                                      max_retries=upload_max_retries)
+        self.upload_workers = max(1, upload_workers)
+        self.upload_commit_every = max(1, upload_commit_every)
+        # Drive folder ids by path per root folder, a folder is looked up or created only the first time it is used
+        self.folder_caches = {}
+        self.folder_caches_lock = threading.Lock()
+        # Id of the last email visited by a categorize_emails call with a limit, the next call continues after it
+        self.categorize_after_id = 0
         logging.basicConfig(level=logging.INFO)
         self.logger = logging.getLogger(__name__)
         self.logger.info("EmailOrganizer initialized with base directory: %s and root folder ID: %s", self.base_dir,
                          self.root_folder_id)
 
-    def get_emails(self):
-        # Retrieve emails with attachments that have not been processed yet
+    def get_emails(self, batch_size=10, after_id=0):
+        # Retrieve the page of classified emails that have not been organized yet after the email after_id
         with self.db.Session() as session:
-            emails = session.query(ImportedEmail).filter(
-                and_(ImportedEmail.has_attachment == True, ImportedEmail.attachment_path.like('%.pdf'),
-                     ImportedEmail.sender_organisation != None, ImportedEmail.processed_path == None)
-            ).all()
+            emails = ImportedEmail.get_batch_by_state(session, [STATE_CLASSIFIED], after_id, batch_size)
             self.logger.info("Retrieved %d emails with attachments to process", len(emails))
             return emails
 
-    def categorize_emails(self, batch_size=10):
-        # Get a limited number of emails to process
-        emails = self.get_emails()[:batch_size]
+    def get_organized_by_hash(self, session, attachment_hashes):
+        # Attachments that were already organized for another email share its copy and upload
+        if not attachment_hashes:
+            return {}
+        emails = session.query(ImportedEmail).filter(
+            and_(ImportedEmail.attachment_hash.in_(list(attachment_hashes)), ImportedEmail.processed_path != None)
+        ).all()
+        return {email.attachment_hash: email for email in emails if os.path.exists(email.processed_path)}
+
+    def categorize_emails(self, batch_size=10, limit=None):
+        # Organize classified emails page by page, returns the number of emails visited. Without a limit all of
+        # them are visited. With a limit a call visits at most limit emails and the next call continues after
+        # the last one, starting over once it reached the end, so emails that cannot be organized do not block
+        # the ones behind them and the cost of a call does not grow with the backlog.
+        visited = 0
+        after_id = self.categorize_after_id if limit else 0
+        wrapped = after_id == 0
+        while limit is None or visited < limit:
+            page_size = batch_size if limit is None else min(batch_size, limit - visited)
+            emails = self.get_emails(page_size, after_id)
+            if not emails:
+                after_id = 0
+                if wrapped:
+                    break
+                wrapped = True
+                continue
+            after_id = emails[-1].id
+            self.categorize_page(emails)
+            visited += len(emails)
+        if limit:
+            self.categorize_after_id = after_id
+        return visited
+
+    def categorize_page(self, emails):
         self.logger.info("Categorizing %d emails", len(emails))
         with self.db.Session() as session:
+            organized_by_hash = self.get_organized_by_hash(
+                session, {email.attachment_hash for email in emails if email.attachment_hash})
             for email in emails:
-                # Use the email date or current date if none is available
-                email_date = email.date or datetime.now()
-                organization = email.sender_organisation or 'Unknown'  # Default to 'Unknown' if no organization is found
-                month_name = email_date.strftime('%B')  # Get the month name from the email date
-                year = email_date.year  # Get the year from the email date
-
-                # Create directory structure path/to/dir/2024/October/{Organization}/
-                organization_dir = os.path.join(self.base_dir, str(year), month_name, organization)
-                os.makedirs(organization_dir, exist_ok=True)  # Create the directory if it doesn't exist
-                self.logger.info("Created directory: %s", organization_dir)
-
-                # Copy the PDF attachment to the appropriate directory
-                if email.attachment_path and os.path.exists(email.attachment_path):
-                    destination_path = os.path.join(organization_dir, os.path.basename(email.attachment_path))
-                    shutil.copy2(email.attachment_path, destination_path)  # Copy the file to the destination
-                    email.processed_path = destination_path  # Update the processed path in the database
-                    email.uploaded = False  # Mark as not yet uploaded
-                    session.add(email)  # Add the email record to the session
-                    self.logger.info("Copied %s to %s", email.attachment_path, destination_path)
+                try:
+                    self.categorize_email(session, email, organized_by_hash)
+                except Exception as e:
+                    # One email that cannot be organized must not stop the others
+                    self.logger.error("Could not organize email %s: %s", email.id, e)
             session.commit()  # Commit the changes to the database
             self.logger.info("Categorization of emails completed and changes committed to the database")
 
+    def categorize_email(self, session, email, organized_by_hash):
+        if email.attachment_hash in organized_by_hash:
+            organized = organized_by_hash[email.attachment_hash]
+            email.processed_path = organized.processed_path
+            email.uploaded = organized.uploaded
+            email.state = STATE_UPLOADED if organized.uploaded else STATE_ORGANIZED
+            session.add(email)
+            self.logger.info("Attachment of email %s is already organized at %s", email.id,
+                             organized.processed_path)
+            return
+
+        # Use the email date or current date if none is available
+        email_date = email.date or datetime.now()
+        organization = safe_name(email.sender_organisation, 'Unknown')  # 'Unknown' if no organization is found
+        month_name = email_date.strftime('%B')  # Get the month name from the email date
+        year = email_date.year  # Get the year from the email date
+
+        # Create directory structure path/to/dir/2024/October/{Organization}/
+        organization_dir = os.path.join(self.base_dir, str(year), month_name, organization)
+        os.makedirs(organization_dir, exist_ok=True)  # Create the directory if it doesn't exist
+        self.logger.info("Created directory: %s", organization_dir)
+
+        # Link the PDF attachment into the appropriate directory
+        if email.attachment_path and os.path.exists(email.attachment_path):
+            if email.attachment_hash:
+                file_name = f"{email.attachment_hash[:8]}_{safe_name(email.attachment_name, 'attachment.pdf')}"
+            else:
+                file_name = os.path.basename(email.attachment_path)
+            destination_path = os.path.join(organization_dir, file_name)
+            # Prefer the decrypted copy written during text extraction
+            source_path = PDFProcessor.decrypted_path(email.attachment_path)
+            if not os.path.exists(source_path):
+                source_path = email.attachment_path
+            AttachmentStore.link(source_path, destination_path)  # Hardlink, reflink or copy
+            email.processed_path = destination_path  # Update the processed path in the database
+            email.uploaded = False  # Mark as not yet uploaded
+            email.state = STATE_ORGANIZED
+            session.add(email)  # Add the email record to the session
+            if email.attachment_hash:
+                organized_by_hash[email.attachment_hash] = email
+            self.logger.info("Linked %s to %s", source_path, destination_path)
+
+    def find_or_create_folder(self, name, parent_folder_id):
+        # Returns the id of the folder and whether it was created
+        folder_id = self.uploader.retry(self.drive_client.find_folder, name, parent_folder_id)
+        if folder_id:
+            return folder_id, False
+        return self.uploader.retry(self.drive_client.create_folder, name, parent_folder_id), True
+
+    def get_folder_cache(self, root_folder_id):
+        with self.folder_caches_lock:
+            if root_folder_id not in self.folder_caches:
+                self.folder_caches[root_folder_id] = DriveFolderCache(self.db, root_folder_id)
+            return self.folder_caches[root_folder_id]
+
+    def get_folder_id(self, folders, parent_folder_id=None):
+        # Id of the Drive folder for a list of folder names below the root, missing folders are created
+        folder_cache = self.get_folder_cache(parent_folder_id)
+        folder_id = folder_cache.get("/".join(folders)) if folders else None
+        if folder_id:
+            return folder_id
+        folder_id = parent_folder_id
+        for depth in range(1, len(folders) + 1):
+            path = "/".join(folders[:depth])
+            cached_id = folder_cache.get(path)
+            if cached_id:
+                folder_id = cached_id
+                continue
+            with folder_cache.path_lock(path):
+                cached_id = folder_cache.get(path)
+                if cached_id:
+                    folder_id = cached_id
+                    continue
+                created_id, created = self.find_or_create_folder(folders[depth - 1], folder_id)
+                folder_id = folder_cache.put(path, created_id)
+                if created and folder_id != created_id:
+                    # Another worker created the same folder first, the duplicate is removed
+                    self.uploader.retry(self.drive_client.trash, created_id)
+                self.logger.info("Using Drive folder %s for %s", folder_id, path)
+        return folder_id
+
     def upload_to_google_drive(self, local_path, parent_folder_id=None):
         parent_folder_id = parent_folder_id or self.root_folder_id  # Use the provided root folder ID
 
@@ -70,57 +195,86 @@ class EmailOrganizer:
         else:
             # If the local path is a file, upload it to Google Drive
             file_name = os.path.basename(local_path)
-            file_metadata = {
-                'title': file_name
-            }
             # get all directories in the path from local_path
             parent_folder_structure = local_path.split(os.sep)[1:-1]
 
-            # create folder structure in google drive from parent_folder_structure, but first check if the folder already exists
-            for folder in parent_folder_structure:
-                folder_exists = False
-                file_list = self.drive.ListFile({'q': "'%s' in parents and trashed=false" % parent_folder_id}).GetList()
-                for file in file_list:
-                    if file['title'] == folder:
-                        parent_folder_id = file['id']
-                        folder_exists = True
-                        break
-                if not folder_exists:
-                    folder_metadata = {
-                        'title': folder,
-                        'mimeType': 'application/vnd.google-apps.folder'
-                    }
-                    if parent_folder_id:
-                        folder_metadata['parents'] = [{'id': parent_folder_id}]
-                    folder = self.drive.CreateFile(folder_metadata)
-                    folder.Upload()
-                    # get the id of the created folder
-                    parent_folder_id = folder['id']
-
-            if parent_folder_id:
-                file_metadata['parents'] = [{'id': parent_folder_id}]
-            file = self.drive.CreateFile(file_metadata)
-            file.SetContentFile(local_path)  # Set the content of the file to be uploaded
-            file.Upload()  # Upload the file to Google Drive
+            # When a cached folder was deleted in Drive, the deepest folder is looked up again first and its
+            # parents only while creating it fails as well
+            depth = len(parent_folder_structure)
+            while True:
+                try:
+                    # The folder structure is created in Google Drive where it does not exist yet
+                    folder_id = self.get_folder_id(parent_folder_structure, parent_folder_id)
+                    file_id = self.uploader.upload(local_path, file_name, folder_id)
+                    break
+                except DriveNotFoundError:
+                    if not depth:
+                        raise
+                    path = "/".join(parent_folder_structure[:depth])
+                    self.logger.warning("Drive folder %s of %s not found, refreshing the folder cache", path,
+                                        local_path)
+                    self.get_folder_cache(parent_folder_id).invalidate(path)
+                    depth -= 1
             self.logger.info("Uploaded file %s to Google Drive", local_path)
+            return file_id
 
-    def organize_and_upload(self, batch_size=10):
-        parent_folder_structure = ''
+    @staticmethod
+    def mark_uploaded(session, processed_paths):
+        # Emails sharing an attachment share the organized file, which is uploaded only once
+        for shared in session.query(ImportedEmail).filter(
+                and_(ImportedEmail.state == STATE_ORGANIZED,
+                     ImportedEmail.processed_path.in_(processed_paths))).all():
+            shared.uploaded = True  # Mark as uploaded
+            shared.state = STATE_UPLOADED
+            session.add(shared)  # Add the updated email record to the session
+        # Written in one short transaction, so the upload workers are not blocked on the database meanwhile
+        session.commit()
+
+    def organize_and_upload(self, batch_size=10, progress=None):
         # Categorize emails and then upload them to Google Drive
-        self.logger.info("Starting organization and upload process for %d emails", batch_size)
+        self.logger.info("Starting organization and upload process in pages of %d emails", batch_size)
         self.categorize_emails(batch_size=batch_size)
-        with self.db.Session() as session:
-            # Retrieve emails that have been processed but not yet uploaded
-            emails = session.query(ImportedEmail).filter(
-                and_(ImportedEmail.processed_path != None, ImportedEmail.uploaded == False)
-            ).all()
-            self.logger.info("Retrieved %d emails to upload to Google Drive", len(emails))
-            for email in emails:
-                if os.path.exists(email.processed_path):
-                    # Upload the processed file to Google Drive
-                    self.logger.info("Uploading processed file: %s", email.processed_path)
-                    self.upload_to_google_drive(email.processed_path, self.root_folder_id)
-                    email.uploaded = True  # Mark as uploaded
-                    session.add(email)  # Add the updated email record to the session
-                    session.commit()  # Commit the changes to the database
-            self.logger.info("Upload process completed and changes committed to the database")
+        self.upload_organized(batch_size=batch_size, progress=progress)
+
+    def upload_organized(self, batch_size=10, progress=None):
+        # Upload all organized emails, returns the number of uploaded files. progress is called with
+        # (processed, total) emails after every page, when all uploads of the page are committed.
+        uploaded = failed = 0
+        uploaded_paths = []
+        with self.db.Session() as session, ThreadPoolExecutor(max_workers=self.upload_workers) as executor:
+            total = ImportedEmail.count_by_state(session, [STATE_ORGANIZED]) if progress else None
+            processed = 0
+            # Retrieve emails that have been processed but not yet uploaded, page by page
+            after_id = 0
+            while True:
+                emails = ImportedEmail.get_batch_by_state(session, [STATE_ORGANIZED], after_id, batch_size)
+                if not emails:
+                    break
+                after_id = emails[-1].id
+                self.logger.info("Retrieved %d emails to upload to Google Drive", len(emails))
+                paths = {email.processed_path for email in emails
+                         if email.processed_path and os.path.exists(email.processed_path)}
+                futures = {executor.submit(self.upload_to_google_drive, path, self.root_folder_id): path
+                           for path in sorted(paths)}
+                for future in as_completed(futures):
+                    path = futures[future]
+                    try:
+                        future.result()
+                    except Exception as e:
+                        # The email stays organized and the upload is tried again in the next run
+                        failed += 1
+                        self.logger.error("Failed to upload %s to Google Drive: %s", path, e)
+                        continue
+                    uploaded_paths.append(path)
+                    uploaded += 1
+                    if len(uploaded_paths) >= self.upload_commit_every:
+                        self.mark_uploaded(session, uploaded_paths)  # Commit the uploads finished so far
+                        uploaded_paths = []
+                if uploaded_paths:
+                    self.mark_uploaded(session, uploaded_paths)
+                    uploaded_paths = []
+                processed += len(emails)
+                if progress:
+                    progress(processed, total)
+            self.logger.info("Upload process completed, %d files uploaded, %d failed", uploaded, failed)
+        return uploaded
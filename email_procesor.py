@@ -1,36 +1,148 @@
 import email
+import hashlib
 import imaplib
 import logging
 import os
+import queue
 import sys
-import uuid
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from contextlib import contextmanager
-from datetime import datetime
+from datetime import datetime, timedelta
 from email.header import decode_header, make_header
 
 from sqlalchemy.exc import SQLAlchemyError
 
-from db_email import ImportedEmail, Db
+from attachment_store import AttachmentStore
+from db_email import ImportedEmail, Db, MailboxSyncState, BatchWriter, STATE_IMPORTED, STATE_SKIPPED
+from imap_connection import ImapConnection, ImapConnectionPool, CONNECTION_ERRORS
+from imap_parser import parse_fetch_response, get_body_parts, decode_part, IncrementalDecoder
+
+# IMAP dates must use English month abbreviations regardless of the locale
+IMAP_MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+# "rfc822" downloads whole messages, "bodystructure" fetches the structure and headers first
+# and then only the text body and the PDF attachments
+FETCH_MODES = ("rfc822", "bodystructure")
+
+# Number of messages requested in one FETCH, configurable per account with fetch_batch_size
+FETCH_BATCH_SIZE = 50
+
+# Number of fetched batches that may wait for processing while the next one is downloaded
+PREFETCH_BATCHES = 2
+
+# Attachments larger than this (encoded size) are fetched in partial ranges of STREAM_CHUNK_SIZE
+# and decoded straight to disk in bodystructure mode
+STREAM_THRESHOLD = 4 * 1024 * 1024
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Headers identifying an email for deduplication, fetched on their own before downloading full messages
+HASHED_HEADERS = ("Message-ID", "From", "To", "Date", "Subject")
+
+# Imported emails are inserted in batches of this size, or when the oldest buffered row is this old
+WRITE_BATCH_SIZE = 100
+WRITE_FLUSH_INTERVAL_MS = 1000
+
+
+def iter_prefetched(iterable, max_pending=PREFETCH_BATCHES):
+    """Run iterable in a background thread so that producing the next items overlaps with their consumption."""
+    pending = queue.Queue(maxsize=max_pending)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pending.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(("item", item)):
+                    return
+            put(("done", None))
+        except Exception as e:
+            put(("error", e))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            kind, item = pending.get()
+            if kind == "done":
+                return
+            if kind == "error":
+                raise item
+            yield item
+    finally:
+        # The producer owns the IMAP connection until it has finished
+        stop.set()
+        producer.join()
 
 
 class EmailProcessor:
-    def __init__(self, imap_server, email_address, password, db, save_path="attachments", year=None, month=None, skip=None):
+    def __init__(self, imap_server, email_address, password, db, save_path="attachments", year=None, month=None, skip=None,
+                 mailbox="INBOX", fetch_mode="rfc822", fetch_batch_size=FETCH_BATCH_SIZE,
+                 progress=None, write_batch_size=WRITE_BATCH_SIZE, write_flush_interval_ms=WRITE_FLUSH_INTERVAL_MS,
+                 connection=None, connection_options=None):
+        if fetch_mode not in FETCH_MODES:
+            raise ValueError(f"Unknown fetch mode {fetch_mode}, expected one of {FETCH_MODES}")
         self.imap_server = imap_server
         self.email_address = email_address
         self.password = password
         self.save_path = save_path
+        self.attachment_store = AttachmentStore(save_path)
         self.year = year
         self.month = month
-        self.imap = None
+        # The IMAP session is opened on first use and re-established when it is lost. A connection passed in
+        # belongs to a pool and is not closed here.
+        self.owns_connection = connection is None
+        self.connection = connection or ImapConnection(imap_server, email_address, password,
+                                                       **(connection_options or {}))
         self.skip = skip if skip else 0
+        self.mailbox = mailbox
+        self.fetch_mode = fetch_mode
+        self.fetch_batch_size = max(1, fetch_batch_size)
+        # Called with (email_address, mailbox, current, total), defaults to show_progress_inline
+        self.progress = progress
+        self.write_batch_size = write_batch_size
+        self.write_flush_interval_ms = write_flush_interval_ms
         self.db = db
+        # Whether the account has emails imported before header hashes were stored, checked on first use
+        self.legacy_rows = None
+
+    @property
+    def imap(self):
+        return self.connection.get()
 
     def connect(self):
-        try:
-            self.imap = imaplib.IMAP4_SSL(self.imap_server)
-            self.imap.login(self.email_address, self.password)
-        except Exception as e:
-            print(f"An error occurred while connecting: {e}")
+        # Raises when the server can not be reached after all retries or rejects the login
+        self.connection.get()
+
+    @staticmethod
+    def imap_date(value):
+        return f"{value.day:02d}-{IMAP_MONTHS[value.month - 1]}-{value.year}"
+
+    def build_search_criteria(self):
+        # Translate year/month into SINCE/BEFORE so only candidate messages are returned by the server.
+        # IMAP compares dates only and in the server's timezone, so the window is widened by a day on
+        # each side and the exact check is done again in process_email_message.
+        if not self.year:
+            return "ALL"
+        if self.month:
+            start = datetime(self.year, self.month, 1)
+            end = datetime(self.year + 1, 1, 1) if self.month == 12 else datetime(self.year, self.month + 1, 1)
+        else:
+            start = datetime(self.year, 1, 1)
+            end = datetime(self.year + 1, 1, 1)
+        since = start - timedelta(days=1)
+        before = end + timedelta(days=1)
+        return f"(SINCE {self.imap_date(since)} BEFORE {self.imap_date(before)})"
 
     def decode_subject(self, subject):
         if subject:
@@ -59,56 +171,86 @@ class EmailProcessor:
             return msg.get_payload(decode=True).decode("utf-8", errors="replace")
         return ""
 
-    def save_attachment(self, part, filename, sender):
-        unique_filename = f"{uuid.uuid4()}_{sender}_{filename}"
-        filepath = os.path.join(self.save_path, unique_filename)
-        with open(filepath, "wb") as f:
-            f.write(part.get_payload(decode=True))
-        return filepath
+    def save_attachment(self, part):
+        return self.write_attachment(part.get_payload(decode=True))
 
-    def process_email_message(self, msg, session, email_id=None):
+    def write_attachment(self, payload):
+        # Identical attachments share one blob, returns its path and SHA-256
+        return self.attachment_store.put(payload)
+
+    @staticmethod
+    def parse_date(value):
+        # Returns the datetime of an RFC 2822 date header, None when it is missing or malformed
+        if not value:
+            return None
+        try:
+            return email.utils.parsedate_to_datetime(str(value))
+        except (TypeError, ValueError, OverflowError):
+            return None
+
+    def get_email_dates(self, msg):
+        # A malformed Delivery-date is None and the period filter uses the Date, a malformed Date falls back to the
+        # Delivery-date or now, so one odd header does not stop the import of a mailbox
+        delivery_date = self.parse_date(msg.get("Delivery-date"))
+        if delivery_date is None and msg.get("Delivery-date"):
+            logging.warning(f"Ignoring malformed Delivery-date {msg.get('Delivery-date')!r} of {msg.get('Subject')!r}")
+        email_date = self.parse_date(msg.get("Date")) or delivery_date or datetime.now()
+        if email_date.tzinfo is not None:
+            email_date = email_date.astimezone().replace(tzinfo=None)  # Local time, as stored so far
+        return email_date, delivery_date
+
+    def is_in_requested_period(self, email_date, delivery_date):
+        # Filter by year and month if specified, the server-side search is only a coarse pre-filter
+        filter_date = delivery_date or email_date
+        if self.year and filter_date.year != self.year:
+            return False
+        if self.month and filter_date.month != self.month:
+            return False
+        return True
+
+    def process_email_message(self, msg, session, email_id=None, body=None, attachments=None, writer=None):
+        # body and attachments are passed in when only selected parts were fetched from the server,
+        # attachments is then a list of (filename, path, hash) of the PDF attachments already in the store
         try:
             subject = self.decode_subject(msg.get("Subject"))
             sender = msg.get("From")
-            date_tuple = email.utils.parsedate_tz(msg.get("Date"))
-            email_date = datetime.fromtimestamp(email.utils.mktime_tz(date_tuple)) if date_tuple else datetime.now()
+            email_date, delivery_date = self.get_email_dates(msg)
 
             is_spam = "***SPAM***" in subject
             has_attachment = False
             attachment_path = None
-            body = self.get_email_body(msg)
+            attachment_hash = None
+            attachment_name = None
+            if body is None:
+                body = self.get_email_body(msg)
 
             return_path = str(msg.get("Return-Path")) if msg.get("Return-Path") else None
             envelope_to = str(msg.get("Envelope-To")) if msg.get("Envelope-To") else None
-            delivery_date_str = msg.get("Delivery-date")
-            delivery_date = datetime.strptime(delivery_date_str,
-                                              "%a, %d %b %Y %H:%M:%S %z") if delivery_date_str else None
             received_from = str(msg.get("Received")) if msg.get("Received") else None
             dkim_signature = str(msg.get("DKIM-Signature")) if msg.get("DKIM-Signature") else None
             spam_status = str(msg.get("X-Spam-Status")) if msg.get("X-Spam-Status") else None
             spam_report = str(msg.get("X-Spam-Report")) if msg.get("X-Spam-Report") else None
 
-            # Filter by year and month if specified
-            if self.year and delivery_date.year != self.year:
-                # print(
-                #     f"Skipping email with ID {email_id} as it is not from the specified year({self.year}) {delivery_date}.")
-                return
-            if self.month and delivery_date.month != self.month:
+            if not self.is_in_requested_period(email_date, delivery_date):
                 # print(
-                #     f"Skipping email with ID {email_id} as it is not from the specified month({self.month}) {delivery_date}.")
+                #     f"Skipping email with ID {email_id} as it is not from the specified period({self.year}/{self.month}) {delivery_date}.")
                 return
 
             # print(
             #     f"Processing email with ID {email_id} year={self.year}({delivery_date.year}) month={self.month}({delivery_date.month}); {delivery_date}")
 
             # Check for attachments
-            if msg.is_multipart():
+            if attachments is not None:
+                for attachment_name, attachment_path, attachment_hash in attachments:
+                    has_attachment = True
+            elif msg.is_multipart():
                 for part in msg.walk():
                     if part.get_content_disposition() == "attachment":
                         filename = part.get_filename()
                         if filename and filename.endswith(".pdf"):
                             has_attachment = True
-                            attachment_path = self.save_attachment(part, filename, sender)
+                            attachment_path, attachment_hash = self.save_attachment(part)
+                            attachment_name = filename
                             # print(f"Attachment saved: {attachment_path}")
 
             # Save email details to the database
@@ -122,119 +264,525 @@ class EmailProcessor:
                 has_attachment=has_attachment,
                 body=body,
                 attachment_path=attachment_path,
+                attachment_hash=attachment_hash,
+                attachment_name=attachment_name,
                 return_path=return_path,
                 envelope_to=envelope_to,
                 delivery_date=delivery_date,
                 received_from=received_from,
                 dkim_signature=dkim_signature,
                 spam_status=spam_status,
-                spam_report=spam_report
+                spam_report=spam_report,
+                message_id=self.get_message_id(msg),
+                header_hash=self.get_header_hash(msg),
+                state=STATE_IMPORTED if has_attachment else STATE_SKIPPED
             )
-            session.add(email_instance)
-            session.commit()
+            if writer is not None:
+                writer.add(email_instance, key=email_id)
+            else:
+                session.add(email_instance)
+                session.commit()
             logging.debug(f"\nProcessed and saved email with date ({delivery_date}): {subject}")
             # print(f"Processed and saved email with date ({delivery_date}): {subject}")
-        except LookupError as e:
+        except (LookupError, ValueError) as e:
+            # The message is skipped, the import continues with the next one
             print(f"An error occurred while processing email with ID {email_id}: {e}")
         except SQLAlchemyError as e:
             session.rollback()
             print(f"Database error while processing email with ID {email_id}: {e}")
 
+    def get_uid_validity(self):
+        # imaplib keeps the untagged UIDVALIDITY response of the last SELECT
+        _, data = self.imap.response("UIDVALIDITY")
+        if data and data[0]:
+            return int(data[0])
+        return None
+
+    def load_sync_state(self, session):
+        state = MailboxSyncState.get_or_create(session, self.email_address, self.mailbox)
+        first_sync = state.updated_at is None
+        uid_validity = self.get_uid_validity()
+        if state.uid_validity != uid_validity:
+            if state.uid_validity is not None:
+                logging.warning(f"UIDVALIDITY of {self.email_address}/{self.mailbox} changed "
+                                f"({state.uid_validity} -> {uid_validity}), starting a full resync")
+            state.reset(uid_validity)
+            session.commit()
+        return state, first_sync
+
+    def search_uids(self, criteria, state=None):
+        # Incremental runs only ask for messages after the checkpoint
+        if state is not None:
+            criteria = f"UID {state.last_uid + 1}:*"
+        status, messages = self.imap.uid("search", None, criteria)
+        if status != "OK":
+            return None
+        uids = sorted(int(uid) for uid in messages[0].split())
+        if state is not None:
+            # "n:*" always matches the highest UID in the mailbox, even if it is lower than n
+            uids = [uid for uid in uids if uid > state.last_uid]
+        return uids
+
+    def iter_message_batches(self, uids):
+        # Yields one list of (uid, msg, body, attachments) per FETCH batch, msg is None when the
+        # message was skipped before downloading its content
+        for start in range(0, len(uids), self.fetch_batch_size):
+            batch = uids[start:start + self.fetch_batch_size]
+            if self.fetch_mode == "bodystructure":
+                yield self.fetch_pdf_parts(batch)
+            else:
+                yield self.fetch_full_messages(batch)
+
+    def iter_messages(self, uids):
+        for batch in self.iter_message_batches(uids):
+            yield from batch
+
+    @staticmethod
+    def get_header_hash(msg):
+        values = []
+        for name in HASHED_HEADERS:
+            value = msg.get(name)
+            values.append(" ".join(str(value).split()).lower() if value else "")
+        return hashlib.sha256("\n".join(values).encode("utf-8", errors="surrogateescape")).hexdigest()
+
+    @staticmethod
+    def get_message_id(msg):
+        message_id = msg.get("Message-ID")
+        return str(message_id).strip() if message_id else None
+
+    def find_imported(self, headers):
+        # headers maps header hashes to the parsed headers, returns the hashes of emails already imported
+        with self.db.get_new_session() as session:
+            imported = ImportedEmail.get_existing_header_hashes(session, self.email_address, set(headers))
+            if self.legacy_rows is None:
+                self.legacy_rows = ImportedEmail.has_legacy_rows(session, self.email_address)
+            if self.legacy_rows:
+                identities = {}
+                for header_hash, msg in headers.items():
+                    date_tuple = email.utils.parsedate_tz(msg.get("Date")) if msg.get("Date") else None
+                    if header_hash in imported or not date_tuple:
+                        continue
+                    identities[header_hash] = (msg.get("From"), self.decode_subject(msg.get("Subject")),
+                                               datetime.fromtimestamp(email.utils.mktime_tz(date_tuple)))
+                imported |= ImportedEmail.claim_legacy_rows(session, self.email_address, identities)
+            return imported
+
+    def filter_new_uids(self, uids):
+        # Only the identifying headers are fetched to skip emails that were already imported
+        status, data = self.imap.uid("fetch", ",".join(str(uid) for uid in uids),
+                                     f"(UID BODY.PEEK[HEADER.FIELDS ({' '.join(HASHED_HEADERS).upper()})])")
+        if status != "OK":
+            return uids, []
+        hashes = {}
+        headers = {}
+        for item in parse_fetch_response(data):
+            header = next((value for key, value in item.items() if key.startswith("BODY[HEADER.FIELDS")), None)
+            if item.get("UID") and isinstance(header, bytes):
+                msg = email.message_from_bytes(header)
+                hashes[int(item["UID"])] = header_hash = self.get_header_hash(msg)
+                headers[header_hash] = msg
+        imported = self.find_imported(headers)
+        new_uids = [uid for uid in uids if hashes.get(uid) not in imported]
+        duplicate_uids = [uid for uid in uids if hashes.get(uid) in imported]
+        return new_uids, duplicate_uids
+
+    def fetch_full_messages(self, uids):
+        uids, duplicate_uids = self.filter_new_uids(uids)
+        messages = [(uid, None, None, None) for uid in duplicate_uids]
+        if not uids:
+            return messages
+        status, data = self.imap.uid("fetch", ",".join(str(uid) for uid in uids), "(UID RFC822)")
+        if status != "OK":
+            print(f"Failed to fetch emails with UIDs {uids[0]}-{uids[-1]}")
+            return messages
+
+        for item in parse_fetch_response(data):
+            if not item.get("UID") or item.get("RFC822") is None:
+                continue
+            messages.append((int(item["UID"]), email.message_from_bytes(item["RFC822"]), None, None))
+        return messages
+
+    def fetch_pdf_parts(self, uids):
+        # First phase: structure and headers of the whole batch
+        status, data = self.imap.uid("fetch", ",".join(str(uid) for uid in uids),
+                                     "(UID BODYSTRUCTURE BODY.PEEK[HEADER])")
+        if status != "OK":
+            print(f"Failed to fetch structure of emails with UIDs {uids[0]}-{uids[-1]}")
+            return []
+
+        headers = []
+        for item in parse_fetch_response(data):
+            structure = item.get("BODYSTRUCTURE")
+            header = item.get("BODY[HEADER]")
+            if not item.get("UID") or structure is None or header is None:
+                continue
+            headers.append((int(item["UID"]), email.message_from_bytes(header), structure))
+        imported = self.find_imported({self.get_header_hash(msg): msg for _, msg, _ in headers})
+
+        plans = []
+        for uid, msg, structure in headers:
+            if self.get_header_hash(msg) in imported:
+                plans.append((uid, None, None, []))
+                continue
+            if not self.is_in_requested_period(*self.get_email_dates(msg)):
+                plans.append((uid, None, None, []))
+                continue
+
+            try:
+                parts = get_body_parts(structure)
+            except Exception as e:
+                print(f"Failed to parse structure of email with UID {uid}: {e}")
+                continue
+            if isinstance(structure[0], list):
+                text_part = next((part for part in parts if part["content_type"] == "text/plain"
+                                  and part["disposition"] != "attachment"), None)
+            else:
+                text_part = parts[0]
+            pdf_parts = [part for part in parts if part["disposition"] == "attachment"
+                         and part["filename"] and part["filename"].endswith(".pdf")]
+            plans.append((uid, msg, text_part, pdf_parts))
+
+        # Second phase: only the text body and the PDF attachments, messages with the same
+        # sections (e.g. body in 1 and PDF in 2) are fetched together, large attachments are streamed
+        groups = {}
+        for uid, msg, text_part, pdf_parts in plans:
+            if msg is None:
+                continue
+            sections = ([text_part] if text_part else []) + [part for part in pdf_parts
+                                                               if part["size"] <= STREAM_THRESHOLD]
+            if sections:
+                items = " ".join(f"BODY.PEEK[{part['section']}]" for part in sections)
+                groups.setdefault(items, []).append(uid)
+        fetched = {}
+        for items, group_uids in groups.items():
+            status, part_data = self.imap.uid("fetch", ",".join(str(uid) for uid in group_uids), f"(UID {items})")
+            if status != "OK":
+                print(f"Failed to fetch parts of emails with UIDs {group_uids}")
+                continue
+            for response in parse_fetch_response(part_data):
+                if response.get("UID"):
+                    fetched.setdefault(int(response["UID"]), {}).update(response)
+
+        messages = []
+        for uid, msg, text_part, pdf_parts in plans:
+            if msg is None:
+                messages.append((uid, None, None, None))
+                continue
+            sections = fetched.get(uid, {})
+            if not sections and (text_part or any(part["size"] <= STREAM_THRESHOLD for part in pdf_parts)):
+                continue
+            try:
+                body = ""
+                if text_part:
+                    body = decode_part(sections.get(f"BODY[{text_part['section']}]"), text_part["encoding"])
+                    body = body.decode("utf-8", errors="replace")
+                attachments = []
+                for part in pdf_parts:
+                    if part["size"] > STREAM_THRESHOLD:
+                        attachment_path, attachment_hash = self.stream_attachment(uid, part)
+                    else:
+                        payload = decode_part(sections.get(f"BODY[{part['section']}]"), part["encoding"])
+                        attachment_path, attachment_hash = self.write_attachment(payload)
+                    attachments.append((part["filename"], attachment_path, attachment_hash))
+            except Exception as e:
+                print(f"Failed to decode parts of email with UID {uid}: {e}")
+                continue
+            messages.append((uid, msg, body, attachments))
+        return messages
+
+    def stream_attachment(self, uid, part):
+        # The part is fetched in partial ranges and decoded chunk by chunk straight to a temporary file,
+        # so memory use does not depend on the attachment size
+        decoder = IncrementalDecoder(part["encoding"])
+        writer = self.attachment_store.open_writer()
+        try:
+            offset = 0
+            while True:
+                status, data = self.imap.uid("fetch", str(uid),
+                                             f"(BODY.PEEK[{part['section']}]<{offset}.{STREAM_CHUNK_SIZE}>)")
+                if status != "OK":
+                    raise imaplib.IMAP4.error(f"Failed to fetch part {part['section']} of email with UID {uid}")
+                chunk = next((value for response in parse_fetch_response(data) for key, value in response.items()
+                              if key.startswith(f"BODY[{part['section']}]")), None) or b""
+                if isinstance(chunk, str):
+                    chunk = chunk.encode("utf-8")
+                writer.write(decoder.feed(chunk))
+                offset += len(chunk)
+                if len(chunk) < STREAM_CHUNK_SIZE:
+                    break
+            writer.write(decoder.finish())
+            return writer.commit()
+        except BaseException:
+            writer.discard()
+            raise
+
     def process_emails(self):
         try:
             logging.info(f"Processing emails for {self.email_address}...\n")
-            # Select the mailbox (e.g., INBOX)
-            self.imap.select("INBOX")
-
-            # Search for all emails in the mailbox
-            status, messages = self.imap.search(None, "ALL")
-            if status != "OK":
-                print("No emails found!")
-                return
+            # Select the mailbox (e.g., INBOX), a pooled connection may have been dropped since its last use
+            try:
+                self.connection.select(self.mailbox)
+            except CONNECTION_ERRORS as e:
+                logging.warning(f"Connection to {self.email_address} lost ({e}), reconnecting")
+                self.connection.reconnect()
 
             # Create a directory to save attachments
             os.makedirs(self.save_path, exist_ok=True)
 
             # Process emails
             with self.db.get_session() as session:
-                email_ids = messages[0].split()
-                total_emails = len(email_ids)
-                for i, num in enumerate(email_ids[self.skip:], start=self.skip+1):
-                    status, msg_data = self.imap.fetch(num, "(RFC822)")
-                    if status != "OK":
-                        print(f"Failed to fetch email with ID {num}")
-                        continue
-
-                    # Parse the email
-                    for response_part in msg_data:
-                        if isinstance(response_part, tuple):
-                            msg = email.message_from_bytes(response_part[1])
-                            self.process_email_message(msg, session, email_id=num.decode('utf-8'))
-                    # Update progress inline
-                    self.show_progress_inline(i, total_emails)
+                # Date-scoped imports search the requested window and leave the checkpoint alone,
+                # otherwise only messages with a UID above the stored checkpoint are fetched
+                criteria = self.build_search_criteria()
+                state = None
+                skip = 0
+                if criteria == "ALL":
+                    state, first_sync = self.load_sync_state(session)
+                    # The positional skip from the config only seeds the very first sync
+                    if first_sync:
+                        skip = self.skip
+
+                uids = self.search_uids(criteria, state)
+                if uids is None:
+                    print("No emails found!")
+                    return
+                uids = uids[skip:]
+                total_emails = len(uids)
+                logging.info(f"Found {total_emails} emails to process in {self.mailbox} ({criteria})")
+                # The next batch is downloaded while the current one is parsed and saved
+                writer = BatchWriter(session, self.write_batch_size, self.write_flush_interval_ms)
+                self.processed = 0
+                self.imported_uids = set()
+                self.checkpoint_index = 0
+                failures = 0
+                failed_at = None
+                try:
+                    while True:
+                        try:
+                            self.import_uids(session, uids, state, writer, total_emails)
+                            break
+                        except CONNECTION_ERRORS as e:
+                            # Consecutive failures without progress are limited, a long import may reconnect
+                            # any number of times
+                            failures = failures + 1 if failed_at == self.processed else 1
+                            failed_at = self.processed
+                            if failures > self.connection.max_retries:
+                                raise
+                            logging.warning(f"Connection to {self.email_address} lost after {self.processed}/"
+                                            f"{total_emails} emails in {self.mailbox} ({e}), reconnecting")
+                            self.connection.reconnect()
+                            # UIDs of another UIDVALIDITY do not continue the import, the next run resyncs
+                            if state is not None and self.get_uid_validity() != state.uid_validity:
+                                logging.warning(f"UIDVALIDITY of {self.email_address}/{self.mailbox} changed "
+                                                f"during the import, stopping")
+                                break
+                finally:
+                    writer.flush()
+                    # A failed batch is rolled back together with the pending checkpoint
+                    if state is not None:
+                        self.advance_checkpoint(state, uids, writer)
+                        session.commit()
+        except CONNECTION_ERRORS:
+            # Raised to the caller, so a pooled connection that failed is closed instead of reused
+            raise
         except Exception as e:
             print(f"An error occurred while processing emails: {e}")
         finally:
             print("\n")
             logging.info(f"Email processing for {self.email_address} complete.")
 
+    def import_uids(self, session, uids, state, writer, total_emails):
+        # self.imported_uids holds the UIDs processed so far, an import that failed resumes with the others. Batches
+        # are not in UID order and may miss messages, so no position in uids marks the progress.
+        remaining = [uid for uid in uids if uid not in self.imported_uids]
+        for batch in iter_prefetched(self.iter_message_batches(remaining)):
+            for uid, msg, body, attachments in batch:
+                self.processed += 1
+                if msg is not None:
+                    self.process_email_message(msg, session, email_id=str(uid), body=body,
+                                               attachments=attachments, writer=writer)
+                self.imported_uids.add(uid)
+                # Update progress inline
+                if self.progress:
+                    self.progress(self.email_address, self.mailbox, self.processed, total_emails)
+                else:
+                    self.show_progress_inline(self.processed, total_emails)
+            # The checkpoint is committed together with the next batch of saved emails
+            if state is not None:
+                self.advance_checkpoint(state, uids, writer)
+            writer.flush_if_due()
+
+    def advance_checkpoint(self, state, uids, writer):
+        # The checkpoint only moves over UIDs that were all imported. A message the server did not return, that
+        # could not be decoded or whose row was not saved stops it, so the next run fetches it again; the emails
+        # after it that were already saved are then skipped by their header hash.
+        unsaved = {key for key in writer.keys if key is not None} | writer.failed_keys
+        while self.checkpoint_index < len(uids):
+            uid = uids[self.checkpoint_index]
+            if uid not in self.imported_uids or str(uid) in unsaved:
+                break
+            self.checkpoint_index += 1
+        if self.checkpoint_index:
+            state.advance(uids[self.checkpoint_index - 1])
+
     def import_email_by_id(self, email_id):
         try:
             # Select the mailbox (e.g., INBOX)
-            self.imap.select("INBOX")
+            self.connection.select(self.mailbox)
 
-            # Fetch the email by ID
-            status, msg_data = self.imap.fetch(email_id, "(RFC822)")
+            # Resolve the UID of the email so it can be fetched in the configured mode
+            status, data = self.imap.fetch(email_id, "(UID)")
             if status != "OK":
                 print(f"Failed to fetch email with ID {email_id}")
                 return
+            uids = [int(item["UID"]) for item in parse_fetch_response(data) if item.get("UID")]
 
             # Create a directory to save attachments
             os.makedirs(self.save_path, exist_ok=True)
 
             # Parse the email
             with self.db.get_session() as session:
-                for response_part in msg_data:
-                    if isinstance(response_part, tuple):
-                        msg = email.message_from_bytes(response_part[1])
-                        self.process_email_message(msg, session, email_id=email_id)
+                for uid, msg, body, attachments in self.iter_messages(uids):
+                    if msg is not None:
+                        self.process_email_message(msg, session, email_id=email_id, body=body,
+                                                   attachments=attachments)
         except Exception as e:
             print(f"An error occurred while importing email by ID: {e}")
 
     def close_connection(self):
-        if self.imap:
-            self.imap.close()
-            self.imap.logout()
+        if self.owns_connection:
+            self.connection.close()
+
+
+class ImportProgress:
+    """Collects the progress of mailboxes imported in parallel and shows it on one line.
+
+    on_progress is called with the emails processed and found in all mailboxes so far.
+    """
+
+    def __init__(self, on_progress=None):
+        self.lock = threading.Lock()
+        self.mailboxes = {}
+        self.on_progress = on_progress
+
+    def update(self, email_address, mailbox, current, total):
+        with self.lock:
+            self.mailboxes[f"{email_address}/{mailbox}"] = (current, total)
+            line = " | ".join(f"{name}: {current}/{total}" for name, (current, total) in self.mailboxes.items())
+            sys.stdout.write(f"\rProgress: {line}")
+            sys.stdout.flush()
+            processed = sum(current for current, _ in self.mailboxes.values())
+            total = sum(total for _, total in self.mailboxes.values())
+        if self.on_progress:
+            self.on_progress(processed, total)
 
 
 class ImportEmails:
-    def __init__(self, email_accounts, save_path, database_url='sqlite:///emails.db'):
+    def __init__(self, email_accounts, save_path, database_url='sqlite:///emails.db', concurrency=1,
+                 connections_per_server=None, write_batch_size=WRITE_BATCH_SIZE,
+                 write_flush_interval_ms=WRITE_FLUSH_INTERVAL_MS, imap_max_retries=5, imap_max_backoff=300,
+                 imap_health_check_interval=60):
         self.email_accounts = email_accounts
         self.save_path = save_path
         self.db = Db(database_url)
-
+        # Maximum number of mailboxes imported at the same time and of IMAP connections to one server
+        self.concurrency = max(1, concurrency)
+        self.connections_per_server = connections_per_server
+        self.write_batch_size = write_batch_size
+        self.write_flush_interval_ms = write_flush_interval_ms
+        # IMAP sessions are reused by later imports, lost ones are re-established with backoff
+        self.connection_options = {'max_retries': imap_max_retries, 'max_backoff': imap_max_backoff,
+                                   'health_check_interval': imap_health_check_interval}
+        self.connection_pool = ImapConnectionPool(**self.connection_options)
+
+    def close(self):
+        # Logs out of the IMAP connections kept for later imports
+        self.connection_pool.close()
+
+    def get_mailboxes(self, email_account):
+        mailboxes = email_account["account"].get("mailboxes")
+        return mailboxes if mailboxes else [email_account["account"].get("mailbox", "INBOX")]
+
+    def create_processor(self, email_account, mailbox, year=None, month=None, progress=None, connection=None):
+        imap_server = email_account["account"]["imap_server"]
+        email_address = email_account["account"]["email_address"]
+        password = email_account["account"]["password"]
+        skip = email_account["account"].get("skip", 0)
+        fetch_mode = email_account["account"].get("fetch_mode", "rfc822")
+        fetch_batch_size = email_account["account"].get("fetch_batch_size", FETCH_BATCH_SIZE)
+
+        return EmailProcessor(imap_server, email_address, password, self.db, save_path=self.save_path,
+                              year=year, month=month, skip=skip, mailbox=mailbox,
+                              fetch_mode=fetch_mode, fetch_batch_size=fetch_batch_size, progress=progress,
+                              write_batch_size=self.write_batch_size,
+                              write_flush_interval_ms=self.write_flush_interval_ms, connection=connection,
+                              connection_options=self.connection_options)
 
     @contextmanager
     def connect(self, year=None, month=None):
+        # The connection of a processor is opened when it is first used
         email_processors = []
         try:
             for email_account in self.email_accounts:
-                imap_server = email_account["account"]["imap_server"]
-                email_address = email_account["account"]["email_address"]
-                password = email_account["account"]["password"]
-                skip = email_account["account"].get("skip", 0)
-
-                logging.info(f"Connecting to {email_address}...")
-                email_processor = EmailProcessor(imap_server, email_address, password, self.db, save_path=self.save_path,
-                                                 year=year, month=month, skip=skip)
-                email_processor.connect()
-                email_processors.append(email_processor)
+                for mailbox in self.get_mailboxes(email_account):
+                    email_processors.append(self.create_processor(email_account, mailbox, year, month))
             yield email_processors
         finally:
             for email_processor in email_processors:
                 email_processor.close_connection()
 
-    def import_emails(self, year=None, month=None):
-        with self.connect(year, month) as email_processors:
-            for email_processor in email_processors:
-                email_processor.process_emails()
+    def import_mailbox(self, email_account, mailbox, year=None, month=None, progress=None):
+        account = email_account["account"]
+        with self.connection_pool.connection(account["imap_server"], account["email_address"],
+                                             account["password"]) as connection:
+            email_processor = self.create_processor(email_account, mailbox, year, month, progress, connection)
+            started = time.monotonic()
+            logging.info(f"Connecting to {email_processor.email_address} ({mailbox})...")
+            email_processor.connect()
+            email_processor.process_emails()
+            logging.info(f"Imported {email_processor.email_address}/{mailbox} in {time.monotonic() - started:.1f}s")
+
+    def get_accounts(self, email_address=None):
+        if email_address is None:
+            return self.email_accounts
+        accounts = [email_account for email_account in self.email_accounts
+                    if email_account["account"]["email_address"] == email_address]
+        if not accounts:
+            raise ValueError(f"Unknown email account {email_address}")
+        return accounts
+
+    def import_emails(self, year=None, month=None, email_address=None, progress=None):
+        # Every (account, mailbox) pair runs in its own worker with its own IMAP connection
+        email_accounts = self.get_accounts(email_address)
+        import_progress = ImportProgress(progress)
+        pending = {}
+        for email_account in email_accounts:
+            for mailbox in self.get_mailboxes(email_account):
+                pending.setdefault(email_account["account"]["imap_server"], deque()).append((email_account, mailbox))
+        # A server never has more than connections_per_server mailboxes in the pool, so the workers only take
+        # mailboxes of servers that can accept another connection
+        server_limit = self.connections_per_server or self.concurrency
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {}
+
+            def submit_next(imap_server):
+                email_account, mailbox = pending[imap_server].popleft()
+                future = executor.submit(self.import_mailbox, email_account, mailbox, year, month,
+                                         import_progress.update)
+                futures[future] = (imap_server, f"{email_account['account']['email_address']}/{mailbox}")
+
+            for imap_server, mailboxes in pending.items():
+                for _ in range(min(server_limit, len(mailboxes))):
+                    submit_next(imap_server)
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    imap_server, name = futures.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f"An error occurred while importing {name}: {e}")
+                    if pending[imap_server]:
+                        submit_next(imap_server)
+        print("\n")
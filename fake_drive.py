@@ -0,0 +1,92 @@
+import itertools
+import os
+import random
+import threading
+import time
+
+from drive_client import DriveClient, DriveNotFoundError, TransientDriveError, FOLDER_MIME_TYPE
+
+
+class FakeUpload:
+    def __init__(self, local_path, title, parent_id, chunk_size):
+        self.local_path = local_path
+        self.title = title
+        self.parent_id = parent_id
+        self.chunk_size = chunk_size
+        self.size = os.path.getsize(local_path)
+        self.offset = 0
+
+
+class FakeDriveClient(DriveClient):
+    """In-memory Drive to test and benchmark uploads without Google.
+
+    Every request waits latency seconds, chunks are sent at bandwidth bytes per second per connection and fail
+    with failure_rate. Like a resumable Drive upload, a failed chunk is sent again from the last received byte.
+    """
+
+    def __init__(self, latency=0.05, bandwidth=None, failure_rate=0.0, root_id='root'):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.root_id = root_id
+        self.files = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'failures': 0, 'bytes': 0, 'uploads': 0}
+
+    def request(self, parent_id=None):
+        time.sleep(self.latency)
+        with self.lock:
+            self.stats['requests'] += 1
+            if parent_id and parent_id != self.root_id and parent_id not in self.files:
+                raise DriveNotFoundError(f"File not found: {parent_id}")
+
+    def add_file(self, title, parent_id, mime_type=None, size=0):
+        with self.lock:
+            file_id = f"fake-{next(self.ids)}"
+            self.files[file_id] = {'id': file_id, 'title': title, 'parent_id': parent_id or self.root_id,
+                                   'mimeType': mime_type, 'size': size}
+            return file_id
+
+    def find_folder(self, name, parent_id):
+        self.request(parent_id)
+        with self.lock:
+            for file in self.files.values():
+                if file['title'] == name and file['parent_id'] == (parent_id or self.root_id) \
+                        and file['mimeType'] == FOLDER_MIME_TYPE:
+                    return file['id']
+        return None
+
+    def create_folder(self, name, parent_id):
+        self.request(parent_id)
+        return self.add_file(name, parent_id, FOLDER_MIME_TYPE)
+
+    def trash(self, file_id):
+        self.request()
+        with self.lock:
+            self.files.pop(file_id, None)
+
+    def start_upload(self, local_path, title, parent_id, chunk_size):
+        return FakeUpload(local_path, title, parent_id, chunk_size)
+
+    def upload_chunk(self, upload):
+        self.request(upload.parent_id)
+        length = min(upload.chunk_size, upload.size - upload.offset)
+        if self.bandwidth:
+            time.sleep(length / self.bandwidth)
+        if random.random() < self.failure_rate:
+            # Part of the chunk arrived before the connection failed
+            received = random.randint(0, length)
+            with self.lock:
+                self.stats['failures'] += 1
+                self.stats['bytes'] += received
+            upload.offset += received
+            raise TransientDriveError(f"Simulated failure at byte {upload.offset} of {upload.local_path}")
+        upload.offset += length
+        with self.lock:
+            self.stats['bytes'] += length
+        if upload.offset < upload.size:
+            return None
+        with self.lock:
+            self.stats['uploads'] += 1
+        return self.add_file(upload.title, upload.parent_id, 'application/pdf', upload.size)
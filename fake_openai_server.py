@@ -0,0 +1,167 @@
+import argparse
+import email.parser
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def answer_chat_completion(request, request_number):
+    content = request["messages"][-1]["content"]
+    match = re.search(r"Sender: .*?@([\w.-]+)", content)
+    organization = match.group(1).split(".")[0].capitalize() if match else "Unknown"
+    answer = json.dumps({"organization": organization, "spam": "No", "invoice": 0.9})
+    return {
+        "id": f"chatcmpl-fake-{request_number}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.get("model", "gpt-4o-mini"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": len(content) // 4, "completion_tokens": 20, "total_tokens": len(content) // 4 + 20},
+    }
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    """Answers chat completions like OpenAI, deriving the organization from the sender domain.
+
+    The files and batches endpoints of the Batch API are supported too, a batch completes batch_delay seconds
+    after it was created.
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def next_request_number(self):
+        with self.server.lock:
+            self.server.requests += 1
+            return self.server.requests
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_GET(self):
+        server = self.server
+        match = re.fullmatch(r"/v1/files/([\w-]+)/content", self.path)
+        if match and match.group(1) in server.files:
+            body = server.files[match.group(1)]["content"]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        match = re.fullmatch(r"/v1/batches/([\w-]+)", self.path)
+        if match and match.group(1) in server.batches:
+            batch = dict(server.batches[match.group(1)])
+            if time.time() < batch["created_at"] + server.batch_delay:
+                batch.update(status="in_progress", output_file_id=None)
+            self.send_json(200, batch)
+            return
+        self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_POST(self):
+        body = self.read_body()
+        server = self.server
+        if self.path.endswith("/files"):
+            self.send_json(200, self.create_file(body))
+            return
+        if self.path.endswith("/batches"):
+            self.send_json(200, self.create_batch(json.loads(body)))
+            return
+        request_number = self.next_request_number()
+        if server.latency:
+            time.sleep(server.latency)
+        if not self.path.endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        if random.random() < server.error_rate:
+            status = random.choice([429, 500, 503])
+            self.send_json(status, {"error": {"message": "Simulated error", "type": "server_error"}},
+                           {"Retry-After": "0.1"} if status == 429 else None)
+            return
+        self.send_json(200, answer_chat_completion(json.loads(body or b"{}"), request_number))
+
+    def store_file(self, filename, content, purpose):
+        file_id = f"file-{uuid.uuid4().hex}"
+        self.server.files[file_id] = {"id": file_id, "object": "file", "bytes": len(content),
+                                      "created_at": int(time.time()), "filename": filename, "purpose": purpose,
+                                      "status": "processed", "content": content}
+        return {key: value for key, value in self.server.files[file_id].items() if key != "content"}
+
+    def create_file(self, body):
+        # The upload is multipart/form-data with a purpose and a file field
+        message = email.parser.BytesParser().parsebytes(
+            f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("utf-8") + body)
+        fields = {part.get_param("name", header="content-disposition"): part for part in message.get_payload()}
+        file_part = fields["file"]
+        return self.store_file(file_part.get_filename(), file_part.get_payload(decode=True),
+                               fields["purpose"].get_payload(decode=True).decode("utf-8"))
+
+    def create_batch(self, request):
+        output = []
+        for line in self.server.files[request["input_file_id"]]["content"].splitlines():
+            if not line.strip():
+                continue
+            batch_request = json.loads(line)
+            request_number = self.next_request_number()
+            output.append({"id": f"batch_req_{request_number}", "custom_id": batch_request["custom_id"],
+                           "response": {"status_code": 200, "request_id": str(request_number),
+                                        "body": answer_chat_completion(batch_request["body"], request_number)},
+                           "error": None})
+        output_file = self.store_file("batch_output.jsonl",
+                                      "".join(json.dumps(line) + "\n" for line in output).encode("utf-8"),
+                                      "batch_output")
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        self.server.batches[batch_id] = {
+            "id": batch_id, "object": "batch", "endpoint": request["endpoint"], "errors": None,
+            "input_file_id": request["input_file_id"], "completion_window": request["completion_window"],
+            "status": "completed", "output_file_id": output_file["id"], "error_file_id": None,
+            "created_at": int(time.time()),
+            "request_counts": {"total": len(output), "completed": len(output), "failed": 0},
+        }
+        return dict(self.server.batches[batch_id], status="validating", output_file_id=None)
+
+
+def start_fake_server(host="127.0.0.1", port=0, error_rate=0.0, latency=0.0, batch_delay=0.0):
+    """Start the fake server in a background thread, use http://host:port/v1 as openai_base_url."""
+    server = ThreadingHTTPServer((host, port), FakeOpenAIHandler)
+    server.error_rate = error_rate
+    server.latency = latency
+    server.batch_delay = batch_delay
+    server.requests = 0
+    server.files = {}
+    server.batches = {}
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI API to test classification offline")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 429/5xx")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to wait before every answer")
+    parser.add_argument("--batch-delay", type=float, default=0.0, help="Seconds until a batch is completed")
+    args = parser.parse_args()
+
+    fake_server = start_fake_server(args.host, args.port, args.error_rate, args.latency, args.batch_delay)
+    print(f"Fake OpenAI API listening on http://{args.host}:{fake_server.server_address[1]}/v1")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake_server.shutdown()
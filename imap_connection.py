@@ -0,0 +1,151 @@
+import imaplib
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+# Errors of a lost or broken connection, after which the session is re-established. Command errors (NO/BAD
+# responses, imaplib.IMAP4.error) and failed logins are not retried.
+CONNECTION_ERRORS = (imaplib.IMAP4.abort, OSError, EOFError)
+
+
+class ImapConnection:
+    """An IMAP session that is opened on first use, health-checked and re-established when it was lost.
+
+    get() returns a logged in imaplib connection. A connection that was not used for health_check_interval seconds
+    is checked with NOOP first and replaced when the check fails. Connecting is retried up to max_retries times with
+    exponential backoff; a rejected login is not retried. After a reconnect the last selected mailbox is selected
+    again.
+    """
+
+    def __init__(self, imap_server, email_address, password, max_retries=5, backoff=1.0, max_backoff=300,
+                 health_check_interval=60):
+        self.imap_server = imap_server
+        self.email_address = email_address
+        self.password = password
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.health_check_interval = health_check_interval
+        self.imap = None
+        self.mailbox = None
+        self.last_used = 0.0
+        self.reconnects = 0
+
+    def open(self):
+        imap = imaplib.IMAP4_SSL(self.imap_server)
+        try:
+            imap.login(self.email_address, self.password)
+        except Exception:
+            self.shutdown(imap)
+            raise
+        return imap
+
+    def get_retry_delay(self, attempt):
+        return min(self.max_backoff, self.backoff * 2 ** attempt) * (0.5 + random.random() / 2)
+
+    def connect(self):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.imap = self.open()
+                break
+            except CONNECTION_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise ConnectionError(f"Could not connect to {self.email_address} at {self.imap_server} "
+                                          f"after {attempt + 1} attempts: {e}") from e
+                delay = self.get_retry_delay(attempt)
+                logging.warning(f"Connecting to {self.email_address} failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+        if self.mailbox:
+            self.imap.select(self.mailbox)
+        self.last_used = time.monotonic()
+        return self.imap
+
+    def is_healthy(self):
+        try:
+            status, _ = self.imap.noop()
+            return status == "OK"
+        except CONNECTION_ERRORS + (imaplib.IMAP4.error,):
+            return False
+
+    def get(self):
+        """Returns a logged in connection, opening or re-establishing it when needed."""
+        if self.imap is None:
+            return self.connect()
+        if time.monotonic() - self.last_used > self.health_check_interval and not self.is_healthy():
+            logging.info(f"Connection to {self.email_address} is no longer alive, reconnecting")
+            return self.reconnect()
+        self.last_used = time.monotonic()
+        return self.imap
+
+    def select(self, mailbox):
+        # The mailbox is selected again after a reconnect
+        self.mailbox = mailbox
+        return self.get().select(mailbox)
+
+    def reconnect(self):
+        self.reconnects += 1
+        self.shutdown(self.imap)
+        self.imap = None
+        return self.connect()
+
+    @staticmethod
+    def shutdown(imap):
+        # Closing a broken connection must not fail
+        if imap is None:
+            return
+        try:
+            imap.logout()
+        except Exception:
+            try:
+                imap.shutdown()
+            except Exception:
+                pass
+
+    def close(self):
+        if self.imap is not None:
+            try:
+                if self.imap.state == "SELECTED":
+                    self.imap.close()
+            except Exception:
+                pass
+            self.shutdown(self.imap)
+            self.imap = None
+        self.mailbox = None
+
+
+class ImapConnectionPool:
+    """Reuses IMAP connections per server and account across imports.
+
+    A connection is used by one import at a time. It is returned to the pool after a successful import and closed
+    after a failed one. Connections are only opened when an import needs them.
+    """
+
+    def __init__(self, **connection_options):
+        self.connection_options = connection_options
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def connection(self, imap_server, email_address, password):
+        key = (imap_server, email_address)
+        with self.lock:
+            connections = self.idle.get(key)
+            connection = connections.pop() if connections else None
+        if connection is None:
+            connection = ImapConnection(imap_server, email_address, password, **self.connection_options)
+        try:
+            yield connection
+        except BaseException:
+            connection.close()
+            raise
+        with self.lock:
+            self.idle.setdefault(key, []).append(connection)
+
+    def close(self):
+        with self.lock:
+            connections = [connection for idle in self.idle.values() for connection in idle]
+            self.idle = {}
+        for connection in connections:
+            connection.close()
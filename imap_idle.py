@@ -0,0 +1,165 @@
+import imaplib
+import logging
+import re
+import select
+import threading
+import time
+
+# Untagged response announcing the new number of messages in the selected mailbox
+EXISTS_RESPONSE = re.compile(rb"^\* \d+ EXISTS\r?\n?$", re.IGNORECASE)
+
+
+class IdleConnection:
+    """IMAP IDLE (RFC 2177) on an imaplib connection, which has no IDLE support before Python 3.14."""
+
+    def __init__(self, imap, stopping, poll_interval=2.0):
+        self.imap = imap
+        self.stopping = stopping
+        # Longest time to wait on the socket before checking whether the listener is stopping
+        self.poll_interval = poll_interval
+
+    def readline(self):
+        line = self.imap.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("Connection closed by the server during IDLE")
+        return line
+
+    def has_data(self, timeout):
+        # True when a response can be read, waiting at most timeout seconds
+        sock = self.imap.sock
+        # imaplib reads through a buffered file, which may already hold the next line. A non-blocking peek returns
+        # it without reading from the socket, or reads what is available without consuming it.
+        previous_timeout = sock.gettimeout()
+        sock.setblocking(False)
+        try:
+            buffered = self.imap.file.peek(1)
+        except OSError:
+            buffered = b""
+        finally:
+            sock.settimeout(previous_timeout)
+        if buffered:
+            return True
+        # TLS may hold already decrypted data that select() does not see
+        if getattr(sock, "pending", None) and sock.pending():
+            return True
+        readable, _, _ = select.select([sock], [], [], timeout)
+        return bool(readable)
+
+    def check_line(self, line):
+        # Returns True for new messages, a BYE ends the connection
+        if line.upper().startswith(b"* BYE"):
+            raise imaplib.IMAP4.abort(f"Server closed the connection: {line!r}")
+        return bool(EXISTS_RESPONSE.match(line))
+
+    def idle(self, timeout):
+        """Wait in IDLE until new messages arrive, timeout passes or the listener stops.
+
+        Returns True when the server reported new messages.
+        """
+        tag = self.imap._new_tag()
+        self.imap.send(tag + b" IDLE\r\n")
+        exists = False
+        while True:
+            line = self.readline()
+            if line.startswith(b"+"):
+                break
+            if line.startswith(tag):
+                raise imaplib.IMAP4.error(f"IDLE rejected: {line!r}")
+            exists = self.check_line(line) or exists
+        try:
+            deadline = time.monotonic() + timeout
+            while not exists and not self.stopping.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if self.has_data(min(remaining, self.poll_interval)):
+                    exists = self.check_line(self.readline())
+        finally:
+            self.imap.send(b"DONE\r\n")
+        while True:
+            line = self.readline()
+            if line.startswith(tag):
+                break
+            exists = self.check_line(line) or exists
+        self.imap.tagged_commands.pop(tag, None)
+        if not line[len(tag):].strip().upper().startswith(b"OK"):
+            raise imaplib.IMAP4.error(f"IDLE failed: {line!r}")
+        return exists
+
+
+class ImapIdleListener:
+    """Imports new emails as soon as they arrive, with one connection in IDLE per account and mailbox.
+
+    Every mailbox is listened to in its own thread. After connecting, the messages that arrived since the last
+    import are imported, then the connection waits in IDLE. When the server reports new messages (EXISTS) only the
+    UIDs above the mailbox checkpoint are fetched. IDLE is renewed every keepalive seconds, well below the 29
+    minutes after which servers may drop it. A lost connection is re-established with exponential backoff.
+    Servers without IDLE are polled every keepalive seconds instead.
+    """
+
+    def __init__(self, importer, keepalive=300, max_backoff=300, on_import=None):
+        self.importer = importer
+        self.keepalive = keepalive
+        self.max_backoff = max_backoff
+        # Called after new messages were imported from a mailbox
+        self.on_import = on_import
+        self.stopping = threading.Event()
+        self.logger = logging.getLogger(__name__)
+
+    def run(self):
+        # Blocks until stop() is called
+        threads = []
+        for email_account in self.importer.email_accounts:
+            for mailbox in self.importer.get_mailboxes(email_account):
+                name = f"{email_account['account']['email_address']}/{mailbox}"
+                thread = threading.Thread(target=self.listen, args=(email_account, mailbox), name=f"idle-{name}",
+                                          daemon=True)
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+    def stop(self):
+        self.stopping.set()
+
+    def import_new(self, email_processor):
+        email_processor.process_emails()
+        if self.on_import:
+            self.on_import()
+
+    def listen(self, email_account, mailbox):
+        name = f"{email_account['account']['email_address']}/{mailbox}"
+        backoff = 1
+        while not self.stopping.is_set():
+            email_processor = self.importer.create_processor(email_account, mailbox)
+            try:
+                email_processor.connect()
+                # Messages that arrived while not connected
+                self.import_new(email_processor)
+                idle_supported = "IDLE" in email_processor.imap.capabilities
+                if not idle_supported:
+                    self.logger.warning("%s does not support IDLE, polling every %ds", name, self.keepalive)
+                self.logger.info("Listening for new emails in %s", name)
+                backoff = 1
+                while not self.stopping.is_set():
+                    if idle_supported:
+                        # An import may have re-established the connection, IDLE always runs on the current one
+                        connection = IdleConnection(email_processor.connection.get(), self.stopping)
+                        arrived = connection.idle(self.keepalive)
+                    else:
+                        arrived = not self.stopping.wait(self.keepalive)
+                        email_processor.imap.noop()
+                    if arrived:
+                        self.logger.info("New emails in %s", name)
+                        self.import_new(email_processor)
+            except Exception as e:
+                if self.stopping.is_set():
+                    break
+                self.logger.warning("Connection to %s lost (%s), reconnecting in %ds", name, e, backoff)
+                self.stopping.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+            finally:
+                try:
+                    email_processor.close_connection()
+                except Exception:
+                    pass
@@ -0,0 +1,205 @@
+import base64
+import quopri
+import re
+from email.header import decode_header, make_header
+from email.utils import decode_rfc2231
+from itertools import takewhile
+from urllib.parse import unquote
+
+LITERAL_RE = re.compile(rb"\{(\d+)\}$")
+
+
+def _to_str(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="replace")
+    return value
+
+
+def _chunks(data):
+    # imaplib returns literals as (prefix, literal) tuples, everything else as plain bytes
+    for item in data:
+        if isinstance(item, tuple):
+            prefix, literal = item
+            match = LITERAL_RE.search(prefix)
+            yield "text", prefix[:match.start()] if match else prefix
+            yield "literal", literal
+        elif item:
+            yield "text", item
+
+
+def _tokenize(data):
+    tokens = []
+    for kind, chunk in _chunks(data):
+        if kind == "literal":
+            tokens.append(chunk)
+            continue
+        i = 0
+        length = len(chunk)
+        while i < length:
+            char = chunk[i:i + 1]
+            if char in (b" ", b"\r", b"\n"):
+                i += 1
+            elif char in (b"(", b")"):
+                tokens.append(char.decode())
+                i += 1
+            elif char == b'"':
+                i += 1
+                value = bytearray()
+                while i < length and chunk[i:i + 1] != b'"':
+                    if chunk[i:i + 1] == b"\\":
+                        i += 1
+                    value += chunk[i:i + 1]
+                    i += 1
+                tokens.append(bytes(value))
+                i += 1
+            else:
+                start = i
+                depth = 0
+                while i < length:
+                    char = chunk[i:i + 1]
+                    if char == b"[":
+                        depth += 1
+                    elif char == b"]":
+                        depth -= 1
+                    elif depth == 0 and char in (b" ", b"(", b")", b"\r", b"\n"):
+                        break
+                    i += 1
+                atom = chunk[start:i].decode("ascii", errors="replace")
+                tokens.append(None if atom.upper() == "NIL" else atom)
+    return tokens
+
+
+def _parse_list(tokens, pos):
+    items = []
+    while pos < len(tokens):
+        token = tokens[pos]
+        if token == "(":
+            value, pos = _parse_list(tokens, pos + 1)
+            items.append(value)
+        elif token == ")":
+            return items, pos + 1
+        else:
+            items.append(token)
+            pos += 1
+    return items, pos
+
+
+def parse_fetch_response(data):
+    """Parse the data of an imaplib FETCH into a list of {item name: value} dicts, one per message."""
+    items, _ = _parse_list(_tokenize(data), 0)
+    messages = []
+    # Every untagged response is "<sequence number> (<name> <value> ...)"
+    for i in range(0, len(items) - 1, 2):
+        values = items[i + 1]
+        if not isinstance(values, list):
+            continue
+        messages.append({str(values[j]).upper(): values[j + 1] for j in range(0, len(values) - 1, 2)})
+    return messages
+
+
+def _params(value):
+    if not isinstance(value, list):
+        return {}
+    return {_to_str(value[i]).lower(): _to_str(value[i + 1]) for i in range(0, len(value) - 1, 2)}
+
+
+def _header_value(value):
+    try:
+        return str(make_header(decode_header(value)))
+    except Exception:
+        return value
+
+
+def _filename(params):
+    if "filename*" in params:
+        charset, _, value = decode_rfc2231(params["filename*"])
+        return unquote(value, encoding=charset or "utf-8", errors="replace")
+    for name in ("filename", "name"):
+        if params.get(name):
+            return _header_value(params[name])
+    return None
+
+
+def _is_multipart(body):
+    return isinstance(body, list) and bool(body) and isinstance(body[0], list)
+
+
+def get_body_parts(bodystructure, section=None):
+    """Flatten a BODYSTRUCTURE into leaf parts with their IMAP section numbers."""
+    if section is None:
+        section = "" if _is_multipart(bodystructure) else "1"
+    if _is_multipart(bodystructure):
+        parts = []
+        # Child parts come first, followed by the subtype and extension data
+        for i, child in enumerate(takewhile(lambda c: isinstance(c, list), bodystructure)):
+            child_section = f"{section}.{i + 1}" if section else str(i + 1)
+            parts.extend(get_body_parts(child, child_section))
+        return parts
+
+    content_type = f"{_to_str(bodystructure[0])}/{_to_str(bodystructure[1])}".lower()
+    params = _params(bodystructure[2])
+    # Extension data follows the type specific fields
+    if content_type.startswith("text/"):
+        extension = 8
+    elif content_type == "message/rfc822":
+        extension = 10
+    else:
+        extension = 7
+    disposition = None
+    disposition_params = {}
+    if len(bodystructure) > extension + 1 and isinstance(bodystructure[extension + 1], list):
+        disposition = _to_str(bodystructure[extension + 1][0]).lower()
+        disposition_params = _params(bodystructure[extension + 1][1])
+
+    parts = [{
+        "section": section,
+        "content_type": content_type,
+        "charset": params.get("charset"),
+        "encoding": (_to_str(bodystructure[5]) or "7bit").lower(),
+        "size": int(bodystructure[6]) if bodystructure[6] else 0,
+        "disposition": disposition,
+        "filename": _filename(disposition_params) or _filename(params),
+    }]
+    # Attachments inside forwarded messages are numbered below the message part
+    if content_type == "message/rfc822" and len(bodystructure) > 8 and isinstance(bodystructure[8], list):
+        inner = bodystructure[8]
+        parts.extend(get_body_parts(inner, section if _is_multipart(inner) else f"{section}.1"))
+    return parts
+
+
+def decode_part(data, encoding):
+    if data is None:
+        return b""
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    if encoding == "base64":
+        return base64.b64decode(data)
+    if encoding == "quoted-printable":
+        return quopri.decodestring(data)
+    return data
+
+
+class IncrementalDecoder:
+    """Decodes a transfer-encoded part chunk by chunk, keeping only an incomplete tail between chunks."""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.pending = b""
+
+    def feed(self, data):
+        if self.encoding == "base64":
+            self.pending += b"".join(data.split())
+            complete = len(self.pending) // 4 * 4
+            data, self.pending = self.pending[:complete], self.pending[complete:]
+            return base64.b64decode(data)
+        if self.encoding == "quoted-printable":
+            # Soft line breaks and escapes never span a newline
+            self.pending += data
+            end = self.pending.rfind(b"\n") + 1
+            data, self.pending = self.pending[:end], self.pending[end:]
+            return quopri.decodestring(data)
+        return data
+
+    def finish(self):
+        data, self.pending = self.pending, b""
+        return decode_part(data, self.encoding) if data else b""
@@ -5,7 +5,20 @@ year=2024
 start_month=8
 
 # Base API URL
-api_url="http://discovery.rlt.sk:7667/api/import_email"
+base_url="http://discovery.rlt.sk:7667/api"
+api_url="$base_url/import_email"
+
+# Seconds between two status requests of a running import job
+poll_interval=10
+
+# Print the value of a field of the JSON read from stdin, e.g. json_field job_id or json_field job status
+json_field() {
+  python3 -c 'import json, sys
+value = json.load(sys.stdin)
+for key in sys.argv[1:]:
+    value = value.get(key) if isinstance(value, dict) else None
+print("" if value is None else value)' "$@"
+}
 
 # Iterate through months from start_month to January (1)
 for ((month=start_month; month>=1; month--)); do
@@ -22,8 +35,32 @@ for ((month=start_month; month>=1; month--)); do
   # Output the response
   echo "Response for $year-$formatted_month: $curl_response"
 
-  # Optional: Add a sleep time if needed to avoid rate-limiting
-  # sleep 1
+  # The import runs as a background job, wait until it is done before the next month is started
+  job_id=$(echo "$curl_response" | json_field job_id 2>/dev/null)
+  if [ -z "$job_id" ]; then
+    echo "No job was started for $year-$formatted_month, stopping."
+    exit 1
+  fi
+  while true; do
+    job_response=$(curl -s "$base_url/jobs/$job_id")
+    status=$(echo "$job_response" | json_field job status 2>/dev/null)
+    case "$status" in
+      succeeded)
+        echo "Import of $year-$formatted_month finished."
+        break
+        ;;
+      failed|cancelled)
+        echo "Import of $year-$formatted_month $status: $(echo "$job_response" | json_field job message 2>/dev/null)"
+        exit 1
+        ;;
+      *)
+        # queued, running, or the API did not answer
+        echo "Import of $year-$formatted_month: ${status:-no answer}," \
+          "$(echo "$job_response" | json_field job processed 2>/dev/null) emails processed"
+        sleep "$poll_interval"
+        ;;
+    esac
+  done
 done
 
-echo "Finished processing all months."
\ No newline at end of file
+echo "Finished processing all months."
@@ -0,0 +1,237 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from db_email import Job, JOB_QUEUED, JOB_RUNNING, JOB_SUCCEEDED, JOB_FAILED, JOB_CANCELLED
+
+
+class JobCancelled(Exception):
+    """Raised inside a job once its cancellation was requested."""
+
+
+class JobProgress:
+    """Progress callback passed to a job function as progress(processed, total).
+
+    The progress is written to the jobs table at most every update_interval seconds. Once a cancellation was
+    requested the next call raises JobCancelled, so the job stops at the next point where it reports progress.
+    """
+
+    def __init__(self, manager, job_id):
+        self.manager = manager
+        self.job_id = job_id
+        self.lock = threading.Lock()
+        self.last_update = 0.0
+        self.cancelled = False
+
+    def __call__(self, processed, total=None):
+        with self.lock:
+            if self.cancelled:
+                raise JobCancelled()
+            now = time.monotonic()
+            if now - self.last_update < self.manager.update_interval:
+                return
+            self.last_update = now
+            with self.manager.db.get_new_session() as session:
+                job = Job.get(session, self.job_id)
+                job.processed = processed
+                if total is not None:
+                    job.total = total
+                job.updated_at = datetime.now()
+                self.cancelled = bool(job.cancel_requested)
+                session.commit()
+            if self.cancelled:
+                raise JobCancelled()
+
+
+class JobManager:
+    """Runs API jobs in background threads and keeps their status in the jobs table.
+
+    Every API worker process has its own manager, the jobs table is shared: any worker can report on or cancel
+    a job, and only one job per key (e.g. the import of one account and month) runs at a time. Submitting a job
+    while one with the same key is active returns the active job instead. Pipeline stages run through
+    run_exclusive with the same keys, so they never duplicate the work of an API job.
+    """
+
+    def __init__(self, db, workers=2, update_interval=1.0, stale_after=900):
+        self.db = db
+        self.workers = max(1, workers)
+        self.update_interval = update_interval
+        # An active job not updated for this many seconds belongs to a worker that died, its key is released
+        self.stale_after = stale_after
+        self.executor = None
+        self.heartbeat_started = False
+        # Jobs of this process that are queued or running
+        self.running = set()
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="job")
+            self.start_heartbeat()
+            return self.executor
+
+    def start_heartbeat(self):
+        # Called with the lock held
+        if not self.heartbeat_started:
+            self.heartbeat_started = True
+            threading.Thread(target=self.heartbeat, name="job-heartbeat", daemon=True).start()
+
+    def heartbeat(self):
+        while True:
+            time.sleep(self.stale_after / 3)
+            with self.lock:
+                job_ids = list(self.running)
+            try:
+                with self.db.get_new_session() as session:
+                    Job.touch(session, job_ids)
+            except Exception as e:
+                self.logger.warning("Could not update running jobs: %s", e)
+
+    def submit(self, kind, key, function, **params):
+        """Start function(progress=..., **params) as a job, returns (job, created).
+
+        When a job with the same key is already active that job is returned with created False.
+        """
+        executor = self.get_executor()
+        job, created = self.create(kind, key, params)
+        if not created:
+            return job, False
+        # Queued jobs get the heartbeat as well, so a job waiting for a free thread is not taken for abandoned
+        with self.lock:
+            self.running.add(job['id'])
+        executor.submit(self.run, job['id'], function, params)
+        return job, True
+
+    def run_exclusive(self, kind, key, function, default=None):
+        """Run function() in the calling thread as a job holding key and return its result.
+
+        While a job with the same key is active function is not run and default is returned, the active job
+        does the work. Exceptions of function are recorded on the job and raised, the job of a successful run is
+        removed again so frequent runs do not fill the jobs table.
+        """
+        job, created = self.create(kind, key, {})
+        if not created:
+            self.logger.info("Skipping %s, job %s with key %s is active", kind, job['id'], key)
+            return default
+        job_id = job['id']
+        with self.lock:
+            self.running.add(job_id)
+            self.start_heartbeat()
+        status, message = JOB_SUCCEEDED, None
+        try:
+            with self.db.get_new_session() as session:
+                Job.get(session, job_id).start()
+                session.commit()
+            return function()
+        except Exception as e:
+            status, message = JOB_FAILED, str(e)
+            raise
+        finally:
+            with self.db.get_new_session() as session:
+                job = Job.get(session, job_id)
+                if status == JOB_SUCCEEDED:
+                    session.delete(job)
+                else:
+                    job.finish(status, message)
+                session.commit()
+            with self.lock:
+                self.running.discard(job_id)
+
+    def create(self, kind, key, params):
+        # Returns (job, created), the active job with created False when the key is taken
+        with self.db.get_new_session() as session:
+            for attempt in range(2):
+                job = Job.create(session, str(uuid.uuid4()), kind, key, json.dumps(params))
+                if job is not None:
+                    return self.to_dict(job), True
+                active = Job.get_active(session, key)
+                if active is None:
+                    continue  # It finished in the meantime
+                if active.updated_at and active.updated_at < datetime.now() - timedelta(seconds=self.stale_after):
+                    self.logger.warning("Job %s of %s was abandoned, starting a new one", active.id, key)
+                    active.finish(JOB_FAILED, "Abandoned, the worker running it stopped")
+                    session.commit()
+                    continue
+                return self.to_dict(active), False
+            raise RuntimeError(f"Could not start a job for {key}")
+
+    def run(self, job_id, function, params):
+        try:
+            with self.db.get_new_session() as session:
+                job = Job.get(session, job_id)
+                if job.status != JOB_QUEUED or job.active_key is None:
+                    # Released as abandoned while it was waiting, a newer job does the work
+                    self.logger.warning("Job %s is no longer queued (%s), skipping it", job_id, job.status)
+                    return
+                if job.cancel_requested:
+                    job.finish(JOB_CANCELLED, "Cancelled before it started")
+                    session.commit()
+                    return
+                job.start()
+                session.commit()
+            status, message = JOB_SUCCEEDED, None
+            try:
+                function(progress=JobProgress(self, job_id), **params)
+            except JobCancelled:
+                status, message = JOB_CANCELLED, "Cancelled"
+            except Exception as e:
+                self.logger.exception("Job %s failed: %s", job_id, e)
+                status, message = JOB_FAILED, str(e)
+            with self.db.get_new_session() as session:
+                job = Job.get(session, job_id)
+                if status == JOB_SUCCEEDED and job.cancel_requested:
+                    status, message = JOB_CANCELLED, "Cancelled"
+                if status == JOB_SUCCEEDED and job.total is not None:
+                    job.processed = job.total
+                job.finish(status, message)
+                session.commit()
+        finally:
+            with self.lock:
+                self.running.discard(job_id)
+
+    def get(self, job_id):
+        with self.db.get_new_session() as session:
+            job = Job.get(session, job_id)
+            return self.to_dict(job) if job else None
+
+    def cancel(self, job_id):
+        # Returns the job, which stops the next time it reports progress, or None when it does not exist
+        with self.db.get_new_session() as session:
+            job = Job.get(session, job_id)
+            if job is None:
+                return None
+            if job.status in (JOB_QUEUED, JOB_RUNNING):
+                job.cancel_requested = True
+                session.commit()
+            return self.to_dict(job)
+
+    @staticmethod
+    def to_dict(job):
+        rate = eta = None
+        if job.started_at and job.processed:
+            elapsed = ((job.finished_at or datetime.now()) - job.started_at).total_seconds()
+            if elapsed > 0:
+                rate = job.processed / elapsed
+                if job.total is not None and job.status == JOB_RUNNING:
+                    eta = max(0, job.total - job.processed) / rate
+        return {
+            'id': job.id,
+            'kind': job.kind,
+            'params': json.loads(job.params) if job.params else {},
+            'status': job.status,
+            'processed': job.processed,
+            'total': job.total,
+            'rate': round(rate, 2) if rate is not None else None,
+            'eta_seconds': round(eta) if eta is not None else None,
+            'message': job.message,
+            'cancel_requested': bool(job.cancel_requested),
+            'created_at': job.created_at.isoformat() if job.created_at else None,
+            'started_at': job.started_at.isoformat() if job.started_at else None,
+            'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+        }
@@ -1,13 +1,22 @@
 import asyncio
 import logging
 import os
+import signal
 from logging.handlers import RotatingFileHandler
-from time import sleep
 
 from config_loader import load_config
+from db_email import Db
 from email_exporter import EmailOrganizer
 from email_procesor import ImportEmails
+from imap_idle import ImapIdleListener
+from jobs import JobManager
 from organization import OrganizationDetector
+from pipeline import PipelineScheduler
+
+
+def import_job_key(email_address=None, year=None, month=None):
+    # Only one import of an account and month runs at a time, the pipeline imports all accounts and months
+    return f"import_email:{email_address or '*'}:{year}:{month}"
 
 
 class Main:
@@ -39,35 +48,139 @@ class Main:
         logger.addHandler(console_handler)
         logger.addHandler(file_handler)
 
-        self.importer = ImportEmails(self.config["emails"], self.config["save_path"], self.config["database_url"])
+        self.importer = ImportEmails(self.config["emails"], self.config["save_path"], self.config["database_url"],
+                                     concurrency=self.config.get('import_concurrency', 1),
+                                     connections_per_server=self.config.get('import_connections_per_server'),
+                                     write_batch_size=self.config.get('db_write_batch_size', 100),
+                                     write_flush_interval_ms=self.config.get('db_flush_interval_ms', 1000),
+                                     imap_max_retries=self.config.get('imap_max_retries', 5),
+                                     imap_max_backoff=self.config.get('imap_reconnect_max_backoff', 300),
+                                     imap_health_check_interval=self.config.get('imap_health_check_interval', 60))
         self.detector = OrganizationDetector(self.config["database_url"], self.config['open_api_key'],
-                                             self.config['pdf_passwords'])
+                                             self.config['pdf_passwords'],
+                                             write_decrypted_pdfs=self.config.get('pdf_write_decrypted', True),
+                                             pdf_text_budget=self.config.get('pdf_text_budget'),
+                                             pdf_max_pages=self.config.get('pdf_max_pages', 5),
+                                             pdf_timeout=self.config.get('pdf_timeout', 60),
+                                             pdf_worker_memory_mb=self.config.get('pdf_worker_memory_mb', 1024),
+                                             pdf_max_attempts=self.config.get('pdf_max_attempts', 3),
+                                             openai_model=self.config.get('openai_model', 'gpt-4o-mini'),
+                                             openai_base_url=self.config.get('openai_base_url'),
+                                             classification_concurrency=self.config.get(
+                                                 'classification_concurrency', 1),
+                                             openai_requests_per_minute=self.config.get(
+                                                 'openai_requests_per_minute', 500),
+                                             openai_tokens_per_minute=self.config.get(
+                                                 'openai_tokens_per_minute', 200000),
+                                             openai_max_retries=self.config.get('openai_max_retries', 5),
+                                             openai_batch_poll_interval=self.config.get(
+                                                 'openai_batch_poll_interval', 60),
+                                             classification_cache_backend=self.config.get(
+                                                 'classification_cache_backend', 'db'),
+                                             classification_cache_ttl_days=self.config.get(
+                                                 'classification_cache_ttl_days', 180),
+                                             classification_cache_max_entries=self.config.get(
+                                                 'classification_cache_max_entries', 10000),
+                                             classification_cache_memory_entries=self.config.get(
+                                                 'classification_cache_memory_entries', 1000),
+                                             known_organizations=self.config.get('known_organizations'),
+                                             org_match_threshold=self.config.get('org_match_threshold', 0.85),
+                                             prompt_max_tokens=self.config.get('prompt_max_tokens', 1000),
+                                             prompt_body_max_tokens=self.config.get('prompt_body_max_tokens', 200))
         self.organizer = EmailOrganizer(self.config["database_url"], self.config["base_dir"],
-                                        self.config["root_folder_id"], self.config["settings_file"])
-
-    def import_email(self, year=None, month=None):
-        self.importer.import_emails(year=year, month=month)
-
-    def detect_organization(self):
-        self.detector.update_emails_with_organization()
-
-    def organize_email(self):
-        self.organizer.organize_and_upload(self.config.get('batch_size', 10))
+                                        self.config["root_folder_id"], self.config["settings_file"],
+                                        upload_workers=self.config.get('upload_workers', 4),
+                                        upload_chunk_size_mb=self.config.get('upload_chunk_size_mb', 8),
+                                        upload_max_retries=self.config.get('upload_max_retries', 5),
+                                        upload_commit_every=self.config.get('upload_commit_every', 20))
+        # Jobs started through the API run in the background, one per job key across all API workers
+        self.jobs = JobManager(Db(self.config["database_url"]), workers=self.config.get('job_workers', 2),
+                               stale_after=self.config.get('job_stale_after', 900))
+
+    def import_email(self, year=None, month=None, email_address=None, progress=None):
+        self.importer.import_emails(year=year, month=month, email_address=email_address, progress=progress)
+
+    def detect_organization(self, batch=None, progress=None):
+        if batch is None:
+            batch = self.config.get('classification_mode') == 'batch'
+        if batch:
+            self.detector.classify_in_batches(progress=progress)
+        else:
+            self.detector.update_emails_with_organization(progress=progress)
+
+    def organize_email(self, progress=None):
+        # The upload holds the key of the pipeline upload stage, so the two never upload the same files
+        batch_size = self.config.get('batch_size', 10)
+        self.organizer.categorize_emails(batch_size)
+        self.jobs.run_exclusive('upload_emails', 'upload_emails',
+                                lambda: self.organizer.upload_organized(batch_size, progress=progress))
+
+    def extract_texts(self):
+        return self.detector.extract_pending_texts()
+
+    def categorize_emails(self):
+        # Organize up to organize_cycle_limit classified emails, returns the number of emails visited
+        return self.organizer.categorize_emails(self.config.get('batch_size', 10),
+                                                limit=self.config.get('organize_cycle_limit', 1000))
+
+    def upload_emails(self):
+        return self.organizer.upload_organized(self.config.get('batch_size', 10))
+
+    def exclusive(self, kind, key, function):
+        # A pipeline run holds the key of the API job doing the same work, it is skipped while that job is active
+        return lambda: self.jobs.run_exclusive(kind, key, function, default=0)
+
+    def create_pipeline(self):
+        # New mail flows through all stages, each stage also runs on its own interval
+        interval = self.config.get('background_interval', 60)
+        return PipelineScheduler([
+            ('import', self.exclusive('pipeline_import', import_job_key(), self.import_email),
+             self.config.get('import_interval', 300)),
+            ('extract', self.extract_texts, self.config.get('extract_interval', interval)),
+            ('classify', self.exclusive('pipeline_classify', 'detect_organization', self.detect_organization),
+             self.config.get('classify_interval', interval)),
+            ('organize', self.exclusive('pipeline_organize', 'organize_email', self.categorize_emails),
+             self.config.get('organize_interval', interval)),
+            ('upload', self.exclusive('pipeline_upload', 'upload_emails', self.upload_emails),
+             self.config.get('upload_interval', interval)),
+        ], queue_size=self.config.get('pipeline_queue_size', 2))
+
+    def close(self):
+        # Releases the IMAP connections and PDF workers kept between runs
+        self.importer.close()
+        if self.detector.extraction_pool:
+            self.detector.extraction_pool.shutdown()
+
+    def create_idle_listener(self, on_import=None):
+        return ImapIdleListener(self.importer, keepalive=self.config.get('imap_idle_keepalive', 300),
+                                max_backoff=self.config.get('imap_reconnect_max_backoff', 300), on_import=on_import)
 
 
 main = Main()
 
 
-async def background_task():
-    while True:
-        logging.info("Background job running...")
-        main.organize_email()
-
-        interval = main.config.get('background_interval', 60)
-        logging.info("Waiting for %d seconds before running the background job again...", interval)
-        sleep(interval)
-
-
 async def run():
-    asyncio.create_task(background_task())  # Start background task
-    logging.info("Background task started.")
+    # Only the pipeline process extracts PDFs in worker processes, API workers extract in their job threads
+    main.detector.start_extraction_pool(main.config.get('pdf_workers'))
+    pipeline = main.create_pipeline()
+    loop = asyncio.get_running_loop()
+    tasks = [pipeline.run()]
+    listener = None
+    if main.config.get('imap_idle', False):
+        # New mail is imported as soon as it arrives and continues through the pipeline right away
+        listener = main.create_idle_listener(
+            on_import=lambda: loop.call_soon_threadsafe(pipeline.trigger, 'extract'))
+        tasks.append(loop.run_in_executor(None, listener.run))
+
+    def stop():
+        pipeline.stop()
+        if listener:
+            listener.stop()
+
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stop)
+    logging.info("Pipeline started.")
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        main.close()
@@ -1,34 +1,62 @@
 from flask import Blueprint, jsonify, request
 
-from main import main
+from main import main, import_job_key
 
 # Create a Flask Blueprint
 main_bp = Blueprint('main_bp', __name__)
 
+
+def job_response(job, created):
+    # Long-running endpoints answer right away with the job, a duplicate request gets the job already running
+    message = 'Job started.' if created else 'A job for the same work is already running.'
+    return jsonify({'status': 'accepted', 'message': message, 'job_id': job['id'], 'coalesced': not created,
+                    'job': job}), 202
+
 @main_bp.route('/import_email', methods=['POST'])
 def import_email():
     try:
-        year = request.json.get('year', None)
-        month = request.json.get('month', None)
-        main.import_email(year=year, month=month)
-        return jsonify({'status': 'success', 'message': 'Emails imported successfully.'}), 200
+        params = request.get_json(silent=True) or {}
+        year = params.get('year', None)
+        month = params.get('month', None)
+        email_address = params.get('email_address', None)
+        job, created = main.jobs.submit('import_email', import_job_key(email_address, year, month),
+                                        main.import_email, year=year, month=month, email_address=email_address)
+        return job_response(job, created)
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 @main_bp.route('/detect_organization', methods=['POST'])
 def detect_organization():
     try:
-        main.detect_organization()
-        return jsonify({'status': 'success', 'message': 'Organizations detected successfully.'}), 200
+        batch = (request.get_json(silent=True) or {}).get('batch', None)
+        job, created = main.jobs.submit('detect_organization', 'detect_organization', main.detect_organization,
+                                        batch=batch)
+        return job_response(job, created)
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+@main_bp.route('/classification_stats', methods=['GET'])
+def classification_stats():
+    return jsonify({'status': 'success', 'stats': main.detector.get_stats()}), 200
+
 @main_bp.route('/organize_email', methods=['POST'])
 def organize_email():
     try:
-        main.organize_email()
-        return jsonify({'status': 'success', 'message': 'Emails organized and uploaded to Google Drive successfully.'}), 200
+        job, created = main.jobs.submit('organize_email', 'organize_email', main.organize_email)
+        return job_response(job, created)
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+@main_bp.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = main.jobs.get(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': f'Job {job_id} not found.'}), 404
+    return jsonify({'status': 'success', 'job': job}), 200
 
+@main_bp.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    job = main.jobs.cancel(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': f'Job {job_id} not found.'}), 404
+    return jsonify({'status': 'success', 'message': 'Cancellation requested.', 'job': job}), 200
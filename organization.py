@@ -1,32 +1,90 @@
+import itertools
 import json
 import os
+from collections import Counter
 
 import PyPDF2
 import openai
 from PyPDF2.errors import PdfReadError
-from openai import OpenAI
-from sqlalchemy import and_
+from openai import AsyncOpenAI, OpenAI
+from sqlalchemy import and_, or_
 
-from db_email import Db, ImportedEmail
-from pdf_processor import PDFProcessor
+from db_email import Db, ImportedEmail, ExtractedText, ClassificationBatch, ClassificationStat, STATE_IMPORTED, \
+    STATE_TEXT_EXTRACTED, STATE_CLASSIFIED, STATE_EXTRACTION_FAILED
+from classification_cache import ClassificationCache
+from classification_engine import BatchClassifier, ClassificationEngine
+from organization_matcher import OrganizationMatcher
+from prompt_builder import PromptBuilder
+from pdf_processor import PDFProcessor, PDFExtractionPool
+
+# Characters of PDF text extracted per character that fits the prompt
+PDF_TEXT_OVERSAMPLING = 4
+# Batch requests of attachments without a hash are identified by the email id with this prefix
+EMAIL_CUSTOM_ID_PREFIX = "email-"
 
 
 class OrganizationDetector:
-    def __init__(self, db_url='sqlite:///emails.db', openai_api_key='your_openai_api_key', pdf_passwords=None):
+    def __init__(self, db_url='sqlite:///emails.db', openai_api_key='your_openai_api_key', pdf_passwords=None,
+                 write_decrypted_pdfs=False, pdf_text_budget=None, pdf_max_pages=5, pdf_workers=0,
+                 pdf_timeout=60, pdf_worker_memory_mb=1024, pdf_max_attempts=3, openai_model="gpt-4o-mini", openai_base_url=None,
+                 classification_concurrency=1, openai_requests_per_minute=500, openai_tokens_per_minute=200000,
+                 openai_max_retries=5, classification_commit_every=20, batch_client=None,
+                 openai_batch_poll_interval=60, classification_cache_backend="db", classification_cache_ttl_days=180,
+                 classification_cache_max_entries=10000, classification_cache_memory_entries=1000,
+                 known_organizations=None, org_match_threshold=0.85, prompt_max_tokens=1000, prompt_body_max_tokens=200):
         self.db = Db(db_url)
         openai.api_key = openai_api_key
-        self.client = OpenAI(api_key=openai_api_key)
+        # openai_base_url points the clients to another endpoint, e.g. fake_openai_server.py for offline testing
+        self.client = OpenAI(api_key=openai_api_key, base_url=openai_base_url)
+        self.openai_model = openai_model
+        # With a concurrency above 1 emails are classified concurrently on the async client
+        self.classification_engine = None
+        if classification_concurrency > 1:
+            self.classification_engine = ClassificationEngine(
+                lambda: AsyncOpenAI(api_key=openai_api_key, base_url=openai_base_url, max_retries=0),
+                model=openai_model, concurrency=classification_concurrency,
+                requests_per_minute=openai_requests_per_minute, tokens_per_minute=openai_tokens_per_minute,
+                max_retries=openai_max_retries)
+        self.classification_commit_every = classification_commit_every
+        # Backfills can be classified with the Batch API, batch_client replaces the OpenAI client for it
+        self.batch_classifier = BatchClassifier(batch_client or self.client, model=openai_model,
+                                                poll_interval=openai_batch_poll_interval)
+        # Known organizations are recognized locally, only the others are classified by the LLM
+        self.org_matcher = OrganizationMatcher(known_organizations, threshold=org_match_threshold)
         self.pdf_passwords = pdf_passwords if pdf_passwords else []
-        self.organization_cache = {}
-        self.pdf_processor = PDFProcessor(pdf_passwords)
+        # Results by sender address and domain, so repeat senders are not classified again
+        self.classification_cache = ClassificationCache(use_db=classification_cache_backend == "db",
+                                                        ttl_days=classification_cache_ttl_days,
+                                                        max_entries=classification_cache_max_entries,
+                                                        memory_entries=classification_cache_memory_entries)
+        # Cache and matcher counters already added to the classification_stats table by this process
+        self.recorded_stats = Counter()
+        self.pdf_processor = PDFProcessor(pdf_passwords, write_decrypted=write_decrypted_pdfs)
+        # Extraction stops once this much PDF text is available, the prompt builder selects the relevant lines
+        # of it within the prompt token budget. By default several times the text that fits the prompt (about four
+        # characters per token) is extracted, so there are supplier and totals lines left to select from.
+        self.pdf_text_budget = pdf_text_budget or prompt_max_tokens * 4 * PDF_TEXT_OVERSAMPLING
+        self.prompt_builder = PromptBuilder(openai_model, max_prompt_tokens=prompt_max_tokens,
+                                            max_body_tokens=prompt_body_max_tokens)
+        self.pdf_max_pages = pdf_max_pages
+        # Attachments without text after this many extractions are moved to the extraction_failed state
+        self.pdf_max_attempts = pdf_max_attempts
+        # PDFs are extracted in the calling thread unless pdf_workers is not 0 or start_extraction_pool is called
+        self.pdf_timeout = pdf_timeout
+        self.pdf_worker_memory_mb = pdf_worker_memory_mb
+        self.extraction_pool = None
+        if pdf_workers != 0:
+            self.start_extraction_pool(pdf_workers)
 
-    def get_emails_with_pdf_attachments(self):
-        with self.db.get_session() as session:
-            emails = session.query(ImportedEmail).filter(
-                and_(ImportedEmail.has_attachment == True, ImportedEmail.attachment_path.like('%.pdf'),
-                     ImportedEmail.sender_organisation == None)
-            ).all()
-            return emails
+    def start_extraction_pool(self, workers=None):
+        # Extract PDFs in parallel worker processes, one per CPU unless workers is set, 0 keeps them in the thread
+        if workers != 0 and self.extraction_pool is None:
+            self.extraction_pool = PDFExtractionPool(self.pdf_processor, workers=workers, timeout=self.pdf_timeout,
+                                                     memory_limit_mb=self.pdf_worker_memory_mb)
+
+    def get_emails_with_pdf_attachments(self, session, after_id=0, limit=100):
+        # Emails whose PDF attachment has not been classified yet
+        return ImportedEmail.get_batch_by_state(session, [STATE_IMPORTED, STATE_TEXT_EXTRACTED], after_id, limit)
 
     def extract_text_from_pdf(self, pdf_path):
         text = ""
@@ -52,25 +110,19 @@ class OrganizationDetector:
             print(f"Error reading PDF {pdf_path}: {e}")
         return text
 
+    def build_prompt(self, email_from, text, body):
+        # Returns the messages and their token count
+        return self.prompt_builder.build(email_from, text, body)
+
     def detect_organization_and_spam(self, email_from, text, body):
+        messages, _ = self.build_prompt(email_from, text, body)
+        return self.request_classification(messages)
+
+    def request_classification(self, messages):
         try:
             response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "You will receive PDF content and sender information. "
-                                   "Extract the organization name and determine if the email is spam or not and "
-                                   "determine probability that PDF content is invoice "
-                                   "('DANOVE PRIZNANIE' is not invoice) "
-                                   "promotional in JSON format: "
-                                   "{ \"organization\": \"XYZ\", spam: \"No\", \"invoice\": 0.8 }"
-                    },
-                    {
-                        "role": "user",
-                        "content": f"Sender: {email_from}\nEmail body: {body}\nPDF content: {text[:2000]}"
-                    },
-                ],
+                model=self.openai_model,
+                messages=messages,
                 max_tokens=100
             )
             return response.choices[0].message.content
@@ -78,61 +130,403 @@ class OrganizationDetector:
             print(f"Error detecting organization and spam status: {e}")
             return None
 
-    def update_emails_with_organization(self):
-        emails = self.get_emails_with_pdf_attachments()
+    def get_results_by_hash(self, session, attachment_hashes):
+        # Attachments that were already classified for another email are not extracted and classified again
+        if not attachment_hashes:
+            return {}
+        emails = session.query(ImportedEmail).filter(
+            and_(ImportedEmail.attachment_hash.in_(list(attachment_hashes)), ImportedEmail.sender_organisation != None)
+        ).all()
+        return {email.attachment_hash: {
+            'organization': email.sender_organisation,
+            'is_spam': email.is_spam,
+            'is_invoice': email.is_invoice
+        } for email in emails}
+
+    def update_emails_with_organization(self, page_size=100, progress=None):
+        # progress is called with (processed, total) after every committed page
         with self.db.get_session() as session:
+            self.org_matcher.load(session)
+            results_by_hash = {}
+            after_id = 0
+            processed = 0
+            total = ImportedEmail.count_by_state(session, [STATE_IMPORTED, STATE_TEXT_EXTRACTED]) if progress else None
+            while True:
+                emails = self.get_emails_with_pdf_attachments(session, after_id, page_size)
+                if not emails:
+                    break
+                after_id = emails[-1].id
+                pending, hashes, extractions, pdf_paths = self.get_pending(session, emails, results_by_hash)
+                if self.classification_engine:
+                    self.classify_concurrently(session, pending, hashes, extractions, pdf_paths, results_by_hash)
+                else:
+                    for key, extraction in itertools.chain(extractions.items(), self.extract_texts(pdf_paths)):
+                        self.save_extraction(session, key, extraction, hashes, extractions, pending[key])
+                        for email in pending[key]:
+                            self.update_email_with_organization(session, email, results_by_hash, extraction)
+                self.commit(session)
+                processed += len(emails)
+                if progress:
+                    progress(processed, total)
+            self.finish_run(session)
+
+    def get_pending(self, session, emails, results_by_hash, skip_keys=()):
+        """Group a page of emails that still need a classification by attachment.
+
+        Returns the groups by attachment hash (or path), the keys that are hashes, the text of those extracted in
+        earlier runs and the PDF paths that still need to be extracted.
+        """
+        results_by_hash.update(self.get_results_by_hash(
+            session, {email.attachment_hash for email in emails
+                      if email.attachment_hash and email.attachment_hash not in results_by_hash}))
+        # Every unique attachment is extracted once, classification starts as soon as its text is ready
+        pending = {}
+        for email in emails:
+            key = email.attachment_hash or email.attachment_path
+            # A miss is counted when the email is prepared for classification, which looks it up again
+            if key not in skip_keys and not self.apply_known_result(session, email, results_by_hash, count_miss=False):
+                pending.setdefault(key, []).append(email)
+        # Text extracted in earlier runs is reused from the extracted_texts table
+        hashes = {key for key, group in pending.items() if group[0].attachment_hash}
+        extractions = {attachment_hash: row.to_extraction()
+                       for attachment_hash, row in ExtractedText.get_by_hashes(session, hashes).items()
+                       if row.text and row.covers(self.pdf_text_budget, self.pdf_max_pages)}
+        pdf_paths = {key: group[0].attachment_path for key, group in pending.items() if key not in extractions}
+        return pending, hashes, extractions, pdf_paths
+
+    def save_extraction(self, session, key, extraction, hashes, extractions, emails):
+        # Newly extracted text of attachments with a hash is kept for later runs, as are failed extractions
+        if key not in hashes or key in extractions:
+            return
+        if extraction['text']:
+            ExtractedText.save(session, key, extraction)
+        else:
+            self.record_failed_extraction(session, key, extraction, emails)
+
+    def record_failed_extraction(self, session, key, extraction, emails):
+        # The attempt is counted with the attachment, after pdf_max_attempts its emails are no longer extracted
+        row = ExtractedText.save(session, key, extraction)
+        if row.attempts < self.pdf_max_attempts:
+            return
+        print(f"No text in attachment {key} after {row.attempts} attempts ({row.error}), giving up")
+        email_ids = [email.id for email in emails]
+        session.query(ImportedEmail).filter(
+            and_(ImportedEmail.id.in_(email_ids), ImportedEmail.state.in_([STATE_IMPORTED, STATE_TEXT_EXTRACTED]))
+        ).update({ImportedEmail.state: STATE_EXTRACTION_FAILED}, synchronize_session=False)
+
+    def extract_pending_texts(self, page_size=100):
+        """Extract the PDF text of newly imported emails ahead of their classification.
+
+        The text is stored in the extracted_texts table, where classification picks it up. Every run visits all
+        emails still in the imported state, returns the number of attachments extracted.
+        """
+        extracted = 0
+        after_id = 0
+        with self.db.get_session() as session:
+            while True:
+                emails = ImportedEmail.get_batch_by_state(session, [STATE_IMPORTED], after_id, page_size)
+                if not emails:
+                    break
+                after_id = emails[-1].id
+                # Only text of attachments with a hash can be stored, the others are extracted when classified
+                groups = {}
+                for email in emails:
+                    if email.attachment_hash and email.attachment_path and os.path.exists(email.attachment_path):
+                        groups.setdefault(email.attachment_hash, []).append(email)
+                done = {key for key, row in ExtractedText.get_by_hashes(session, set(groups)).items()
+                        if row.text and row.covers(self.pdf_text_budget, self.pdf_max_pages)}
+                pdf_paths = {key: group[0].attachment_path for key, group in groups.items() if key not in done}
+                for key, extraction in self.extract_texts(pdf_paths):
+                    if extraction['text']:
+                        ExtractedText.save(session, key, extraction)
+                        done.add(key)
+                        extracted += 1
+                    else:
+                        self.record_failed_extraction(session, key, extraction, groups[key])
+                # Classification may have run on these emails in the meantime, its state is kept
+                email_ids = [email.id for key in done for email in groups[key]]
+                if email_ids:
+                    session.query(ImportedEmail).filter(
+                        and_(ImportedEmail.id.in_(email_ids), ImportedEmail.state == STATE_IMPORTED)
+                    ).update({ImportedEmail.state: STATE_TEXT_EXTRACTED}, synchronize_session=False)
+                self.commit(session)
+        return extracted
+
+    def classify_in_batches(self, page_size=100, progress=None):
+        """Classify all pending emails with the Batch API, waiting for the batches to complete."""
+        with self.db.get_session() as session:
+            # Batches submitted before a restart are applied first, so their emails are not submitted again
+            self.apply_batches(session)
+            self.org_matcher.load(session)
+            submitted_requests = 0
+            total = ImportedEmail.count_by_state(session, [STATE_IMPORTED, STATE_TEXT_EXTRACTED]) if progress else None
+            requests = self.iter_batch_requests(session, page_size)
+            while True:
+                submitted = self.batch_classifier.submit(
+                    itertools.islice(requests, self.batch_classifier.max_requests))
+                if submitted is None:
+                    break
+                batch, request_count = submitted
+                ClassificationBatch.create(session, batch.id, batch.status, request_count)
+                self.commit(session)
+                submitted_requests += request_count
+                if progress:
+                    progress(submitted_requests, total)
+            self.apply_batches(session)
+            self.finish_run(session)
+
+    def finish_run(self, session):
+        evicted = self.classification_cache.evict(session)
+        self.record_stats(session)
+        self.commit(session)
+        stats = self.classification_cache.stats
+        print(f"Classification cache: {stats['hits']} hits ({stats['domain_hits']} by domain), "
+              f"{stats['misses']} misses, hit rate {self.classification_cache.hit_rate():.0%}, {evicted} evicted")
+        stats = self.org_matcher.stats
+        print(f"Local organization matcher: {stats['matched']} matched, {stats['missed']} sent to the LLM, "
+              f"hit rate {self.org_matcher.hit_rate():.0%}")
+
+    def get_counters(self):
+        counters = Counter({f"cache_{name}": value for name, value in self.classification_cache.stats.items()})
+        counters.update({f"matcher_{name}": value for name, value in self.org_matcher.stats.items()})
+        return counters
+
+    def record_stats(self, session):
+        # The counters of this process since the last run are added to the totals of all processes
+        counters = self.get_counters()
+        ClassificationStat.add(session, counters - self.recorded_stats)
+        self.recorded_stats = counters
+
+    def get_stats(self):
+        # Totals of all runs and processes, including the counters of this process not recorded yet
+        with self.db.get_new_session() as session:
+            counters = Counter(ClassificationStat.get_all(session))
+        counters.update(self.get_counters() - self.recorded_stats)
+        cache = {name: counters[f"cache_{name}"] for name in self.classification_cache.stats}
+        matcher = {name: counters[f"matcher_{name}"] for name in self.org_matcher.stats}
+        cache_lookups = cache['hits'] + cache['misses']
+        matcher_lookups = matcher['matched'] + matcher['missed']
+        return {'cache': dict(cache, hit_rate=cache['hits'] / cache_lookups if cache_lookups else 0.0),
+                'matcher': dict(matcher, hit_rate=matcher['matched'] / matcher_lookups if matcher_lookups else 0.0)}
+
+    def iter_batch_requests(self, session, page_size=100):
+        # Yields (custom_id, messages) for every unique pending attachment, the custom_id is its hash or, for
+        # attachments imported without a hash, the id of the first email with it
+        results_by_hash = {}
+        submitted = set()
+        after_id = 0
+        while True:
+            emails = self.get_emails_with_pdf_attachments(session, after_id, page_size)
+            if not emails:
+                break
+            after_id = emails[-1].id
+            pending, hashes, extractions, pdf_paths = self.get_pending(session, emails, results_by_hash,
+                                                                       skip_keys=submitted)
+            for key, extraction in itertools.chain(extractions.items(), self.extract_texts(pdf_paths)):
+                self.save_extraction(session, key, extraction, hashes, extractions, pending[key])
+                pdf_text = None
+                for email in pending[key]:
+                    pdf_text = self.prepare_classification(session, email, results_by_hash, extraction)
+                if pdf_text:
+                    submitted.add(key)
+                    email = pending[key][0]
+                    messages, prompt_tokens = self.build_prompt(email.sender, pdf_text, email.body)
+                    email.prompt_tokens = prompt_tokens
+                    yield (key if key in hashes else f"{EMAIL_CUSTOM_ID_PREFIX}{email.id}"), messages
+            self.commit(session)
+
+    def apply_batches(self, session):
+        for row in ClassificationBatch.get_unapplied(session):
+            batch = self.batch_classifier.wait(row.batch_id)
+            results = dict(self.batch_classifier.get_results(batch))
+            self.apply_batch_results(session, results)
+            # Emails of failed requests stay pending and are submitted again with the next batch
+            row.mark_applied(batch.status)
+            self.commit(session)
+
+    def apply_batch_results(self, session, results, chunk_size=500):
+        results_by_hash = {}
+        custom_ids = list(results)
+        for start in range(0, len(custom_ids), chunk_size):
+            chunk = custom_ids[start:start + chunk_size]
+            email_ids = [int(custom_id[len(EMAIL_CUSTOM_ID_PREFIX):]) for custom_id in chunk
+                         if custom_id.startswith(EMAIL_CUSTOM_ID_PREFIX)]
+            emails = session.query(ImportedEmail).filter(
+                ImportedEmail.state.in_([STATE_IMPORTED, STATE_TEXT_EXTRACTED]),
+                or_(ImportedEmail.attachment_hash.in_(chunk), ImportedEmail.id.in_(email_ids))
+            ).all()
             for email in emails:
-                pdf_path = email.attachment_path
-                if os.path.exists(pdf_path):
-                    # Check if organization info is already in the cache
-                    if email.sender in self.organization_cache:
-                        cached_data = self.organization_cache[email.sender]
-                        email.sender_organisation = cached_data['organization']
-                        email.is_spam = cached_data['is_spam']
-                        session.add(email)
-                        print(
-                            f"Updated email ID {email.id} with cached organization: {email.sender_organisation}, spam status: {email.is_spam}")
-                        continue
-
-                    pdf_text = self.pdf_processor.extract_text_from_pdf(pdf_path)
-                    if pdf_text:
-                        detection_result = self.detect_organization_and_spam(email.sender, pdf_text, email.body)
-                        if detection_result:
-                            # Assuming detection_result returns something like "Organization: XYZ, Spam: No"
-                            try:
-                                print(detection_result)
-                                # parse detection_result as json data
-                                # Trim all characters before the first `{` and after the last `}`
-                                start_index = detection_result.index("{")
-                                end_index = detection_result.rindex("}") + 1
-                                cleaned_data = detection_result[start_index:end_index]
-
-                                json_data = json.loads(cleaned_data)
-                                organization = json_data['organization']
-                                spam_status = json_data['spam']
-                                invoice_probability = json_data['invoice']
-
-                                email.sender_organisation = organization
-                                email.is_spam = spam_status.strip().lower() == "yes"
-                                if invoice_probability > 0.6:
-                                    email.is_invoice = True
-                                else:
-                                    email.is_invoice = False
-
-                                # Store the result in the cache
-                                self.organization_cache[email.sender] = {
-                                    'organization': email.sender_organisation,
-                                    'is_spam': email.is_spam,
-                                    'is_invoice': email.is_invoice
-                                }
-                                session.add(email)
-                                print(
-                                    f"Updated email ID {email.id} with organization: {email.sender_organisation}, spam status: {email.is_spam}")
-                            except ValueError:
-                                print(f"Unexpected response format for email ID {email.id}: {detection_result}")
-            try:
-                session.commit()
-            except Exception as e:
-                session.rollback()
-                print(f"Error updating emails in database: {e}")
+                detection_result = results.get(email.attachment_hash) \
+                    or results.get(f"{EMAIL_CUSTOM_ID_PREFIX}{email.id}")
+                self.apply_detection_result(session, email, detection_result, results_by_hash)
+            self.commit(session)
+
+    def classify_concurrently(self, session, pending, hashes, extractions, pdf_paths, results_by_hash):
+        # One request per unique attachment, results are written as they arrive and committed every
+        # classification_commit_every attachments. The jobs generator runs in another thread, so the prompts
+        # are built from a snapshot and the session is only used in on_result.
+        prompt_data = {key: (group[0].sender, group[0].body, group[0].dkim_signature)
+                       for key, group in pending.items()}
+        completed = 0
+
+        def jobs():
+            for key, extraction in itertools.chain(extractions.items(), self.extract_texts(pdf_paths)):
+                sender, body, dkim_signature = prompt_data[key]
+                # Failed extractions are passed through to be recorded, senders classified earlier in this run to
+                # be taken from the cache in on_result
+                if not extraction['text'] or self.classification_cache.peek(sender) is not None:
+                    yield (key, extraction, None, None), None
+                    continue
+                # Known organizations are matched here and passed through without a request
+                match = self.org_matcher.match(sender, dkim_signature, extraction['text'])
+                if match:
+                    yield (key, extraction, match, None), None
+                else:
+                    messages, prompt_tokens = self.build_prompt(sender, extraction['text'], body)
+                    yield (key, extraction, None, prompt_tokens), messages
+
+        def on_result(job, detection_result):
+            nonlocal completed
+            key, extraction, match, prompt_tokens = job
+            self.save_extraction(session, key, extraction, hashes, extractions, pending[key])
+            for email in pending[key]:
+                if prompt_tokens:
+                    email.prompt_tokens = prompt_tokens
+                pdf_text = self.prepare_classification(session, email, results_by_hash, extraction, use_matcher=False)
+                if pdf_text and match:
+                    self.apply_match(session, email, match, results_by_hash, pdf_text)
+                elif pdf_text and detection_result:
+                    self.apply_detection_result(session, email, detection_result, results_by_hash, pdf_text)
+            completed += 1
+            if completed % self.classification_commit_every == 0:
+                self.commit(session)
+
+        self.classification_engine.run(jobs(), on_result)
+
+    @staticmethod
+    def commit(session):
+        try:
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            print(f"Error updating emails in database: {e}")
+
+    def extract_texts(self, pdf_paths):
+        # Yields (key, extraction) for a dict of key -> PDF path, in completion order when a pool is used
+        if self.extraction_pool:
+            yield from self.extraction_pool.extract(pdf_paths, self.pdf_text_budget, self.pdf_max_pages)
+            return
+        for key, pdf_path in pdf_paths.items():
+            yield key, self.pdf_processor.extract_text(pdf_path, max_chars=self.pdf_text_budget,
+                                                       max_pages=self.pdf_max_pages)
+
+    def apply_known_result(self, session, email, results_by_hash, count_miss=True):
+        # Returns True when the email needs no extraction, because it was classified from a known result
+        # or because its attachment is missing
+        if email.attachment_hash in results_by_hash:
+            cached_data = results_by_hash[email.attachment_hash]
+            email.sender_organisation = cached_data['organization']
+            email.is_spam = cached_data['is_spam']
+            email.is_invoice = cached_data['is_invoice']
+            email.state = STATE_CLASSIFIED
+            session.add(email)
+            print(f"Updated email ID {email.id} with organization of the same attachment: "
+                  f"{email.sender_organisation}")
+            return True
+        if not os.path.exists(email.attachment_path):
+            return True
+
+        # Check if organization info is already in the cache
+        cached_data = self.classification_cache.get(session, email.sender, count_miss)
+        if cached_data is not None:
+            email.sender_organisation = cached_data['organization']
+            email.is_spam = cached_data['is_spam']
+            email.is_invoice = cached_data['is_invoice']
+            email.state = STATE_CLASSIFIED
+            session.add(email)
+            print(
+                f"Updated email ID {email.id} with cached organization: {email.sender_organisation}, spam status: {email.is_spam}")
+            return True
+        return False
+
+    def prepare_classification(self, session, email, results_by_hash, extraction=None, use_matcher=True):
+        # Returns the PDF text to classify, or None when the email was handled without a request
+        if self.apply_known_result(session, email, results_by_hash):
+            return None
+        pdf_path = email.attachment_path
+        if extraction is None:
+            extraction = self.pdf_processor.extract_text(pdf_path, max_chars=self.pdf_text_budget,
+                                                         max_pages=self.pdf_max_pages)
+        pdf_text = extraction['text']
+        if not pdf_text:
+            return None
+        print(f"Extracted {len(pdf_text)} characters from {extraction['pages_read']}/{extraction['page_count']} "
+              f"pages of {pdf_path}")
+        email.state = STATE_TEXT_EXTRACTED
+        session.add(email)
+        if use_matcher:
+            match = self.org_matcher.match(email.sender, email.dkim_signature, pdf_text)
+            if match:
+                self.apply_match(session, email, match, results_by_hash, pdf_text)
+                return None
+        return pdf_text
+
+    def apply_match(self, session, email, match, results_by_hash, pdf_text=None):
+        print(f"Matched email ID {email.id} locally to {match['organization']} "
+              f"({', '.join(match['signals'])}, confidence {match['confidence']:.2f})")
+        self.apply_result(session, email, match, results_by_hash)
+        # Matched documents support their identifiers as well, so an identifier shared with another
+        # organization is recognized as ambiguous
+        self.org_matcher.learn(email.sender, email.dkim_signature, pdf_text, match, email.id)
+
+    def update_email_with_organization(self, session, email, results_by_hash, extraction=None):
+        pdf_text = self.prepare_classification(session, email, results_by_hash, extraction)
+        if not pdf_text:
+            return
+        messages, prompt_tokens = self.build_prompt(email.sender, pdf_text, email.body)
+        email.prompt_tokens = prompt_tokens
+        detection_result = self.request_classification(messages)
+        if not detection_result:
+            return
+        self.apply_detection_result(session, email, detection_result, results_by_hash, pdf_text)
+
+    def apply_detection_result(self, session, email, detection_result, results_by_hash, pdf_text=None):
+        # Assuming detection_result returns something like "Organization: XYZ, Spam: No"
+        try:
+            print(detection_result)
+            # parse detection_result as json data
+            # Trim all characters before the first `{` and after the last `}`
+            start_index = detection_result.index("{")
+            end_index = detection_result.rindex("}") + 1
+            cleaned_data = detection_result[start_index:end_index]
+
+            json_data = json.loads(cleaned_data)
+            organization = json_data['organization']
+            spam_status = json_data['spam']
+            invoice_probability = json_data['invoice']
+
+            result = {
+                'organization': organization,
+                'is_spam': spam_status.strip().lower() == "yes",
+                'is_invoice': invoice_probability > 0.6
+            }
+        except ValueError:
+            print(f"Unexpected response format for email ID {email.id}: {detection_result}")
+            return
+        self.apply_result(session, email, result, results_by_hash)
+        # The matcher learns the domains and identifiers of the attachment for the next emails
+        self.org_matcher.learn(email.sender, email.dkim_signature, pdf_text, result, email.id)
+        print(
+            f"Updated email ID {email.id} with organization: {email.sender_organisation}, spam status: {email.is_spam}")
 
+    def apply_result(self, session, email, result, results_by_hash):
+        result = {key: result[key] for key in ('organization', 'is_spam', 'is_invoice')}
+        email.sender_organisation = result['organization']
+        email.is_spam = result['is_spam']
+        email.is_invoice = result['is_invoice']
+        email.state = STATE_CLASSIFIED
+        # Store the result in the cache
+        self.classification_cache.put(session, email.sender, result)
+        if email.attachment_hash:
+            results_by_hash[email.attachment_hash] = result
+        session.add(email)
@@ -0,0 +1,232 @@
+import re
+import threading
+from collections import Counter, defaultdict
+from email.utils import parseaddr
+
+import Levenshtein
+
+from classification_cache import FREEMAIL_DOMAINS
+from db_email import ImportedEmail, ExtractedText, STATE_CLASSIFIED, STATE_ORGANIZED, STATE_UPLOADED
+
+DKIM_DOMAIN_PATTERN = re.compile(r"(?:^|[;\s])d=([A-Za-z0-9.-]+)")
+VAT_PATTERN = re.compile(r"\b(?:I[ČC]\s*DPH|DI[ČC]|VAT(?:\s*(?:ID|No\.?|number|reg\.?\s*no\.?))?|USt-?IdNr\.?)\s*[:.]?\s*"
+                         r"([A-Z]{2}\s?[0-9A-Z]{8,12})\b", re.IGNORECASE)
+ICO_PATTERN = re.compile(r"\bI[ČC]O?\s*[:.]?\s*(\d{2}\s?\d{3}\s?\d{3})\b", re.IGNORECASE)
+IBAN_PATTERN = re.compile(r"\b([A-Z]{2}\d{2}(?:\s?[A-Z0-9]{4}){2,7}(?:\s?[A-Z0-9]{1,3})?)\b")
+LEGAL_FORM_PATTERN = re.compile(r"\b(s\.?\s?r\.?\s?o\.?|spol\.|a\.\s?s\.|k\.\s?s\.|v\.\s?o\.\s?s\.|gmbh|ag|ltd\.?|"
+                                r"limited|inc\.?|llc|plc|b\.\s?v\.|s\.\s?a\.|se)(?=\W|$)", re.IGNORECASE)
+INVOICE_PATTERN = re.compile(r"fakt[úu]r|invoice|rechnung|da[ňn]ov[ýy] doklad", re.IGNORECASE)
+TAX_RETURN_PATTERN = re.compile(r"da[ňn]ov[ée] prizn", re.IGNORECASE)
+
+# Confidence contributed by one signal, signals for the same organization are combined
+SIGNAL_WEIGHTS = {'dkim': 0.9, 'domain': 0.75, 'vat': 0.95, 'ico': 0.95, 'iban': 0.9, 'name': 0.85}
+# Identifiers printed in the documents, the customer's own are on every invoice as well
+IDENTIFIER_KINDS = {'vat', 'ico', 'iban'}
+# A learned identifier found in more than this share of all documents is taken for the customer's own
+MAX_IDENTIFIER_SHARE = 0.5
+
+
+def get_domains(domain):
+    # mail.billing.example.com also matches example.com
+    labels = domain.lower().strip(".").split(".")
+    return [".".join(labels[i:]) for i in range(len(labels) - 1)]
+
+
+def get_sender_domain(sender):
+    address = parseaddr(sender or "")[1].lower()
+    return address.rsplit("@", 1)[1] if "@" in address else None
+
+
+def get_dkim_domain(dkim_signature):
+    match = DKIM_DOMAIN_PATTERN.search(dkim_signature or "")
+    return match.group(1).lower() if match else None
+
+
+def is_valid_iban(iban):
+    rearranged = iban[4:] + iban[:4]
+    digits = "".join(str(int(char, 36)) for char in rearranged)
+    return int(digits) % 97 == 1
+
+
+def get_identifiers(text):
+    """VAT numbers, IČO and IBANs in a text, as (kind, normalized value) pairs."""
+    identifiers = set()
+    for match in VAT_PATTERN.finditer(text or ""):
+        identifiers.add(('vat', re.sub(r"\s", "", match.group(1)).upper()))
+    for match in ICO_PATTERN.finditer(text or ""):
+        identifiers.add(('ico', re.sub(r"\s", "", match.group(1))))
+    for match in IBAN_PATTERN.finditer(text or ""):
+        iban = re.sub(r"\s", "", match.group(1))
+        if 15 <= len(iban) <= 34 and is_valid_iban(iban):
+            identifiers.add(('iban', iban))
+    return identifiers
+
+
+def normalize_name(name):
+    name = LEGAL_FORM_PATTERN.sub(" ", name.lower())
+    return " ".join(re.sub(r"[^\w&]+", " ", name).split())
+
+
+def get_name_candidates(text):
+    # Names with a legal form are the supplier and customer blocks of an invoice, a "Supplier:" label is dropped
+    candidates = set()
+    for line in (text or "").splitlines():
+        match = LEGAL_FORM_PATTERN.search(line)
+        if match and len(line) < 120:
+            candidates.add(normalize_name(line[:match.end()].rsplit(":", 1)[-1]))
+    return candidates - {""}
+
+
+class OrganizationMatcher:
+    """Recognizes known organizations locally so only unknown ones are classified by the LLM.
+
+    The index is learned from classified emails (sender and DKIM domains, VAT, IČO and IBAN in their extracted
+    text) and from the known_organizations config. The customer's own IČO, VAT ID and IBAN are on every invoice,
+    so learned identifiers seen with more than one organization or in most documents are ignored, and names and
+    learned identifiers in a document only count when the sender or DKIM domain points to the same organization.
+    """
+
+    def __init__(self, known_organizations=None, threshold=0.85, name_ratio=0.88, min_support=2):
+        self.threshold = threshold
+        self.name_ratio = name_ratio
+        # Learned values need this many emails before they are trusted, configured ones are trusted immediately
+        self.min_support = min_support
+        self.observations = defaultdict(Counter)
+        self.flags = defaultdict(Counter)
+        self.names = {}
+        # Identifiers from known_organizations, which are trusted without a matching domain
+        self.configured_keys = set()
+        # Number of learned documents with identifiers
+        self.documents = 0
+        # Emails learned as they were classified, load() skips them
+        self.learned_ids = set()
+        self.loaded_until_id = 0
+        self.lock = threading.Lock()
+        self.stats = {'matched': 0, 'missed': 0}
+        for organization in known_organizations or []:
+            self.add_known_organization(organization)
+
+    def add_known_organization(self, organization):
+        name = organization['name']
+        keys = [('domain', domain.lower()) for domain in organization.get('domains', [])]
+        keys += [('vat', re.sub(r"\s", "", vat).upper()) for vat in organization.get('vat_ids', [])]
+        keys += [('ico', re.sub(r"\s", "", ico)) for ico in organization.get('ico', [])]
+        keys += [('iban', re.sub(r"\s", "", iban).upper()) for iban in organization.get('iban', [])]
+        for key in keys:
+            self.observations[key][name] += self.min_support
+            if key[0] in IDENTIFIER_KINDS:
+                self.configured_keys.add(key)
+        self.names[normalize_name(name)] = name
+        if 'is_invoice' in organization:
+            self.flags[name]['invoice' if organization['is_invoice'] else 'other'] += 1
+
+    def learn(self, sender, dkim_signature, text, result, email_id=None):
+        organization = result['organization']
+        if not organization:
+            return
+        keys = {('domain', domain) for domain in [get_sender_domain(sender), get_dkim_domain(dkim_signature)]
+                if domain and domain not in FREEMAIL_DOMAINS}
+        identifiers = get_identifiers(text)
+        keys |= identifiers
+        with self.lock:
+            if email_id is not None:
+                self.learned_ids.add(email_id)
+            if identifiers:
+                self.documents += 1
+            for key in keys:
+                self.observations[key][organization] += 1
+            self.names.setdefault(normalize_name(organization), organization)
+            self.flags[organization]['spam' if result['is_spam'] else 'ham'] += 1
+            self.flags[organization]['invoice' if result['is_invoice'] else 'other'] += 1
+
+    def load(self, session, batch_size=1000):
+        """Learn from emails classified since the last load."""
+        while True:
+            rows = session.query(ImportedEmail.id, ImportedEmail.sender, ImportedEmail.dkim_signature,
+                                 ImportedEmail.sender_organisation, ImportedEmail.is_spam, ImportedEmail.is_invoice,
+                                 ExtractedText.text) \
+                .outerjoin(ExtractedText, ExtractedText.attachment_hash == ImportedEmail.attachment_hash) \
+                .filter(ImportedEmail.id > self.loaded_until_id,
+                        ImportedEmail.state.in_([STATE_CLASSIFIED, STATE_ORGANIZED, STATE_UPLOADED]),
+                        ImportedEmail.sender_organisation != None) \
+                .order_by(ImportedEmail.id).limit(batch_size).all()
+            if not rows:
+                return
+            for row in rows:
+                if row.id in self.learned_ids:
+                    self.learned_ids.discard(row.id)
+                    continue
+                self.learn(row.sender, row.dkim_signature, row.text,
+                           {'organization': row.sender_organisation, 'is_spam': row.is_spam,
+                            'is_invoice': row.is_invoice})
+            self.loaded_until_id = rows[-1].id
+
+    def lookup(self, key):
+        # The organization of an indexed value, None when it is unknown or ambiguous
+        counts = self.observations.get(key)
+        if not counts:
+            return None
+        organization, count = counts.most_common(1)[0]
+        if count < self.min_support or count < 0.8 * sum(counts.values()):
+            return None
+        if key[0] in IDENTIFIER_KINDS and key not in self.configured_keys \
+                and (len(counts) > 1 or count > MAX_IDENTIFIER_SHARE * self.documents):
+            # Printed in the documents of several organizations or in most documents, the customer's own
+            return None
+        return organization
+
+    def get_signals(self, sender, dkim_signature, text):
+        # Returns (kind, organization, weight, trusted) tuples, only trusted signals can identify an organization
+        # on their own, the others confirm it
+        signals = []
+        dkim_domain = get_dkim_domain(dkim_signature)
+        for kind, domain in (('dkim', dkim_domain), ('domain', get_sender_domain(sender))):
+            for candidate in get_domains(domain) if domain else []:
+                organization = self.lookup(('domain', candidate))
+                if organization:
+                    signals.append((kind, organization, SIGNAL_WEIGHTS[kind], True))
+                    break
+        for key in get_identifiers(text):
+            organization = self.lookup(key)
+            if organization:
+                signals.append((key[0], organization, SIGNAL_WEIGHTS[key[0]], key in self.configured_keys))
+        for candidate in get_name_candidates(text):
+            best_name, best_ratio = None, 0
+            for normalized, name in self.names.items():
+                ratio = Levenshtein.ratio(candidate, normalized)
+                if ratio > best_ratio:
+                    best_name, best_ratio = name, ratio
+            if best_ratio >= self.name_ratio:
+                signals.append(('name', best_name, SIGNAL_WEIGHTS['name'] * best_ratio, False))
+        return signals
+
+    def match(self, sender, dkim_signature, text):
+        """Classify an email from the index, returns None when the confidence is below the threshold."""
+        with self.lock:
+            signals = self.get_signals(sender, dkim_signature, text)
+            confidence = defaultdict(lambda: 1.0)
+            for kind, organization, weight, trusted in signals:
+                confidence[organization] *= 1 - weight
+            scores = sorted(((1 - remaining, organization) for organization, remaining in confidence.items()),
+                            reverse=True)
+            # Signals pointing to another organization lower the confidence
+            score = scores[0][0] - (scores[1][0] if len(scores) > 1 else 0) if scores else 0
+            organization = scores[0][1] if scores else None
+            # The document alone may name the customer, the sender or DKIM domain has to agree
+            trusted = any(trusted and name == organization for kind, name, weight, trusted in signals)
+            if score < self.threshold or not trusted:
+                self.stats['missed'] += 1
+                return None
+            flags = self.flags[organization]
+            self.stats['matched'] += 1
+        if flags['invoice'] or flags['other']:
+            is_invoice = flags['invoice'] > flags['other']
+        else:
+            is_invoice = bool(INVOICE_PATTERN.search(text or "")) and not TAX_RETURN_PATTERN.search(text or "")
+        return {'organization': organization, 'is_spam': flags['spam'] > flags['ham'], 'is_invoice': is_invoice,
+                'confidence': score, 'signals': [kind for kind, name, weight, trusted in signals
+                                                 if name == organization]}
+
+    def hit_rate(self):
+        lookups = self.stats['matched'] + self.stats['missed']
+        return self.stats['matched'] / lookups if lookups else 0.0
@@ -1,76 +1,212 @@
+import multiprocessing
 import os
+import resource
+import signal
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
 import PyPDF2
 from PyPDF2.errors import PdfReadError
 
+
+def empty_extraction():
+    return {'text': "", 'pages_read': 0, 'page_count': 0, 'encrypted': False, 'password_index': None,
+            'extraction_time': 0.0, 'error': None}
+
+
 class PDFProcessor:
-    def __init__(self, pdf_passwords):
-        self.pdf_passwords = pdf_passwords
+    def __init__(self, pdf_passwords, write_decrypted=False):
+        self.pdf_passwords = pdf_passwords if pdf_passwords else []
+        # Keep a decrypted copy next to encrypted attachments, the attachment itself is never modified
+        self.write_decrypted = write_decrypted
 
-    def extract_text_from_pdf(self, pdf_path):
-        text = ""
-        original_file = pdf_path
-        tmp_file = pdf_path + ".tmp"
-        decrypted_file = pdf_path + ".decrypted"
+    @staticmethod
+    def decrypted_path(pdf_path):
+        root, ext = os.path.splitext(pdf_path)
+        return f"{root}.decrypted{ext}"
 
+    @staticmethod
+    def is_readable(reader):
+        # An encrypted reader raises on page access until it was decrypted
         try:
-            # Rename original file to temporary name
-            os.rename(original_file, tmp_file)
+            _ = reader.pages[0]
+            return True
+        except Exception:
+            return False
 
-            # Attempt to decrypt the PDF
-            with open(tmp_file, "rb") as pdf_file:
-                reader = PyPDF2.PdfReader(pdf_file)
+    def decrypt(self, reader, pdf_path):
+        # Decrypt the reader in memory. Returns (decrypted, index of the password that worked), the index is None
+        # for PDFs with only an owner password, which open with the empty user password.
+        try:
+            if reader.decrypt("") or self.is_readable(reader):
+                return True, None
+        except NotImplementedError:
+            print(f"PyCryptodome is required for AES algorithm. Unable to decrypt PDF {pdf_path}.")
+            return False, None
+        except PdfReadError:
+            pass
+        for password_index, password in enumerate(self.pdf_passwords):
+            try:
+                if reader.decrypt(password) or self.is_readable(reader):
+                    print(f"Decryption of {pdf_path} successful")
+                    return True, password_index
+            except NotImplementedError:
+                print(f"PyCryptodome is required for AES algorithm. Unable to decrypt PDF {pdf_path}.")
+                return False, None
+            except PdfReadError:
+                continue
+        print(f"Unable to decrypt PDF {pdf_path} with provided passwords.")
+        return False, None
 
-                if reader.is_encrypted:
-                    # Try each password to decrypt
-                    for password in self.pdf_passwords:
-                        try:
-                            reader.decrypt(password)
-
-                            # Test if decryption succeeded by accessing the first page
-                            _ = reader.pages[0]  # Try to access the first page
-                            print(f"Decryption successful with password: {password}")
-                            break
-                        except NotImplementedError:
-                            print(f"PyCryptodome is required for AES algorithm. Unable to decrypt PDF {pdf_path}.")
-                            os.rename(tmp_file, original_file)  # Restore original file
-                            return text
-                        except PdfReadError:
-                            continue
-                    else:
-                        print(f"Unable to decrypt PDF {pdf_path} with provided passwords.")
-                        os.rename(tmp_file, original_file)  # Restore original file
-                        return text
-
-                # Save decrypted PDF for processing
-                writer = PyPDF2.PdfWriter()
-                for page in reader.pages:
-                    print(f"Adding page {page} to decrypted PDF")
-                    writer.add_page(page)
-
-                with open(decrypted_file, "wb") as output_file:
-                    print(f"Writing decrypted PDF to {decrypted_file}")
-                    writer.write(output_file)
-
-            # Rename decrypted file back to original name
-            os.rename(decrypted_file, original_file)
-            print(f"Decrypted PDF saved to {original_file}")
-
-            # Extract text from the decrypted PDF
-            with open(original_file, "rb") as pdf_file:
+    def save_decrypted_copy(self, reader, pdf_path):
+        decrypted_path = self.decrypted_path(pdf_path)
+        if os.path.exists(decrypted_path):
+            return decrypted_path
+        writer = PyPDF2.PdfWriter()
+        for page in reader.pages:
+            writer.add_page(page)
+        # Write to a temporary file first so the copy is either complete or missing
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(pdf_path) or ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as output_file:
+                writer.write(output_file)
+            os.replace(tmp_path, decrypted_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        print(f"Decrypted PDF saved to {decrypted_path}")
+        return decrypted_path
+
+    @staticmethod
+    def page_order(page_count):
+        # Invoice header and totals are usually on the first and last page, the rest follows in order
+        if page_count <= 2:
+            return list(range(page_count))
+        return [0, page_count - 1] + list(range(1, page_count - 1))
+
+    def extract_text(self, pdf_path, max_chars=None, max_pages=None):
+        """Extract text until max_chars characters or max_pages pages were read.
+
+        Returns a dict with the text, the number of pages read, the page count, whether the PDF was encrypted,
+        the index of the password that decrypted it, the extraction time in seconds and why no text was extracted.
+        """
+        result = empty_extraction()
+        started = time.monotonic()
+        try:
+            with open(pdf_path, "rb") as pdf_file:
                 reader = PyPDF2.PdfReader(pdf_file)
-                for page_num in range(len(reader.pages)):
-                    text += reader.pages[page_num].extract_text() + "\n"
+                if reader.is_encrypted:
+                    result['encrypted'] = True
+                    decrypted, result['password_index'] = self.decrypt(reader, pdf_path)
+                    if not decrypted:
+                        result['error'] = "could not decrypt"
+                        return result
+                    if self.write_decrypted:
+                        self.save_decrypted_copy(reader, pdf_path)
 
+                # Extract text straight from the open reader and stop as soon as there is enough of it
+                page_count = len(reader.pages)
+                result['page_count'] = page_count
+                texts = {}
+                length = 0
+                # Half of the budget is kept for the last page when both the first and the last page are read
+                reserve_last = page_count > 1 and (max_pages is None or max_pages > 1)
+                for page_num in self.page_order(page_count):
+                    if max_pages is not None and len(texts) >= max_pages:
+                        break
+                    if max_chars is not None and length >= max_chars:
+                        break
+                    page_text = reader.pages[page_num].extract_text() + "\n"
+                    # The budget is spent in reading order, so the last page is not cut off by the middle ones
+                    if max_chars is not None:
+                        limit = max_chars - length
+                        if page_num == 0 and reserve_last:
+                            limit = max(1, max_chars // 2)
+                        if page_num == page_count - 1 and reserve_last:
+                            # Totals are at the end of the last page
+                            page_text = page_text[-limit:]
+                        else:
+                            page_text = page_text[:limit]
+                    texts[page_num] = page_text
+                    length += len(page_text)
+                result['text'] = "".join(texts[page_num] for page_num in sorted(texts))
+                result['pages_read'] = len(texts)
+                if not result['text'].strip():
+                    result['error'] = "no text"
         except Exception as e:
             print(f"Error reading PDF {pdf_path}: {e}")
-            # Restore the original file if something went wrong
-            if os.path.exists(tmp_file):
-                os.rename(tmp_file, original_file)
+            result['error'] = str(e) or type(e).__name__
         finally:
-            if os.path.exists(tmp_file):
-                os.remove(tmp_file)
-            # Clean up decrypted file if left over
-            if os.path.exists(decrypted_file):
-                os.remove(decrypted_file)
+            result['extraction_time'] = time.monotonic() - started
+
+        return result
+
+    def extract_text_from_pdf(self, pdf_path):
+        return self.extract_text(pdf_path)['text']
+
+
+def limit_worker_memory(memory_limit_mb):
+    # A PDF that needs more memory fails with MemoryError in its worker instead of exhausting the machine
+    if memory_limit_mb:
+        limit = memory_limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def extract_text_in_worker(pdf_passwords, write_decrypted, pdf_path, max_chars, max_pages, timeout):
+    def on_timeout(signum, frame):
+        raise TimeoutError(f"extraction took longer than {timeout}s")
+
+    # PyPDF2 is pure Python, so the alarm interrupts even a pathological PDF
+    signal.signal(signal.SIGALRM, on_timeout)
+    signal.alarm(timeout)
+    try:
+        return PDFProcessor(pdf_passwords, write_decrypted).extract_text(pdf_path, max_chars, max_pages)
+    finally:
+        signal.alarm(0)
+
+
+class PDFExtractionPool:
+    """Extracts PDF text in worker processes, one per CPU by default, with a timeout and memory limit per file."""
+
+    def __init__(self, pdf_processor, workers=None, timeout=60, memory_limit_mb=1024):
+        self.pdf_processor = pdf_processor
+        self.workers = workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.memory_limit_mb = memory_limit_mb
+        self.executor = None
+
+    def get_executor(self):
+        if self.executor is None:
+            # Forked workers would inherit the address space of the multi-threaded parent (API, database pool,
+            # pipeline threads) and count it against the memory limit, workers from a fork server start small
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=limit_worker_memory,
+                                                initargs=(self.memory_limit_mb,),
+                                                mp_context=multiprocessing.get_context("forkserver"))
+        return self.executor
+
+    def extract(self, pdf_paths, max_chars=None, max_pages=None):
+        """Yield (key, extraction) for a dict of key -> PDF path as soon as each file is done."""
+        executor = self.get_executor()
+        futures = {executor.submit(extract_text_in_worker, self.pdf_processor.pdf_passwords,
+                                   self.pdf_processor.write_decrypted, pdf_path, max_chars, max_pages,
+                                   self.timeout): key
+                   for key, pdf_path in pdf_paths.items()}
+        for future in as_completed(futures):
+            try:
+                extraction = future.result()
+            except BrokenProcessPool as e:
+                # A worker died, the pool is recreated for the next batch
+                print(f"PDF extraction worker failed for {pdf_paths[futures[future]]}: {e}")
+                self.executor = None
+                extraction = dict(empty_extraction(), error=f"worker failed: {e}")
+            except Exception as e:
+                print(f"Error extracting PDF {pdf_paths[futures[future]]}: {e}")
+                extraction = dict(empty_extraction(), error=str(e) or type(e).__name__)
+            yield futures[future], extraction
 
-        return text
\ No newline at end of file
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
@@ -0,0 +1,98 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Stage:
+    """A step of the pipeline: a blocking job, how often it runs on its own and the stage it feeds.
+
+    The job returns how much new work it produced for the next stage; None means unknown and triggers the next
+    stage as well, 0 does not.
+    """
+
+    def __init__(self, name, job, interval=None, queue_size=2):
+        self.name = name
+        self.job = job
+        self.interval = interval or None
+        self.downstream = None
+        # Triggers from the previous stage, a full queue makes the previous stage wait (back-pressure)
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.runs = 0
+        self.failures = 0
+
+
+class PipelineScheduler:
+    """Runs import -> extract -> classify -> organize -> upload as concurrent stages.
+
+    Every stage is an asyncio task that runs its job in a worker thread, so the event loop never blocks. A stage
+    runs every interval seconds and as soon as the stage before it finished a run with new work; triggers that
+    arrive while the stage is busy are coalesced into one run. stop() lets running jobs finish and ends the
+    pipeline.
+    """
+
+    def __init__(self, stages, queue_size=2):
+        self.stages = [Stage(name, job, interval, queue_size) for name, job, interval in stages]
+        for stage, downstream in zip(self.stages, self.stages[1:]):
+            stage.downstream = downstream
+        self.executor = ThreadPoolExecutor(max_workers=len(self.stages), thread_name_prefix="pipeline")
+        self.stopping = None
+        self.logger = logging.getLogger(__name__)
+
+    def get_stage(self, name):
+        return next(stage for stage in self.stages if stage.name == name)
+
+    def trigger(self, name):
+        # Run a stage as soon as possible, a trigger that is already queued is enough
+        stage = self.get_stage(name)
+        if not stage.queue.full():
+            stage.queue.put_nowait(None)
+
+    def stop(self):
+        if self.stopping is not None and not self.stopping.is_set():
+            self.logger.info("Stopping the pipeline, running jobs are finished first")
+            self.stopping.set()
+
+    async def until_stopped(self, awaitable, timeout=None):
+        # Returns the result of awaitable, or None when the pipeline stops or the timeout expires first
+        task = asyncio.ensure_future(awaitable)
+        stopped = asyncio.ensure_future(self.stopping.wait())
+        done, _ = await asyncio.wait({task, stopped}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        stopped.cancel()
+        if task in done:
+            return task.result()
+        task.cancel()
+        return None
+
+    async def run_stage(self, stage):
+        loop = asyncio.get_running_loop()
+        while not self.stopping.is_set():
+            await self.until_stopped(stage.queue.get(), stage.interval)
+            while not stage.queue.empty():
+                stage.queue.get_nowait()
+            if self.stopping.is_set():
+                break
+            stage.runs += 1
+            self.logger.info("Running pipeline stage %s", stage.name)
+            try:
+                produced = await loop.run_in_executor(self.executor, stage.job)
+            except Exception as e:
+                stage.failures += 1
+                self.logger.exception("Pipeline stage %s failed: %s", stage.name, e)
+                continue
+            if stage.downstream and produced != 0:
+                await self.until_stopped(stage.downstream.queue.put(produced))
+
+    async def run(self):
+        self.stopping = asyncio.Event()
+        # Work left from before a restart is picked up right away
+        for stage in self.stages:
+            self.trigger(stage.name)
+        try:
+            await asyncio.gather(*(self.run_stage(stage) for stage in self.stages))
+        finally:
+            self.executor.shutdown(wait=True)
+            self.logger.info("Pipeline stopped")
+
+    def get_stats(self):
+        return {stage.name: {'runs': stage.runs, 'failures': stage.failures, 'queued': stage.queue.qsize()}
+                for stage in self.stages}
@@ -0,0 +1,141 @@
+import html
+import re
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+SYSTEM_PROMPT = ("You will receive PDF content and sender information. "
+                 "Extract the organization name and determine if the email is spam or not and "
+                 "determine probability that PDF content is invoice "
+                 "('DANOVE PRIZNANIE' is not invoice) "
+                 "promotional in JSON format: "
+                 "{ \"organization\": \"XYZ\", spam: \"No\", \"invoice\": 0.8 }")
+
+# Everything after these lines is a quoted reply or a forwarded message
+QUOTE_START_PATTERN = re.compile(
+    r"^(>|-{2,}\s*(original message|forwarded message|pôvodná správa|původní zpráva|ursprüngliche nachricht)"
+    r"|on .{5,80} wrote:|d[ňn]a .{5,80} nap[íi]sal|am .{5,80} schrieb|from: .+ sent: )", re.IGNORECASE)
+# Everything after these lines is a signature. Only a short closing line standing on its own counts, "Ďakujeme za
+# objednávku" starts the actual message.
+SIGNATURE_START_PATTERN = re.compile(
+    r"^(--|(best|kind|warm)? ?regards|s pozdravom|s pozdravem|s úctou|ďakujem\w*( pekne| vám)?|děkuji( pěkně| vám)?"
+    r"|děkujeme|mit freundlichen grüßen|(sent from my|odoslané z|odesláno z) .{1,30})[\s,.!]*$", re.IGNORECASE)
+# Lines of legal disclaimers, tracking and newsletter footers
+BOILERPLATE_PATTERN = re.compile(
+    r"unsubscribe|odhlási|odhlásit|view (it )?in (your )?browser|confidential|důvěrn|dôvern|disclaimer"
+    r"|intended recipient|please consider the environment|do not reply|nereagujte|neodpovedajte|privacy policy"
+    r"|all rights reserved", re.IGNORECASE)
+
+# Lines that identify an invoice, its supplier and its totals, they are sent before the rest of the PDF text
+RELEVANT_LINE_PATTERNS = (
+    re.compile(r"fakt[úu]r|invoice|rechnung|da[ňn]ov[ýy] doklad|variabiln|due date|splatnos|d[áa]tum vystaven"
+               r"|issue date|číslo|number", re.IGNORECASE),
+    re.compile(r"dod[áa]vate|supplier|vendor|seller|lieferant|predávajúci|prodávající|I[ČC]O|I[ČC] DPH|DI[ČC]|IBAN"
+               r"|s\.\s?r\.\s?o|a\.\s?s\.|gmbh|ltd", re.IGNORECASE),
+    re.compile(r"spolu|celkom|celkem|total|k [úu]hrad|amount due|suma|zaplaten|dph|vat|eur|€", re.IGNORECASE),
+)
+HEADER_LINES = 5
+
+
+def strip_html(text):
+    text = re.sub(r"(?is)<(script|style)\b.*?</\1>", " ", text)
+    text = re.sub(r"(?i)<br\s*/?>|</(p|div|tr|li|h\d)>", "\n", text)
+    return html.unescape(re.sub(r"<[^>]+>", " ", text))
+
+
+def clean_body(body):
+    """The body without HTML, quoted replies, signatures, boilerplate, blank and repeated lines."""
+    if not body:
+        return ""
+    if re.search(r"(?i)<(html|body|div|p|table|br)\b", body):
+        body = strip_html(body)
+    lines = []
+    body_lines = [" ".join(line.split()) for line in body.splitlines()]
+    for index, line in enumerate(body_lines):
+        if QUOTE_START_PATTERN.match(line):
+            break
+        # A closing line only starts the signature in the second half of the body
+        if index >= len(body_lines) // 2 and SIGNATURE_START_PATTERN.match(line):
+            break
+        if line and not BOILERPLATE_PATTERN.search(line) and (not lines or line != lines[-1]):
+            lines.append(line)
+    return "\n".join(lines)
+
+
+def select_pdf_snippets(text, max_tokens, count_tokens):
+    """Lines of the PDF text that identify the invoice, up to max_tokens, in their original order.
+
+    The first lines (the header) come first, then lines matching the invoice, supplier and totals patterns with
+    the line after each of them, then the remaining lines. Gaps are marked with '...'.
+    """
+    lines = [" ".join(line.split()) for line in (text or "").splitlines()]
+    lines = [line for line in lines if line]
+    if count_tokens("\n".join(lines)) <= max_tokens:
+        return "\n".join(lines)
+    ranked = list(range(min(HEADER_LINES, len(lines))))
+    for index, line in enumerate(lines):
+        if any(pattern.search(line) for pattern in RELEVANT_LINE_PATTERNS):
+            ranked += [index, index + 1]
+    ranked += range(len(lines))
+    selected = set()
+    used = 0
+    for index in ranked:
+        if index in selected or index >= len(lines):
+            continue
+        tokens = count_tokens(lines[index]) + 1
+        if used + tokens > max_tokens:
+            continue
+        selected.add(index)
+        used += tokens
+    snippets = []
+    previous = -1
+    for index in sorted(selected):
+        if index != previous + 1:
+            snippets.append("...")
+        snippets.append(lines[index])
+        previous = index
+    return "\n".join(snippets)
+
+
+class PromptBuilder:
+    """Builds the classification prompt within a token budget.
+
+    Tokens are counted with tiktoken when it is installed, otherwise estimated as four characters per token.
+    """
+
+    def __init__(self, model="gpt-4o-mini", max_prompt_tokens=1000, max_body_tokens=200):
+        self.max_prompt_tokens = max_prompt_tokens
+        self.max_body_tokens = max_body_tokens
+        self.encoding = None
+        if tiktoken is not None:
+            try:
+                self.encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                self.encoding = tiktoken.get_encoding("o200k_base")
+
+    def count_tokens(self, text):
+        if self.encoding is not None:
+            return len(self.encoding.encode(text))
+        return (len(text) + 3) // 4
+
+    def truncate(self, text, max_tokens):
+        if self.count_tokens(text) <= max_tokens:
+            return text
+        if self.encoding is not None:
+            return self.encoding.decode(self.encoding.encode(text)[:max(0, max_tokens)])
+        return text[:max(0, max_tokens) * 4]
+
+    def build(self, email_from, pdf_text, body):
+        """Returns the messages and their token count."""
+        sender = self.truncate(f"Sender: {email_from}", 50)
+        # The system prompt, the sender and the labels are always sent, the body and the PDF share the rest
+        remaining = self.max_prompt_tokens - self.count_tokens(SYSTEM_PROMPT) - self.count_tokens(sender) - 10
+        body = self.truncate(clean_body(body), min(self.max_body_tokens, remaining // 3))
+        pdf_content = select_pdf_snippets(pdf_text, remaining - self.count_tokens(body), self.count_tokens)
+        messages = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": f"{sender}\nEmail body: {body}\nPDF content: {pdf_content}"},
+        ]
+        return messages, sum(self.count_tokens(message["content"]) for message in messages)